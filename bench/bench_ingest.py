@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Measures how quickly remote packages are written to the database, comparing
+one execute per package (update_remote_package) against the batched executemany
+path used by update_remote (update_remote_stream).  Each run is stored as a
+repo of its own in the packages table, through the database module's
+connection, so the db_* pragmas of real runs apply.
+Like the tests, this needs libpnd.so.1 to be loadable."""
+import sys, os.path, tempfile, shutil, time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pndstore_core import options, database
+from repo_server import make_package
+
+
+def per_row(table, pkgs, cursor):
+    for p in pkgs:
+        database_update.update_remote_package(table, p, cursor)
+    return len(pkgs)
+
+
+def batched(table, pkgs, cursor):
+    return database_update.update_remote_stream(table, iter(pkgs), cursor)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--packages', '-n', dest='packages', type='int',
+        default=10000, help='number of synthetic packages [default: %default]')
+    opts, args = parser.parse_args()
+
+    options.working_dir = tempfile.mkdtemp()
+    try:
+        from pndstore_core import database_update
+        pkgs = [ make_package(i) for i in xrange(opts.packages) ]
+        for name, ingest in (('per-row', per_row), ('batched', batched)):
+            start = time.time()
+            # Use the connection real updates get, pragmas and all.
+            with database.transaction(path=options.get_database()) as db:
+                n = ingest(name, pkgs, db.cursor())
+            elapsed = time.time() - start
+            print '%-8s %8d rows %8.3f s %10.0f rows/s' % (
+                name, n, elapsed, n / elapsed)
+        database.close()
+    finally:
+        shutil.rmtree(options.working_dir)
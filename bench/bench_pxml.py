@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Measures the per-file cost of extracting the local table's fields from PNDs,
+comparing the single-pass ElementTree extractor (open_pxml and parse_pxml, as
+used by read_local_file) against the libpnd calls it replaced, which remain as
+its fallback (read_pxml_libpnd).
+
+By default the PNDs in test/testdata are used; others may be given as
+arguments.  PNDs whose PXML ElementTree can't parse even after repairs are
+skipped, since those would use libpnd either way.
+Like the tests, this needs libpnd.so.1 to be loadable."""
+import sys, os.path, tempfile, shutil, time, glob
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pndstore_core import options
+
+
+def elementtree(path):
+    with database_update.open_pxml(path) as pxml:
+        return database_update.parse_pxml(pxml, locales)
+
+
+def libpnd(path):
+    return database_update.read_pxml_libpnd(path)
+
+
+def measure(extract, paths, repeat):
+    "Gives the mean seconds taken by extract per file."
+    start = time.time()
+    for i in xrange(repeat):
+        for path in paths:
+            extract(path)
+    return (time.time() - start) / (repeat * len(paths))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options] [PND files]')
+    parser.add_option('--repeat', '-n', dest='repeat', type='int',
+        default=200, help='times to read each PND [default: %default]')
+    opts, args = parser.parse_args()
+    if not args:
+        args = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..',
+            'test', 'testdata', '*.pnd')))
+
+    options.working_dir = tempfile.mkdtemp()
+    try:
+        from pndstore_core import database_update
+        locales = options.get_locale()
+        paths = []
+        for path in args:
+            try: elementtree(path)
+            except (SyntaxError, database_update.PXMLError,
+                    database_update.PNDError):
+                print 'Skipping %s: not parsed by ElementTree' % path
+            else: paths.append(path)
+
+        print '%d PNDs, %d reads each' % (len(paths), opts.repeat)
+        results = [ (name, measure(extract, paths, opts.repeat))
+            for name, extract in (('libpnd', libpnd),
+                ('elementtree', elementtree)) ]
+        for name, per_file in results:
+            print '%-12s %10.1f us/file %8.2fx' % (name, per_file * 1e6,
+                results[0][1] / per_file)
+    finally:
+        shutil.rmtree(options.working_dir)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Measures database_update.update_remote against local stand-in repositories
+(see repo_server.py), to catch regressions in the remote ingest path.
+
+For each feed size, three runs are measured:
+
+    full          first update of an empty database
+    delta         second update, using each repo's updates URL
+    not-modified  update of repos without updates URLs whose feeds haven't
+                  changed, so each gets a 304 response
+
+Each run reports wall time, rows written per second, SQL statements executed
+(executemany counts once), and peak RSS.  Every feed size runs in its own
+process so its peak RSS isn't hidden by an earlier, larger one; within a size,
+the full run normally sets the peak.
+Like the tests, this needs libpnd.so.1 to be loadable."""
+import sys, os.path, tempfile, shutil, sqlite3, time, json, resource
+import subprocess, threading
+from optparse import OptionParser, SUPPRESS_HELP
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pndstore_core import options
+import repo_server
+
+
+sql_stats = {'statements':0, 'rows':0}
+_stats_lock = threading.Lock()
+
+def _count(statements, rows):
+    with _stats_lock:
+        sql_stats['statements'] += statements
+        sql_stats['rows'] += rows
+
+
+class CountingCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        _count(1, sql.lstrip().lower().startswith('insert'))
+        return sqlite3.Cursor.execute(self, sql, *args)
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        _count(1, len(seq))
+        return sqlite3.Cursor.executemany(self, sql, seq)
+
+
+class CountingConnection(sqlite3.Connection):
+    # Connection.execute and executemany go through this too.
+    def cursor(self, factory=CountingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+def count_sql():
+    "Makes every later sqlite3 connection count its statements in sql_stats."
+    connect = sqlite3.connect
+    def counting_connect(*args, **kwargs):
+        kwargs.setdefault('factory', CountingConnection)
+        return connect(*args, **kwargs)
+    sqlite3.connect = counting_connect
+
+
+def write_cfg(repos):
+    with open(options.get_cfg(), 'w') as cfg:
+        json.dump({'repositories': repos, 'locales': ['en_US'],
+            'searchpath': []}, cfg)
+
+
+def measure(name, packages, update):
+    "Runs update, printing its measurements as a line of the results table."
+    sql_stats.update(statements=0, rows=0)
+    start = time.time()
+    update()
+    elapsed = time.time() - start
+    # Linux gives ru_maxrss in KiB.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print '%9d  %-12s %8.3f s %10.0f rows/s %8d stmts %8.1f MiB' % (packages,
+        name, elapsed, sql_stats['rows'] / elapsed, sql_stats['statements'], rss)
+    sys.stdout.flush()
+
+
+def run_size(packages, opts):
+    "Measures all runs for one feed size."
+    server = repo_server.RepoServer(compress=opts.compress,
+        delta_fraction=opts.delta)
+    server.start()
+    options.working_dir = tempfile.mkdtemp()
+    try:
+        write_cfg([ server.feed_url(packages, 'repo%d' % i, updates=True)
+            for i in xrange(opts.repos) ])
+        count_sql()
+        from pndstore_core import database_update
+        update = lambda: database_update.update_remote(threads=opts.threads)
+
+        measure('full', packages, update)
+        measure('delta', packages, update)
+
+        write_cfg([ server.feed_url(packages, 'plain%d' % i)
+            for i in xrange(opts.repos) ])
+        update()
+        measure('not-modified', packages, update)
+    finally:
+        server.shutdown()
+        shutil.rmtree(options.working_dir)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--packages', '-n', dest='packages',
+        default='1000,10000,100000', help=
+        'comma-separated feed sizes, in packages per repo [default: %default]')
+    parser.add_option('--repos', '-r', dest='repos', type='int', default=3,
+        help='number of repos to serve [default: %default]')
+    parser.add_option('--threads', '-t', dest='threads', type='int',
+        default=None, help='repos to update at once [default: from config]')
+    parser.add_option('--delta', dest='delta', type='float', default=0.01,
+        help='fraction of packages changed in update deltas [default: %default]')
+    parser.add_option('--no-compress', action='store_false', dest='compress',
+        default=True, help="don't gzip feeds")
+    parser.add_option('--child', dest='child', type='int', help=SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+
+    if opts.child:
+        run_size(opts.child, opts)
+    else:
+        print '%9s  %-12s %10s %17s %14s %12s' % ('packages', 'run', 'wall',
+            'rows/s', 'SQL', 'peak RSS')
+        sys.stdout.flush()
+        for n in opts.packages.split(','):
+            subprocess.check_call([sys.executable] + sys.argv + ['--child', n])
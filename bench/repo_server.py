@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""Serves synthetic PND repository feeds over HTTP, standing in for real repo
+servers so that remote updates can be measured reproducibly.
+
+Feeds are generated on the fly, so even very large ones cost the server little
+memory.  URLs take the form:
+
+    /<packages>/<name>              full feed of <packages> packages
+    /<packages>/<name>?updates=1    same, but advertising an updates URL
+    /<packages>/<name>/updates?since=<time>
+                                    updates-URL delta, in which a fraction of
+                                    the packages have a new version
+
+Full feeds have an ETag, so a conditional request for an unchanged feed gets a
+304 response.  Responses are gzip compressed when the client accepts it.
+
+Run this directly to serve feeds for manual testing."""
+
+import BaseHTTPServer, SocketServer, threading, urlparse, json, zlib
+from optparse import OptionParser
+
+# Localizations that synthetic packages may have.  Every package has en_US, as
+# required by the spec; others are added in varying combinations.
+LOCALES = ('en_US', 'de_DE', 'fr_FR', 'it_IT', 'es_ES', 'en_CA')
+# Bytes of feed to collect before sending them as one chunk.
+CHUNK_SIZE = 16 * 1024
+
+
+def make_package(i, revision=0):
+    """Gives synthetic package number i in the form used by repository feeds.
+    Packages with a higher revision have a newer version."""
+    localizations = {}
+    for lang in LOCALES[:1 + i % len(LOCALES)]:
+        localizations[lang] = {
+            'title': 'Package %d (%s)' % (i, lang),
+            'description': 'Synthetic package number %d, revision %d, '
+                'described in %s.' % (i, revision, lang) }
+    return {
+        'id': 'bench.package.%d' % i,
+        'uri': 'http://example.org/bench/%d.pnd' % i,
+        'version': {'major': str(i % 10), 'minor': str(i % 7),
+            'release': str(revision), 'build': str(i), 'type': 'release'},
+        'localizations': localizations,
+        'size': 1000 + i,
+        'md5': '%032x' % (i + revision),
+        'modified-time': 1300000000 + i + revision,
+        'author': {'name': 'Author %d' % (i % 50)},
+        'vendor': 'bench',
+        'icon': 'http://example.org/bench/%d.png' % i,
+        'previewpics': ['http://example.org/bench/%d-1.png' % i],
+        'categories': ['Game', 'ActionGame'] if i % 2 else ['System'],
+    }
+
+
+def make_feed(name, ids, revision=0, updates_url=None):
+    """Yields a repository feed holding the packages numbered in "ids", piece
+    by piece."""
+    repository = {'name': name, 'version': 3.0}
+    if updates_url:
+        repository['updates'] = updates_url
+    yield '{"repository": %s, "packages": [' % json.dumps(repository)
+    for n, i in enumerate(ids):
+        yield (',' if n else '') + json.dumps(make_package(i, revision))
+    yield ']}'
+
+
+
+class RepoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        try:
+            n = int(parts[0])
+            name = parts[1]
+        except (IndexError, ValueError):
+            self.send_error(404)
+            return
+
+        if parts[2:] == ['updates']:
+            # Every package in the delta gets a new version.
+            step = max(1, int(round(1 / self.server.delta_fraction)))
+            feed = make_feed(name, xrange(0, n, step), revision=1)
+            etag = None
+        else:
+            updates_url = None
+            if query.get('updates'):
+                updates_url = 'http://%s:%d/%d/%s/updates?since=%%time%%' % (
+                    self.server.server_address + (n, name))
+            feed = make_feed(name, xrange(n), updates_url=updates_url)
+            etag = '"%d-%s"' % (n, name)
+            if self.headers.getheader('If-None-Match') == etag:
+                self.server.count('not_modified')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        compress = (self.server.compress and
+            'gzip' in self.headers.getheader('Accept-Encoding', ''))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if etag:
+            self.send_header('ETag', etag)
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.server.count('ok')
+
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        pending = []
+        size = 0
+        for piece in feed:
+            pending.append(piece)
+            size += len(piece)
+            if size >= CHUNK_SIZE:
+                data = ''.join(pending)
+                self._write_chunk(z.compress(data) if compress else data)
+                pending = []
+                size = 0
+        data = ''.join(pending)
+        self._write_chunk(z.compress(data) + z.flush() if compress else data)
+        self.wfile.write('0\r\n\r\n')
+
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+            self.server.count('bytes', len(data))
+
+
+    def log_message(self, *args):
+        pass
+
+
+
+class RepoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves synthetic feeds from a background thread once start is called.
+    "delta_fraction" is the portion of packages changed in each updates-URL
+    delta.  The stats dictionary counts full responses ("ok"), 304 responses
+    ("not_modified"), and body bytes sent ("bytes")."""
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), compress=True,
+            delta_fraction=0.01):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RepoHandler)
+        self.compress = compress
+        self.delta_fraction = delta_fraction
+        self.stats = {'ok':0, 'not_modified':0, 'bytes':0}
+        self._lock = threading.Lock()
+
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up early is normal for a benchmark.
+        pass
+
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+
+    def feed_url(self, packages, name, updates=False):
+        """Gives the URL of a full feed served by this server."""
+        return 'http://%s:%d/%d/%s%s' % (self.server_address +
+            (packages, name, '?updates=1' if updates else ''))
+
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--port', '-p', dest='port', type='int', default=8000,
+        help='port to listen on [default: %default]')
+    parser.add_option('--no-compress', action='store_false', dest='compress',
+        default=True, help="don't gzip responses")
+    parser.add_option('--delta', dest='delta', type='float', default=0.01,
+        help='fraction of packages changed in update deltas [default: %default]')
+    opts, args = parser.parse_args()
+
+    server = RepoServer(('127.0.0.1', opts.port), opts.compress, opts.delta)
+    print 'Serving feeds like %s' % server.feed_url(1000, 'example', True)
+    server.serve_forever()
@@ -0,0 +1,150 @@
+"""
+This module hands out connections to the sqlite database.  Opening a connection
+costs far more than the small queries this program mostly makes, so each thread
+keeps one connection per database file, opened the first time it's wanted and
+reused from then on.  Looking up hundreds of packages therefore opens the
+database once, not hundreds of times.
+
+Every connection gives rows as sqlite3.Row, so columns can be taken by name or
+position.  Text is decoded from UTF-8 into Unicode strings by default; pass
+BYTES to get bytestrings instead, as database_update does for file paths.
+
+Use transaction in a with block, both for reads and changes:
+
+    with database.transaction() as db:
+        db.execute(...)
+
+A transaction commits when its with block ends, or rolls back if the block
+raises an exception, just like using a new sqlite3 connection in a with block.
+Transactions in the same thread may be nested, in which case only the
+outermost commits or rolls back.  Code that needs to commit part-way through
+(such as a long update writing in batches) may call commit itself.
+get_stats shows how many connections have been opened and reused.
+
+Connections are tuned by the db_* options: by default, the database uses
+write-ahead logging (WAL), so the GUI can keep reading while an update writes
+in the background, and only syncs to disk at checkpoints, which is much
+kinder to SD cards.  Each connection waits up to options.get_db_busy_timeout()
+for others' writes, and caches and memory-maps as much of the database as
+options allow.
+
+If the database file is deleted or replaced, the connections to it are dropped
+and new ones opened the next time they're wanted.
+
+Concurrency note: sqlite connections mustn't be shared between threads, so each
+thread has its own; they're closed when the thread ends, or by close.  Don't
+use connections made before a fork in the child process.
+"""
+
+import options, sqlite3, threading, os
+from contextlib import contextmanager
+
+
+def decode_text(s):
+    "Decodes UTF-8 text from the database, replacing anything that isn't."
+    return unicode(s, 'utf-8', 'replace')
+
+# Text factories: Unicode strings, or the bytestrings stored.
+TEXT = decode_text
+BYTES = str
+
+
+class _Local(threading.local):
+    def __init__(self):
+        # Database path to [connection, (st_dev, st_ino), transaction depth].
+        self.connections = {}
+
+_local = _Local()
+_stats = {'requests':0, 'opened':0, 'reused':0}
+_stats_lock = threading.Lock()
+
+
+def get_stats():
+    """Returns a copy of the counts of connections requested, opened and
+    reused, over all threads."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _count(key):
+    with _stats_lock:
+        _stats['requests'] += 1
+        _stats[key] += 1
+
+
+def _get(path):
+    """Gives the cache entry of this thread's connection to "path", opening it
+    if it isn't open or the file has changed since."""
+    try:
+        st = os.stat(path)
+        ident = (st.st_dev, st.st_ino)
+    except OSError:
+        ident = None
+    entry = _local.connections.get(path)
+    if entry is not None and ident is not None and entry[1] == ident:
+        _count('reused')
+        return entry
+
+    if entry is not None:
+        entry[0].close()
+    db = sqlite3.connect(path, timeout=options.get_db_busy_timeout())
+    db.row_factory = sqlite3.Row
+    db.text_factory = TEXT
+    _configure(db)
+    st = os.stat(path)
+    entry = [db, (st.st_dev, st.st_ino), 0]
+    _local.connections[path] = entry
+    _count('opened')
+    return entry
+
+
+def _configure(db):
+    """Applies the db_* options to the new connection "db"."""
+    # The journal mode is kept in the file, so this only changes anything the
+    # first time.  That needs nobody else to be using the database; if someone
+    # is, the next connection can try again.
+    try: db.execute('Pragma journal_mode=%s' % options.get_db_journal_mode())
+    except sqlite3.OperationalError: pass
+    db.execute('Pragma synchronous=%s' % options.get_db_synchronous())
+    # A negative cache size is in KiB rather than pages.
+    db.execute('Pragma cache_size=%d' % -(options.get_db_cache_size() // 1024))
+    db.execute('Pragma mmap_size=%d' % options.get_db_mmap_size())
+
+
+def get_connection(path=None):
+    """Gives this thread's connection to the database at "path" (defaulting to
+    options.get_database()), opening it if needed."""
+    return _get(path or options.get_database())[0]
+
+
+@contextmanager
+def transaction(text_factory=TEXT, path=None):
+    """Gives this thread's connection to the database at "path" (defaulting to
+    options.get_database()) for use in a with block, with text given by
+    "text_factory" until the block ends.  Commits when the block ends, or rolls
+    back if it raises an exception; nested in another transaction, this does
+    neither, leaving it to the outermost."""
+    entry = _get(path or options.get_database())
+    db = entry[0]
+    old = db.text_factory
+    db.text_factory = text_factory
+    entry[2] += 1
+    try:
+        yield db
+    except:
+        if entry[2] == 1:
+            db.rollback()
+        raise
+    else:
+        if entry[2] == 1:
+            db.commit()
+    finally:
+        entry[2] -= 1
+        db.text_factory = old
+
+
+def close():
+    """Closes this thread's connections.  They'll be opened again if wanted."""
+    connections, _local.connections = _local.connections, {}
+    for entry in connections.itervalues():
+        entry[0].close()
@@ -10,14 +10,27 @@ created in the working directory specified by pndstore_core.options.
 Therefore, you must ensure that options.working_dir is set to the desired
 directory *before* this module is imported.
 
+Pass an observer to update_remote or update_local to follow their progress; see
+the progress module for the events it will be sent.
+
 Concurrency note: Most functions here make changes to the database.  However,
-they all create their own connections and cursors; since sqlite can handle
-concurrent database writes automatically, these functions should be thread safe.
+they all use their own thread's connection (see the database module); since
+sqlite can handle concurrent database writes automatically, these functions
+should be thread safe.  update_remote takes advantage of this by fetching
+several repositories at once, each in its own thread with its own connection.
 """
 
-import options, libpnd, urllib2, sqlite3, json, ctypes, warnings, time
+import options, database, libpnd, jsonstream, httpclient, progress, images
+import urllib2, sqlite3
+import ctypes, socket, httplib
+import warnings, time, threading, Queue, os, multiprocessing, mmap, re
+import sys, stat, errno, glob
+from contextlib import contextmanager
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+from distutils.version import LooseVersion
 import xml.etree.cElementTree as etree
-from hashlib import md5
+from hashlib import md5, sha1
 
 #This module currently supports these versions of the PND repository
 #specification as seen at http://pandorawiki.org/PND_repository_specification
@@ -25,18 +38,96 @@ REPO_VERSION = (2.0, 3.0)
 
 LOCAL_TABLE = 'local'
 REPO_INDEX_TABLE = 'repo_index'
+# Packages of every repo, keyed by (repo, id), where repo is the repo's URL as
+# in REPO_INDEX_TABLE.  Each repo also gets a read-only view of its own
+# packages, named by its URL, as it had its own table in older versions.
+PACKAGES_TABLE = 'packages'
+# Each package's applications and categories, one per row, so packages can be
+# found by either through an index.  Installed packages are listed with
+# LOCAL_TABLE as their repo.
+APPLICATIONS_TABLE = 'package_applications'
+CATEGORIES_TABLE = 'package_categories'
+# Full-text index of packages for packages.search, and the docids of its rows,
+# keyed like PACKAGES_TABLE.
+SEARCH_TABLE = 'package_search'
+SEARCH_IDS_TABLE = 'package_search_ids'
+# Stat, MD5 and icon cache of the PND files behind LOCAL_TABLE, for incremental
+# updates.
+LOCAL_FILES_TABLE = 'local_files'
+# Names that can't be used for repo views.
+RESERVED_TABLES = (LOCAL_TABLE, REPO_INDEX_TABLE, LOCAL_FILES_TABLE,
+    PACKAGES_TABLE, APPLICATIONS_TABLE, CATEGORIES_TABLE, SEARCH_TABLE,
+    SEARCH_IDS_TABLE, images.REMOTE_IMAGES_TABLE)
 SEPCHAR = ';' # Character that defines list separations in the database.
 
 # Minimum amount of time to wait between full updates (in seconds).
 FULL_UPDATE_TIME = 3000000 # ~35 days.
 # The substring that gets replaced in updates URLs, as given in the repo spec.
 TIME_SUBSTRING = '%time%'
-
+# Number of remote packages written to the database with each executemany.
+BATCH_SIZE = 256
+# Suffix of the table a full update is loaded into before being compared with
+# the repo's live table.  URLs can't contain spaces, so this can't clash with
+# a real repo.
+SHADOW_SUFFIX = ' (new)'
+# Bytes to copy at a time when saving a feed to disk.
+CHUNK_SIZE = 16 * 1024
+# Bytes of a local PND to read at a time when computing its MD5 sum.
+HASH_CHUNK_SIZE = 1024 * 1024
+# Number of updates in a row a repo may fail before update_remote starts
+# skipping it for a cool-down period (see options.get_repo_cooldown).
+FAILURES_BEFORE_COOLDOWN = 3
+# Longest cool-down in seconds, no matter how many times a repo has failed.
+MAX_COOLDOWN = 7 * 24 * 3600
+
+# Files with this extension (in any case) are PNDs, as libpnd's discovery has it.
+PND_EXT = '.pnd'
 PXML_NAMESPACE = 'http://openpandora.org/namespaces/PXML'
+# Tags that mark the start and end of the PXML appended to a PND.
+PXML_START = '<PXML'
+PXML_END = '</PXML>'
+# What may separate a PND's PXML from its icon.
+_ICON_GAP = re.compile(r'[\s\0]*')
 xml_child = lambda s: '{%s}%s' % (PXML_NAMESPACE, s)
 
 class RepoError(Exception): pass
 class PNDError(Exception): pass
+class PXMLError(Exception): pass
+
+
+class HashingReader(object):
+    """Wraps a file-like object, keeping a SHA-1 hash of everything read from
+    it so far."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.hash = sha1()
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class ProgressReader(object):
+    """Wraps a file-like object, reporting the running total of bytes read from
+    it to the progress.Reporter "reporter"."""
+    def __init__(self, fp, reporter):
+        self.fp = fp
+        self.reporter = reporter
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if data:
+            self.bytes += len(data)
+            self.reporter.emit(progress.BYTES_RECEIVED, bytes=self.bytes)
+        return data
+
+    def info(self):
+        return self.fp.info()
 
 
 def sanitize_sql(name):
@@ -51,37 +142,308 @@ def sanitize_sql(name):
     #TODO: Remove str call once/if it's not needed.
 
 
-def create_table(cursor, name):
-    name = sanitize_sql(name)
-    cursor.execute("""Create Table If Not Exists "%s" (
-        id Text Primary Key,
-        uri Text,
-        version Text,
-        title Text,
-        description Text,
-        info Text,
-        size Int,
-        md5 Text,
-        modified_time Int,
-        rating Int,
-        author_name Text,
-        author_website Text,
-        author_email Text,
-        vendor Text,
-        icon Text,
-        previewpics Text,
-        licenses Text,
-        source Text,
-        categories Text,
-        applications Text,
-        appdatas Text
-        )""" % name)
+def add_columns(cursor, table, columns):
+    """Adds any of "columns" (a sequence of (name, type) pairs) that "table"
+    doesn't have yet, so that databases made by older versions keep working."""
+    table = sanitize_sql(table)
+    existing = set(i[1] for i in
+        cursor.execute('Pragma table_info("%s")' % table).fetchall())
+    for name, coltype in columns:
+        if name not in existing:
+            cursor.execute('Alter Table "%s" Add Column %s %s'
+                % (table, name, coltype))
+
+
+# Columns of a package, in order, as in the local table and the rows given by
+# remote_package_row and read_local_file.
+PACKAGE_COLUMNS = ( ('id', 'Text'),
+    ('uri', 'Text'),
+    ('version', 'Text'),
+    ('title', 'Text'),
+    ('description', 'Text'),
+    ('info', 'Text'),
+    ('size', 'Int'),
+    ('md5', 'Text'),
+    ('modified_time', 'Int'),
+    ('rating', 'Int'),
+    ('author_name', 'Text'),
+    ('author_website', 'Text'),
+    ('author_email', 'Text'),
+    ('vendor', 'Text'),
+    ('icon', 'Text'),
+    ('previewpics', 'Text'),
+    ('licenses', 'Text'),
+    ('source', 'Text'),
+    ('categories', 'Text'),
+    ('applications', 'Text'),
+    ('appdatas', 'Text'),
+    ('version_key', 'Text') )
+# The same, ready to go in a Select.
+PACKAGE_COLUMN_NAMES = ', '.join(c[0] for c in PACKAGE_COLUMNS)
+# Tables listing the entries of SEPCHAR-separated columns, as (table, column,
+# name of an entry in the table).
+PACKAGE_LISTS = ( (APPLICATIONS_TABLE, 'applications', 'appid'),
+    (CATEGORIES_TABLE, 'categories', 'category') )
+# Columns of the search index, and the package columns they're taken from.
+SEARCH_COLUMNS = ( ('title', 'title'),
+    ('description', 'description'),
+    ('author', 'author_name'),
+    ('categories', 'categories') )
+# Full-text modules to try for the search index, in order of preference.
+SEARCH_MODULES = ('fts4', 'fts3')
+# Whether the search index exists, as found by create_index_tables.
+search_available = False
 
 
-def update_remote_package(table, pkg, cursor):
-    """Insert or replace information on a package into "table".
-    "pkg" is assumed to be a dictionary in the form given by each package
-    listed in the given repository."""
+def create_table(cursor, name):
+    """Creates a table of packages called "name", keyed by id, like the local
+    table or a repo's shadow table, if it doesn't exist."""
+    cursor.execute('Create Table If Not Exists "%s" (%s Primary Key, %s)'
+        % (sanitize_sql(name), ' '.join(PACKAGE_COLUMNS[0]),
+        ', '.join(' '.join(c) for c in PACKAGE_COLUMNS[1:])))
+
+
+def create_packages_table(cursor):
+    """Creates PACKAGES_TABLE and its indexes if they don't exist."""
+    cursor.execute("""Create Table If Not Exists "%s" (repo Text, %s,
+        Primary Key (repo, id))""" % (PACKAGES_TABLE,
+        ', '.join(' '.join(c) for c in PACKAGE_COLUMNS)))
+    # The primary key serves lookups by repo, this index lookups by id and of
+    # the latest version of a package.
+    add_columns(cursor, PACKAGES_TABLE, [('version_key', 'Text')])
+    cursor.execute('''Create Index If Not Exists "%s_version"
+        On "%s" (id, version_key)''' % (PACKAGES_TABLE, PACKAGES_TABLE))
+    # It makes the index by id alone that came before it redundant.
+    cursor.execute('Drop Index If Exists "%s_id"' % PACKAGES_TABLE)
+
+
+def create_repo_view(cursor, table):
+    """Creates the read-only view of the packages of the repo stored as "table"
+    in PACKAGES_TABLE, in the order they were written, if it doesn't exist."""
+    table = sanitize_sql(table)
+    # Views can't have parameters, so quote the repo as a string literal.
+    cursor.execute("""Create View If Not Exists "%s" As Select %s From "%s"
+        Where repo='%s' Order By rowid""" % (table, PACKAGE_COLUMN_NAMES,
+        PACKAGES_TABLE, table.replace("'", "''")))
+
+
+def create_index_tables(cursor):
+    """Creates the tables of PACKAGE_LISTS and the search index, and their
+    indexes, if they don't exist.  Returns True if any had to be created, in
+    which case they should be filled with rebuild_package_index."""
+    global search_available
+    names = set( i[0] for i in cursor.execute(
+        "Select name From sqlite_master").fetchall() )
+    created = False
+    for table, column, entry in PACKAGE_LISTS:
+        created = created or table not in names
+        # The primary key serves finding a package's entries, the index finding
+        # the packages with an entry.  Entries are matched regardless of case,
+        # as Like did before these tables, so the index ignores case too.
+        cursor.execute("""Create Table If Not Exists "%s" (repo Text, id Text,
+            %s Text, Primary Key (repo, id, %s))""" % (table, entry, entry))
+        cursor.execute('''Create Index If Not Exists "%s_%s_nocase"
+            On "%s" (%s Collate NoCase, repo, id)'''
+            % (table, entry, table, entry))
+        cursor.execute('Drop Index If Exists "%s_%s"' % (table, entry))
+
+    # Full-text search needs sqlite's FTS module, which not every build has.
+    # Failing that, packages.search falls back on scanning.
+    search_available = SEARCH_TABLE in names
+    if not search_available:
+        for module in SEARCH_MODULES:
+            try:
+                cursor.execute('Create Virtual Table "%s" Using %s(%s)'
+                    % (SEARCH_TABLE, module, ', '.join( c for c, p in
+                    SEARCH_COLUMNS )))
+            except sqlite3.OperationalError:
+                continue
+            search_available = created = True
+            break
+    # Docids of the search index, which stay the same while a package exists.
+    created = created or SEARCH_IDS_TABLE not in names
+    cursor.execute("""Create Table If Not Exists "%s" (repo Text, id Text,
+        Primary Key (repo, id))""" % SEARCH_IDS_TABLE)
+    return created
+
+
+def _split(value):
+    "Gives the entries of a SEPCHAR-separated column."
+    return [ i for i in value.split(SEPCHAR) if i ] if value else []
+
+
+# Columns of packages kept in the tables of PACKAGE_LISTS or the search index.
+INDEX_COLUMNS = ('applications', 'categories', 'title', 'description',
+    'author_name')
+# Positions of INDEX_COLUMNS in rows of PACKAGE_COLUMNS.
+_INDEX_POSITIONS = [ [ i[0] for i in PACKAGE_COLUMNS ].index(c)
+    for c in INDEX_COLUMNS ]
+
+def package_index_values(row):
+    """Gives the id and INDEX_COLUMNS, in order, from a row of PACKAGE_COLUMNS,
+    for write_package_index."""
+    return (row[0],) + tuple( row[i] for i in _INDEX_POSITIONS )
+
+
+def write_package_index(cursor, repo, rows, gone=()):
+    """Replaces the entries in the tables of PACKAGE_LISTS and the search index
+    of the packages of "repo" (a repo's URL, or LOCAL_TABLE) given by "rows",
+    and forgets those of the packages whose ids are in "gone".  Each row is a
+    package's id followed by its INDEX_COLUMNS, in order."""
+    # Only the last row given for a package counts, as when inserting.
+    rows = dict( (r[0], r) for r in rows ).values()
+    ids = [ (repo, r[0]) for r in rows ] + [ (repo, i) for i in gone ]
+    for table, column, entry in PACKAGE_LISTS:
+        n = INDEX_COLUMNS.index(column) + 1
+        cursor.executemany('Delete From "%s" Where repo=? And id=?' % table,
+            ids)
+        cursor.executemany('Insert Or Ignore Into "%s" Values (?,?,?)' % table,
+            ((repo, r[0], v) for r in rows for v in _split(r[n])))
+
+    if not search_available:
+        return
+    names = {'s':SEARCH_TABLE, 'i':SEARCH_IDS_TABLE,
+        'c':', '.join( c for c, p in SEARCH_COLUMNS ),
+        'v':', '.join('?' * len(SEARCH_COLUMNS))}
+    positions = [ INDEX_COLUMNS.index(p) + 1 for c, p in SEARCH_COLUMNS ]
+    # Comparing docid to a single value lets FTS look it up directly.
+    cursor.executemany('''Delete From "%(s)s" Where docid=(Select rowid From
+        "%(i)s" Where repo=? And id=?)''' % names, ids)
+    cursor.executemany('Delete From "%(i)s" Where repo=? And id=?' % names,
+        ((repo, i) for i in gone))
+    cursor.executemany('Insert Or Ignore Into "%(i)s" Values (?,?)' % names,
+        ((repo, r[0]) for r in rows))
+    cursor.executemany('''Insert Into "%(s)s" (docid, %(c)s)
+        Select rowid, %(v)s From "%(i)s" Where repo=? And id=?''' % names,
+        ( tuple( r[p] for p in positions ) + (repo, r[0]) for r in rows ))
+
+
+def _index_rows(cursor, repo, ids=None):
+    """Gives the rows write_package_index wants for the packages of "repo", or
+    only for those whose ids are in the list "ids" if given."""
+    columns = ', '.join(INDEX_COLUMNS)
+    where = []
+    params = []
+    if repo == LOCAL_TABLE:
+        sql = 'Select id, %s From "%s"' % (columns, LOCAL_TABLE)
+    else:
+        sql = 'Select id, %s From "%s"' % (columns, PACKAGES_TABLE)
+        where.append('repo=?')
+        params.append(repo)
+    if ids is None:
+        if where:
+            sql += ' Where ' + ' And '.join(where)
+        return cursor.execute(sql, params).fetchall()
+
+    # Look ids up a batch at a time, keeping under sqlite's parameter limit.
+    rows = []
+    for n in xrange(0, len(ids), BATCH_SIZE):
+        batch = ids[n:n+BATCH_SIZE]
+        rows.extend(cursor.execute(sql + ' Where ' + ' And '.join(where +
+            ['id In (%s)' % ','.join('?' * len(batch))]),
+            params + batch).fetchall())
+    return rows
+
+
+def update_package_index(cursor, repo, ids):
+    """Brings the entries in the tables of PACKAGE_LISTS and the search index of
+    the packages of "repo" (a repo's URL, or LOCAL_TABLE) with the given ids in
+    line with their rows, forgetting those of packages that are gone."""
+    ids = set(ids)
+    rows = _index_rows(cursor, repo, list(ids))
+    gone = ids.difference( r[0] for r in rows )
+    write_package_index(cursor, repo, rows, gone)
+
+
+def rebuild_package_index(cursor, repo=None):
+    """Fills the tables of PACKAGE_LISTS and the search index afresh from the
+    packages of "repo" (a repo's URL, or LOCAL_TABLE), or of every repo and
+    LOCAL_TABLE if None."""
+    if repo is None:
+        repos = [LOCAL_TABLE] + [ i[0] for i in cursor.execute(
+            'Select Distinct repo From "%s"' % PACKAGES_TABLE).fetchall() ]
+    else:
+        repos = [repo]
+    for r in repos:
+        gone = [ i[0] for i in cursor.execute('Select id From "%s" Where repo=?'
+            % SEARCH_IDS_TABLE, (r,)).fetchall() ]
+        for table, column, entry in PACKAGE_LISTS:
+            cursor.execute('Delete From "%s" Where repo=?' % table, (r,))
+        write_package_index(cursor, r, _index_rows(cursor, r), gone)
+
+
+def version_key(version):
+    """Gives a string that sorts bytewise (as sqlite compares text) in the same
+    order as packages.PNDVersion sorts "version", or None if "version" is None.
+    Like LooseVersion, the version is split into numbers and text, and then
+    each part is encoded so that text comes before the end of a version, which
+    comes before a number."""
+    if version is None:
+        return None
+    key = []
+    # LooseVersion doesn't parse empty versions at all.
+    for part in LooseVersion(version).version if version else ():
+        if isinstance(part, basestring):
+            # Ended by a character that sorts before any text.
+            key.append(u'\x01%s\x01' % part)
+        else:
+            # Numbers with more digits are larger, so lead with the count.
+            digits = str(part)
+            key.append(u'\x03%02d%s' % (len(digits), digits))
+    key.append(u'\x02')
+    return u''.join(key)
+
+
+def fill_version_keys(cursor, table):
+    """Sets the version_key of every row of "table" that doesn't have one yet,
+    as left by older versions."""
+    table = sanitize_sql(table)
+    rows = cursor.execute('''Select rowid, version From "%s"
+        Where version_key Is Null And version Is Not Null''' % table).fetchall()
+    cursor.executemany('Update "%s" Set version_key=? Where rowid=?' % table,
+        [ (version_key(v), i) for i, v in rows ])
+
+
+def migrate_repo_tables(cursor):
+    """Moves the packages of any repo that still has its own table, as made by
+    older versions, into PACKAGES_TABLE, and replaces the table with a view.
+    Does nothing for repos already moved, so it's safe to run every time."""
+    tables = set( i[0] for i in cursor.execute(
+        "Select name From sqlite_master Where type='table'") )
+    for (url,) in cursor.execute('Select url From "%s"'
+            % REPO_INDEX_TABLE).fetchall():
+        table = sanitize_sql(url)
+        if table in tables:
+            add_columns(cursor, table, [('version_key', 'Text')])
+            cursor.execute('Insert Or Replace Into "%s" Select ?, %s From "%s"'
+                ' Order By rowid' % (PACKAGES_TABLE, PACKAGE_COLUMN_NAMES,
+                table), (table,))
+            # Dropping the table commits the copy first.
+            cursor.execute('Drop Table "%s"' % table)
+        if table + SHADOW_SUFFIX in tables:
+            cursor.execute('Drop Table "%s"' % (table + SHADOW_SUFFIX))
+        create_repo_view(cursor, table)
+
+
+def insert_sql(table):
+    """Gives the statement that inserts or replaces a single package in "table",
+    which is PACKAGES_TABLE or one made by create_table.  Always giving the
+    same string for a table lets sqlite3's statement cache reuse the prepared
+    statement."""
+    n = len(PACKAGE_COLUMNS) + (table == PACKAGES_TABLE)
+    return 'Insert Or Replace Into "%s" Values (%s)' % (sanitize_sql(table),
+        ','.join('?' * n))
+
+
+def remote_package_row(pkg, locales=None):
+    """Gives a tuple of column values for a package, ready to be inserted with
+    insert_sql.  "pkg" is assumed to be a dictionary in the form given by each
+    package listed in the given repository.  "locales" is the list of preferred
+    languages, defaulting to options.get_locale(); pass it in when converting
+    many packages to avoid rereading the config file each time."""
+    if locales is None:
+        locales = options.get_locale()
+
     # Assume package ID and URI exist.  Not much to do if they don't.
     id = pkg['id']
     uri = pkg['uri']
@@ -99,7 +461,7 @@ def update_remote_package(table, pkg, cursor):
     # Get title and description.
     # First search for most preferred language available.
     l = dict()
-    for lang in options.get_locale():
+    for lang in locales:
         try:
             l = pkg['localizations'][lang]
             break
@@ -131,11 +493,11 @@ def update_remote_package(table, pkg, cursor):
     for i in opt_list.iterkeys():
         try: opt_list[i] = SEPCHAR.join(pkg[i])
         except: pass
+    # Only the ids of the package's applications are kept, as for local ones.
+    try: applications = _join([ a['id'] for a in pkg['applications'] ])
+    except: applications = None
 
-    # Insert extracted data into table.
-    cursor.execute("""Insert Or Replace Into "%s" Values
-        (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""" % table,
-        ( id,
+    return ( id,
         uri,
         version,
         title,
@@ -154,34 +516,297 @@ def update_remote_package(table, pkg, cursor):
         opt_list['licenses'],
         opt_list['source'],
         opt_list['categories'],
-        None, None ) )
+        applications,
+        None,
+        version_key(version) )
+
+
+def update_remote_package(table, pkg, cursor):
+    """Insert or replace information on a package of the repo stored as "table"
+    in PACKAGES_TABLE.  "pkg" is assumed to be a dictionary in the form given by
+    each package listed in the given repository."""
+    row = remote_package_row(pkg)
+    cursor.execute(insert_sql(PACKAGES_TABLE), (sanitize_sql(table),) + row)
+    write_package_index(cursor, sanitize_sql(table),
+        [package_index_values(row)])
+
+
+def update_remote_stream(table, pkgs, cursor, batch_size=BATCH_SIZE,
+        commit=False, reporter=progress.null, shadow=None):
+    """Inserts or replaces each package from the iterable "pkgs" as a package
+    of the repo stored as "table" in PACKAGES_TABLE, or into "shadow" instead,
+    if given, which is a table made by create_table.
+    Packages are converted to rows as soon as they're available and written
+    "batch_size" at a time with executemany, so a feed never has to be held in
+    memory all at once.  All batches go into the connection's current
+    transaction and committing is left to the caller, unless "commit" is True;
+    then each batch is committed as soon as it's written so no write lock is
+    held while waiting on the feed.  Only do that for a table readers don't
+    look at.  If the feed turns out to be malformed partway through, any
+    uncommitted packages are rolled back before the error is raised.  Progress
+    is reported to "reporter" after each batch.  Returns the number of packages
+    written."""
+    sql = insert_sql(PACKAGES_TABLE if shadow is None else shadow)
+    # Rows of PACKAGES_TABLE start with their repo.
+    prefix = (sanitize_sql(table),) if shadow is None else ()
+    locales = options.get_locale()
+    parsed = 0
+    n = 0
+    batch = []
+
+    def write():
+        reporter.emit(progress.PACKAGES_PARSED, packages=parsed)
+        cursor.executemany(sql, batch)
+        if shadow is None:
+            write_package_index(cursor, prefix[0],
+                ( package_index_values(r[1:]) for r in batch ))
+        if commit: cursor.connection.commit()
+        reporter.emit(progress.ROWS_WRITTEN, rows=n + len(batch))
+        return len(batch)
+
+    try:
+        for pkg in pkgs:
+            parsed += 1
+            try: batch.append(prefix + remote_package_row(pkg, locales))
+            except Exception as e:
+                warnings.warn("Could not process remote package: %s" % repr(e))
+            if len(batch) >= batch_size:
+                n += write()
+                batch = []
+        if batch:
+            n += write()
+    except:
+        cursor.connection.rollback()
+        raise
+    return n
+
+
+def apply_shadow_table(cursor, table, shadow):
+    """Makes the packages of the repo stored as "table" in PACKAGES_TABLE match
+    "shadow" by deleting, inserting or replacing only the rows that differ
+    between them.  This is done entirely with DML statements in the
+    connection's current transaction, so readers see either the old contents or
+    the new ones, never a mix; committing is left to the caller.  Returns a
+    tuple of the numbers of (inserted, changed, deleted) packages."""
+    names = {'p':PACKAGES_TABLE, 's':sanitize_sql(shadow),
+        'c':PACKAGE_COLUMN_NAMES}
+    repo = (sanitize_sql(table),)
+    inserted = cursor.execute('''Select Count(*) From "%(s)s"
+        Where id Not In (Select id From "%(p)s" Where repo=?)''' % names,
+        repo).fetchone()[0]
+    deleted = [ i[0] for i in cursor.execute('''Select id From "%(p)s"
+        Where repo=? And id Not In (Select id From "%(s)s")''' % names,
+        repo).fetchall() ]
+    # Except leaves only the new rows and those with any column changed.
+    written = [ i[0] for i in cursor.execute('''Select id From
+        (Select * From "%(s)s" Except Select %(c)s From "%(p)s" Where repo=?)'''
+        % names, repo).fetchall() ]
+
+    cursor.execute('''Delete From "%(p)s" Where repo=?
+        And id Not In (Select id From "%(s)s")''' % names, repo)
+    # Except's output is sorted, so reselect the rows to keep the repo's own
+    # order.
+    cursor.execute('''Insert Or Replace Into "%(p)s"
+        Select ?, * From "%(s)s" Where id In (Select id From
+            (Select * From "%(s)s" Except
+            Select %(c)s From "%(p)s" Where repo=?))
+        Order By rowid''' % names, repo * 2)
+    update_package_index(cursor, repo[0], deleted + written)
+    return inserted, len(written) - inserted, len(deleted)
+
+
+def add_repo_index(cursor, table):
+    """Returns the index entry (etag, last_modified, updates_url, last_update,
+    last_full_update, feed_hash) of the repo stored in "table".  If the repo is
+    not yet in the index (it's the first time it's been checked), an empty
+    entry and view are made for it first."""
+    cursor.execute('''Select etag, last_modified, updates_url, last_update,
+        last_full_update, feed_hash From "%s" Where url=?'''
+        % REPO_INDEX_TABLE, (table,) )
+    result = cursor.fetchone()
+
+    if result is None:
+        cursor.execute('''Insert Into "%s" (url,last_update,last_full_update)
+            Values (?,?,?)''' % REPO_INDEX_TABLE, (table,0,0) )
+        create_repo_view(cursor, table)
+        result = (None, None, None, 0, 0, None)
+    return tuple(result)
+
+
+def record_repo_success(cursor, url):
+    """Clears the failure record of the repo at "url" in the index."""
+    cursor.execute('''Update "%s" Set failures=0, last_error=Null,
+        retry_after=Null Where url=?''' % REPO_INDEX_TABLE,
+        (sanitize_sql(url),) )
 
 
-def update_remote_url(url, cursor, full_update=None):
-    """Adds database table for the repository held by the url object.
+def record_repo_failure(cursor, url, error):
+    """Records in the index that the repo at "url" failed to update because of
+    the exception "error".  Once it has failed FAILURES_BEFORE_COOLDOWN times in
+    a row, it's given a cool-down period, which doubles with each further
+    failure.  Returns the time until which the repo should be skipped, or None
+    if it shouldn't be."""
+    table = sanitize_sql(url)
+    failures = cursor.execute('''Select Coalesce(failures, 0) From "%s"
+        Where url=?''' % REPO_INDEX_TABLE, (table,) ).fetchone()
+    failures = (failures[0] if failures else 0) + 1
+
+    t = int(time.time())
+    retry_after = None
+    if failures >= FAILURES_BEFORE_COOLDOWN:
+        retry_after = t + int(min(MAX_COOLDOWN, options.get_repo_cooldown(url)
+            * 2 ** (failures - FAILURES_BEFORE_COOLDOWN)))
+    cursor.execute('''Update "%s" Set failures=?, last_error=?,
+        last_failure=?, retry_after=? Where url=?''' % REPO_INDEX_TABLE,
+        (failures, repr(error), t, retry_after, table) )
+    return retry_after
+
+
+def is_transient_error(e):
+    """Tells whether the exception "e", raised while trying to reach a repo,
+    might not happen again if the request is retried."""
+    if isinstance(e, urllib2.HTTPError):
+        # Timeouts, rate limiting and server errors.
+        return e.code in (408, 429) or e.code >= 500
+    if isinstance(e, urllib2.URLError):
+        # Other URLErrors, like missing files, won't go away.
+        e = e.reason
+    # socket.error includes timeouts and failed DNS lookups.
+    return isinstance(e, (socket.error, httplib.HTTPException))
+
+
+def open_with_retries(open_url, url, retries=None, reporter=progress.null):
+    """Returns the result of calling "open_url", which tries to reach the repo
+    at "url".  If that fails with a transient error, it's retried up to
+    "retries" times (defaulting to options.get_repo_retries), with an
+    exponentially increasing wait before each retry."""
+    if retries is None:
+        retries = options.get_repo_retries(url)
+    delay = options.get_repo_retry_delay(url)
+    attempt = 0
+    while True:
+        try: return open_url()
+        except Exception as e:
+            if isinstance(e, urllib2.HTTPError) and e.fp is not None:
+                # Finish the error response off so its connection goes back to
+                # the pool instead of being left open.
+                try: e.read()
+                except Exception: pass
+                e.close()
+            if attempt >= retries or not is_transient_error(e):
+                raise
+            attempt += 1
+            reporter.emit(progress.REPO_RETRYING, attempt=attempt, delay=delay,
+                error=e)
+            time.sleep(delay)
+            delay *= 2
+
+
+def get_feed_path(table):
+    """Gives the path at which the feed of the repo stored in "table" is saved.
+    URLs don't make good filenames, so the file is named by a hash of it."""
+    return os.path.join(options.get_feed_dir(),
+        md5(sanitize_sql(table)).hexdigest() + '.json')
+
+
+def save_feed(fp, table):
+    """Copies the feed read from "fp" to get_feed_path(table), replacing any
+    earlier copy only once the whole feed has arrived.  Returns its path and
+    the hex SHA-1 digest of its contents."""
+    path = get_feed_path(table)
+    part = path + '.part'
+    h = sha1()
+    try:
+        with open(part, 'wb') as dest:
+            for chunk in iter(lambda: fp.read(CHUNK_SIZE), ''):
+                h.update(chunk)
+                dest.write(chunk)
+        os.rename(part, path)
+    except:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return path, h.hexdigest()
+
+
+def update_remote_feed(table, fp, cursor, index_update=None,
+        reporter=progress.null):
+    """Brings the packages of the repo stored as "table" in line with the
+    complete repository feed read from the file-like object "fp".  The feed is
+    loaded into a shadow table as it's parsed, then only the differences are
+    applied to PACKAGES_TABLE.  The repo's packages are never emptied, so
+    readers always see a whole catalog.  If given, index_update is called with
+    the feed's header (everything but its packages) so the repo index can be
+    updated in the same transaction.
+    Everything is committed before returning.  Progress is reported to
+    "reporter".  Returns the number of packages in the feed."""
+    shadow = sanitize_sql(table) + SHADOW_SUFFIX
+    cursor.execute('Drop Table If Exists "%s"' % shadow)
+    create_table(cursor, shadow)
+
+    try:
+        # Parse each package in repo as it arrives.
+        repo = jsonstream.RepoStream(fp)
+        with reporter.phase(progress.FETCH_PHASE):
+            n = update_remote_stream(table, repo.packages(), cursor,
+                commit=True, reporter=reporter, shadow=shadow)
+        with reporter.phase(progress.APPLY_PHASE):
+            apply_shadow_table(cursor, table, shadow)
+        if index_update is not None:
+            index_update(repo.header)
+    except:
+        # Dropping a table commits, so undo any partial changes first.
+        cursor.connection.rollback()
+        cursor.execute('Drop Table If Exists "%s"' % shadow)
+        raise
+    # The changes and index entry must be committed together before the
+    # shadow table is dropped (which would commit them anyways).
+    cursor.connection.commit()
+    cursor.execute('Drop Table "%s"' % shadow)
+    return n
+
+
+def reingest_remote_url(url, cursor):
+    """Rebuilds the packages of the repository at "url" from its saved feed,
+    without using the network.  Feeds are only saved if
+    options.get_keep_feeds() is set; raises RepoError if there isn't one.
+    Returns the number of packages."""
+    table = sanitize_sql(url)
+    path = get_feed_path(table)
+    if not os.path.isfile(path):
+        raise RepoError('No saved feed for %s.' % url)
+    add_repo_index(cursor, table)
+    with open(path, 'rb') as f:
+        return update_remote_feed(table, f, cursor)
+
+
+def update_remote_url(url, cursor, full_update=None, timeout=None,
+        connect_timeout=None, retries=None, reporter=progress.null):
+    """Adds the packages of the repository at "url" to the database.
     full_update may be True (to force an update with the full repository),
     False (to force use of the updates-only URL, if available), or None (to
-    select mode automatically)."""
+    select mode automatically).  timeout and connect_timeout are the number of
+    seconds to wait on the server for data and to connect before giving up;
+    they default to options.get_repo_timeout() and get_repo_connect_timeout().
+    Transient failures to reach the server are retried up to "retries" times
+    (see open_with_retries).  Progress is reported to "reporter".  Returns the
+    number of packages written, or None if the repo couldn't be reached, in
+    which case the failure is recorded in the index."""
+    if timeout is None:
+        timeout = options.get_repo_timeout(url)
+    if connect_timeout is None:
+        connect_timeout = options.get_repo_connect_timeout(url)
+    forced = full_update is True
 
     table = sanitize_sql(url)
-    if table in (LOCAL_TABLE, REPO_INDEX_TABLE):
+    if table in RESERVED_TABLES:
         raise RepoError(
             'Cannot handle a repo named "%s"; name is reserved for internal use.'
             % table)
 
     # Check if repo exists in index and has an updates URL.
-    cursor.execute('''Select etag, last_modified, updates_url, last_update,
-        last_full_update From "%s" Where url=?''' % REPO_INDEX_TABLE, (table,) )
-    result = cursor.fetchone()
-
-    if result is None:
-        # This repo is not yet in the index (it's the first time it's
-        # been checked), so make an empty entry and table for it.
-        cursor.execute('''Insert Into "%s" (url,last_update,last_full_update)
-            Values (?,?,?)''' % REPO_INDEX_TABLE, (table,0,0) )
-        create_table(cursor, table)
-        result = (None, None, None, 0, 0)
-    etag, last_modified, updates_url, last_update, last_full_update = result
+    (etag, last_modified, updates_url, last_update, last_full_update,
+        feed_hash) = add_repo_index(cursor, table)
     # Ensure that the right substring is in updates_url.
     updates_url = updates_url if (isinstance(updates_url, basestring) and
         TIME_SUBSTRING in updates_url) else None
@@ -201,70 +826,99 @@ def update_remote_url(url, cursor, full_update=None):
 
         class NotModifiedHandler(urllib2.BaseHandler):
             def http_error_304(self, req, fp, code, message, headers):
+                # Finish the response off so its connection can be reused.
+                fp.read()
+                fp.close()
                 return 304
 
-        opener = urllib2.build_opener(NotModifiedHandler())
+        opener = httpclient.build_opener(NotModifiedHandler())
+        req.connect_timeout = connect_timeout
         try:
-            url_handle = opener.open(req)
+            url_handle = open_with_retries(
+                lambda: opener.open(req, timeout=timeout), url, retries,
+                reporter)
         except Exception as e:
             warnings.warn("Could not reach repo %s: %s" % (url, repr(e)))
+            record_repo_failure(cursor, url, e)
             return
 
-        # If no error, clear out old table for complete replacement.
-        if url_handle != 304:
-            cursor.execute('Drop Table If Exists "%s"' % table)
-            create_table(cursor, table)
-
-            # Parse JSON.
-            # TODO: Is there any way to gracefully handle a malformed feed?
-            repo = json.load(url_handle)
-
-            # Parse each package in repo.
-            for pkg in repo["packages"]:
-                try: update_remote_package(table, pkg, cursor)
-                except Exception as e:
-                    warnings.warn("Could not process remote package: %s" % repr(e))
+        if url_handle == 304:
+            return 0
 
+        headers = url_handle.info()
+        url_handle = ProgressReader(url_handle, reporter)
+        keep = options.get_keep_feeds()
+        saved = None
+        if keep or not (headers.getheader('ETag') or
+                headers.getheader('Last-Modified')):
+            # Without ETag or Last-Modified there's no conditional get, so the
+            # only way to tell an unchanged feed is by its hash.  That means
+            # downloading it before deciding whether to parse it.
+            saved, digest = save_feed(url_handle, table)
+            if digest == feed_hash and not forced:
+                # Same feed as last time, so the table is already up to date.
+                # That counts as a full update.
+                if not keep:
+                    os.remove(saved)
+                cursor.execute('''Update "%s" Set last_update=?,
+                    last_full_update=? Where url=?''' % REPO_INDEX_TABLE,
+                    (t, t, table) )
+                return 0
+            feed = HashingReader(open(saved, 'rb'))
+        else:
+            feed = HashingReader(url_handle)
+
+        def index_update(repo):
             # Now repo is all updated, let the index know its information.
-            headers = url_handle.info()
             try: name = repo['repository']['name']
             except: name = None
             try: updates_url = repo['repository']['updates']
             except: updates_url = None
-            cursor.execute('''Update "%s" Set name=?, etag=?, last_modified=?,
-                updates_url=?, last_update=?, last_full_update=? Where url=?'''
-                %REPO_INDEX_TABLE, (
+            cursor.execute('''Update "%s" Set name=?, etag=?,
+                last_modified=?, updates_url=?, last_update=?,
+                last_full_update=?, feed_hash=? Where url=?'''
+                % REPO_INDEX_TABLE, (
                     name,
                     headers.getheader('ETag'),
                     headers.getheader('Last-Modified'),
                     updates_url,
                     t, t,
+                    feed.hexdigest(),
                     table) )
 
+        try:
+            return update_remote_feed(table, feed, cursor, index_update,
+                reporter)
+        finally:
+            if saved is not None:
+                feed.fp.close()
+                if not keep:
+                    os.remove(saved)
+
     # Get only changes since the last update.
     else:
         # Open updates URL with time of last update.
-        url = updates_url.replace('%time%', str(last_update))
+        updates_url = updates_url.replace('%time%', str(last_update))
         try:
-            url_handle = urllib2.urlopen(url)
+            url_handle = open_with_retries(lambda: httpclient.urlopen(
+                updates_url, timeout, connect_timeout), url, retries, reporter)
         except Exception as e:
-            warnings.warn("Could not reach update %s: %s" % (url, repr(e)))
+            warnings.warn("Could not reach update %s: %s" % (updates_url,
+                repr(e)))
+            record_repo_failure(cursor, url, e)
             return
 
         t = int(time.time())
-        # Parse JSON.
-        # TODO: Is there any way to gracefully handle a malformed feed?
-        repo = json.load(url_handle)
-
-        # If any packages have been updated, parse them.
-        if repo["packages"] is not None:
-            for pkg in repo["packages"]:
-                try: update_remote_package(table, pkg, cursor)
-                except Exception as e:
-                    warnings.warn("Could not process remote package: %s" % repr(e))
+        # Updates are small, so read them all before writing any, rather than
+        # holding the write lock while waiting on the network.
+        repo = jsonstream.RepoStream(ProgressReader(url_handle, reporter))
+        with reporter.phase(progress.FETCH_PHASE):
+            pkgs = list(repo.packages())
+        with reporter.phase(progress.APPLY_PHASE):
+            n = update_remote_stream(table, pkgs, cursor, reporter=reporter)
+        repo = repo.header
 
         # Now repo is all updated, let the index know its information.
-        headers = url_handle.info()
         try: name = repo['repository']['name']
         except: name = None
         try: updates_url = repo['repository']['updates']
@@ -275,250 +929,757 @@ def update_remote_url(url, cursor, full_update=None):
                 updates_url,
                 t,
                 table) )
+        return n
 
 
-def update_remote():
-    """Adds a table for each repository to the database, adding an entry for each
-    application listed in the repository."""
-    # Open database connection.
-    with sqlite3.connect(options.get_database()) as db:
-        db.row_factory = sqlite3.Row
+def _update_remote_worker(urls, errors, timeout, reporter):
+    """Takes repository URLs off the "urls" queue and updates each in turn until
+    the queue is empty, committing after every repository along with its
+    failure record.  Any exception is stored in the "errors" dictionary, keyed
+    by URL, rather than raised."""
+    with database.transaction() as db:
         c = db.cursor()
-
-        for url in options.get_repos():
+        while True:
+            try: url = urls.get_nowait()
+            except Queue.Empty: break
+            r = reporter.bind(repo=url)
+            r.emit(progress.REPO_STARTED)
+            start = time.time()
+            n = None
             try:
-                update_remote_url(url, c)
+                n = update_remote_url(url, c, timeout=timeout, reporter=r)
+                # Unreachable repos have already recorded their failure.
+                if n is not None:
+                    record_repo_success(c, url)
+                db.commit()
             except Exception as e:
-                warnings.warn("Could not process %s: %s" % (url, repr(e)))
-
+                db.rollback()
+                errors[url] = e
+                record_repo_failure(c, url, e)
+                db.commit()
+            r.emit(progress.REPO_FINISHED, packages=n,
+                elapsed=time.time() - start)
 
 
-def update_local_file(path, db_conn):
-    """Adds an entry to the local database based on the PND found at "path"."""
-    apps = libpnd.pxml_get_by_path(path)
-    if not apps:
-        raise ValueError("%s doesn't seem to be a real PND file." % path)
+def update_remote(threads=None, timeout=None, observer=None,
+        ignore_cooldown=False):
+    """Adds a table for each repository to the database, adding an entry for each
+    application listed in the repository.
+    Up to "threads" repositories are fetched and parsed at once, defaulting to
+    options.get_update_threads(); each repository is written as soon as its
+    own feed is ready.  timeout is passed on to update_remote_url.  If given,
+    "observer" is sent progress.Events as the update goes along.
+    Repositories that failed their last update go after the others, and those
+    in a cool-down period (see record_repo_failure) are skipped with a warning
+    unless ignore_cooldown is True."""
+    reporter = progress.Reporter(observer)
+    with reporter.phase(progress.REMOTE_PHASE):
+        _update_remote(threads, timeout, reporter, ignore_cooldown)
+
+
+def _update_remote(threads, timeout, reporter, ignore_cooldown):
+    repos = options.get_repos()
+    if threads is None:
+        threads = options.get_update_threads()
+
+    # Index new repos up front so the index keeps the configured order no
+    # matter which worker gets to them first.
+    failures = {}
+    with database.transaction() as db:
+        c = db.cursor()
+        for url in repos:
+            table = sanitize_sql(url)
+            if table not in RESERVED_TABLES:
+                add_repo_index(c, table)
+                failures[url] = c.execute("""Select Coalesce(failures, 0),
+                    retry_after From "%s" Where url=?""" % REPO_INDEX_TABLE,
+                    (table,) ).fetchone()
 
+    t = int(time.time())
+    todo = []
+    for url in repos:
+        n, retry_after = failures.get(url, (0, None))
+        if retry_after is not None and retry_after > t and not ignore_cooldown:
+            warnings.warn("Skipping repo %s until %s after %d failed updates."
+                % (url, time.ctime(retry_after), n))
+            reporter.emit(progress.REPO_SKIPPED, repo=url,
+                retry_after=retry_after)
+        else:
+            todo.append(url)
+    # Healthy repos go first so failing ones can't hold them up.  The sort is
+    # stable, so otherwise the configured order is kept.
+    todo.sort(key=lambda url: failures.get(url, (0,))[0])
+
+    urls = Queue.Queue()
+    for url in todo:
+        urls.put(url)
+    errors = {}
+
+    if threads <= 1 or len(todo) <= 1:
+        _update_remote_worker(urls, errors, timeout, reporter)
+    else:
+        workers = [ threading.Thread(target=_update_remote_worker,
+            args=(urls, errors, timeout, reporter))
+            for i in xrange(min(threads, len(todo))) ]
+        for w in workers: w.start()
+        for w in workers: w.join()
+
+    # Report failures in the order the repositories are configured, regardless
+    # of which finished first.
+    for url in repos:
+        if url in errors:
+            warnings.warn("Could not process %s: %s" % (url, repr(errors[url])))
+
+
+
+def stat_key(st):
+    """Gives the parts of the os.stat result "st" that change when a file does,
+    as stored in LOCAL_FILES_TABLE: (size, mtime, inode)."""
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+def find_local_files(searchpath=None):
+    """Yields the path and os.stat result of every PND file in the directories
+    of "searchpath" (a list of paths, which may contain wildcards, defaulting
+    to options.get_searchpath()) and those below them.  Each file is given
+    once, even if the searchpath overlaps itself or links lead to a file more
+    than once.  Symbolic links to PNDs are followed, but not those to
+    directories, so there can be no loops.  Unlike libpnd's discovery, this
+    doesn't read the PNDs, so it's cheap enough to run for every update."""
+    if searchpath is None:
+        searchpath = options.get_searchpath()
+    seen = set() # (st_dev, st_ino) of files and directories already found.
+    for pattern in searchpath:
+        # Work with bytestrings, as libpnd and the local table do.
+        if isinstance(pattern, unicode):
+            pattern = pattern.encode(sys.getfilesystemencoding() or 'utf-8')
+        dirs = sorted(glob.glob(pattern), reverse=True)
+        while dirs:
+            d = dirs.pop()
+            try:
+                st = os.stat(d)
+                if not stat.S_ISDIR(st.st_mode) or (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                names = sorted(os.listdir(d))
+            except OSError as e:
+                # Searchpaths commonly name directories that don't exist.
+                if e.errno != errno.ENOENT:
+                    warnings.warn("Could not search %s: %s" % (d, repr(e)))
+                continue
+
+            subdirs = []
+            for name in names:
+                path = os.path.join(d, name)
+                try:
+                    st = os.lstat(path)
+                    if stat.S_ISDIR(st.st_mode):
+                        subdirs.append(path)
+                        continue
+                    if not name.lower().endswith(PND_EXT):
+                        continue
+                    if stat.S_ISLNK(st.st_mode):
+                        st = os.stat(path)
+                except OSError:
+                    # Vanished since listing, or a broken link.
+                    continue
+                if (stat.S_ISREG(st.st_mode) and
+                        (st.st_dev, st.st_ino) not in seen):
+                    seen.add((st.st_dev, st.st_ino))
+                    yield path, st
+            # Search subdirectories next, in order.
+            dirs.extend(reversed(subdirs))
+
+
+def update_local_file(path, db_conn, st=None):
+    """Adds an entry to the local database based on the PND found at "path",
+    and records the file's stat information so later incremental updates can
+    tell if it has changed.  "st" may be given if the file has already been
+    stat'ed.  Returns the package's id."""
+    if st is None:
+        st = os.stat(path)
+    row, icon = read_local_file(path, st,
+        get_cached_md5(db_conn, path, stat_key(st)) or hash_file(path))
+    write_local_files(db_conn, [(path, stat_key(st), row, icon)])
+    return row[0]
+
+
+def write_local_files(db_conn, entries):
+    """Writes entries for PND files to the local table and its stat cache, in
+    the given order.  "entries" is a sequence of (path, stat_key, row, icon)
+    tuples, where row and icon are as given by read_local_file.  Each row's MD5
+    sum and icon are cached along with the stat information.  Paths and
+    libpnd's output are bytestrings, so db_conn should come from
+    database.transaction(database.BYTES)."""
+    old_icons = _get_local_icons(db_conn, [ e[0] for e in entries ])
+    db_conn.executemany(insert_sql(LOCAL_TABLE),
+        (row for path, key, row, icon in entries))
+    write_package_index(db_conn, LOCAL_TABLE,
+        ( package_index_values(row) for path, key, row, icon in entries ))
+    # If a file used to hold a different package, that one's gone now.
+    gone = []
+    for path, key, row, icon in entries:
+        gone.extend( i[0] for i in db_conn.execute('Select id From "%s" '
+            'Where uri=? And id!=?' % LOCAL_TABLE, (path, row[0])) )
+    db_conn.executemany('Delete From "%s" Where uri=? And id!=?' % LOCAL_TABLE,
+        ((path, row[0]) for path, key, row, icon in entries))
+    update_package_index(db_conn, LOCAL_TABLE, gone)
+    # An empty icon marks PNDs found to have none, as opposed to those cached
+    # before icons were.
+    db_conn.executemany('Insert Or Replace Into "%s" Values (?,?,?,?,?,?,?)'
+        % LOCAL_FILES_TABLE, ((path,) + tuple(key) + (row[0], row[7],
+        icon or '') for path, key, row, icon in entries))
+    _discard_local_icons(db_conn, old_icons)
+
+
+def _get_local_icons(db_conn, paths):
+    icons = set()
+    for path in paths:
+        icons.update(i[0] for i in db_conn.execute(
+            """Select icon From "%s" Where path=? And icon!=''"""
+            % LOCAL_FILES_TABLE, (path,)))
+    return icons
+
+
+def _discard_local_icons(db_conn, icons):
+    """Removes the cached icons among "icons" that no PND has any more."""
+    images.discard([ i for i in icons if db_conn.execute(
+        'Select 1 From "%s" Where icon=?' % LOCAL_FILES_TABLE,
+        (i,)).fetchone() is None ], images.LOCAL_DIR)
+
+
+def get_cached_md5(db_conn, path, key):
+    """Gives the MD5 sum cached for the PND file at "path", or None if there is
+    none or the file has changed since (that is, its stat_key is not "key")."""
+    c = db_conn.execute('Select size, mtime, inode, md5 From "%s" Where path=?'
+        % LOCAL_FILES_TABLE, (path,)).fetchone()
+    if c is not None and tuple(c)[:3] == tuple(key):
+        return c[3]
+
+
+def hash_file(path):
+    """Gives the hex MD5 sum of the file at "path", read a chunk at a time."""
     m = md5()
-    #with open(path, 'rb') as p:
-    #    for chunk in iter(lambda: p.read(128*m.block_size), ''):
-    #        m.update(chunk)
+    with open(path, 'rb') as p:
+        for chunk in iter(lambda: p.read(HASH_CHUNK_SIZE), ''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+@contextmanager
+def open_pnd(path):
+    """Finds the PXML and icon of the PND at "path", giving them as a (pxml,
+    icon) tuple for use in a with block.  A PND is a filesystem image with the
+    PXML and icon appended, so the file is memory-mapped and searched backward
+    from the end; the PXML and icon are given as read-only buffers into the
+    mapping, so they're never copied and the image is never read.  The file is
+    closed and unmapped when the block exits, after which the buffers can't be
+    used.  If this fails, libpnd's search from the start of the file is tried
+    instead, giving the PXML as a string.  The icon is None if there isn't one,
+    or libpnd had to be used.  Raises PNDError if there's no PXML."""
+    try:
+        f = open(path, 'rb')
+    except EnvironmentError:
+        mm = None
+    else:
+        # An empty file can't be mapped, and doesn't have a PXML anyway.
+        try: mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError): mm = None
+        finally: f.close()
 
-    # Extract all the useful information from the PND and add it to the table.
-    # NOTE: libpnd doesn't yet have functions to look at the package element of
-    # a PND.  Instead, extract the PXML and parse that element manually.
+    if mm is not None:
+        try:
+            end = mm.rfind(PXML_END)
+            start = -1
+            if end >= 0:
+                end += len(PXML_END)
+                start = mm.rfind(PXML_START, max(0, end - libpnd.PXML_MAXLEN),
+                    end)
+            if start >= 0:
+                # The icon is whatever follows, often after a line break.
+                icon_start = _ICON_GAP.match(mm, end).end()
+                yield (buffer(mm, start, end - start),
+                    buffer(mm, icon_start) if icon_start < len(mm) else None)
+                return
+        finally:
+            mm.close()
+    yield accrue_pxml(path), None
+
+
+@contextmanager
+def open_pxml(path):
+    """Like open_pnd, but gives only the PXML."""
+    with open_pnd(path) as (pxml, icon):
+        yield pxml
+
+
+def accrue_pxml(path):
+    """Gives the PXML of the PND at "path" as found by libpnd, which searches
+    forward from the start of the file.  Raises PNDError if there's no PXML."""
     pxml_buffer = ctypes.create_string_buffer(libpnd.PXML_MAXLEN)
     f = libpnd.libc.fopen(path, 'r')
-    if not libpnd.pnd_seek_pxml(f):
-        raise PNDError('PND file has no starting PXML tag.')
-    if not libpnd.pnd_accrue_pxml(f, pxml_buffer, libpnd.PXML_MAXLEN):
-        raise PNDError('PND file has no ending PXML tag.')
-
-    try:
-        # Strip extra trailing characters from the icon.  Remove them!
-        end_tag = pxml_buffer.value.rindex('>')
-        pxml = etree.XML(pxml_buffer.value[:end_tag+1])
-        # Search for package element.
-        pkg = pxml.find(xml_child('package'))
-    except: pass
-
-    # May need to fall back on first app element, assuming it's representative
-    # of the package as a whole.
-    app = apps[0]
-
-    try:
-        pkgid = pkg.attrib['id']
-    except:
-        pkgid = libpnd.pxml_get_unique_id(app)
-
-    try:
-        v = pkg.find(xml_child('version'))
-        # TODO: Add support for 'type' attribute.
-        # NOTE: Using attrib instead of get will be fragile on non standards-
-        # compliant PNDs.
-        version = '.'.join( (
-            v.attrib['major'],
-            v.attrib['minor'],
-            v.attrib['release'],
-            v.attrib['build'], ) )
-    except:
-        version = '.'.join( (
-            str(libpnd.pxml_get_version_major(app)),
-            str(libpnd.pxml_get_version_minor(app)),
-            str(libpnd.pxml_get_version_release(app)),
-            str(libpnd.pxml_get_version_build(app)), ) )
-
+    if not f:
+        raise PNDError('Could not open PND file.')
     try:
-        author = pkg.find(xml_child('author'))
-        author_name = author.get('name')
-        author_website = author.get('website')
-        author_email = author.get('email')
-    except:
-        author_name = libpnd.pxml_get_author_name(app)
-        author_website = libpnd.pxml_get_author_website(app)
-        author_email = None # NOTE: libpnd has no pxml_get_author_email?
-
+        if not libpnd.pnd_seek_pxml(f):
+            raise PNDError('PND file has no starting PXML tag.')
+        if not libpnd.pnd_accrue_pxml(f, pxml_buffer, libpnd.PXML_MAXLEN):
+            raise PNDError('PND file has no ending PXML tag.')
+    finally:
+        libpnd.libc.fclose(f)
+    # Strip extra trailing characters from the icon.  Remove them!
+    end_tag = pxml_buffer.value.rindex('>')
+    return pxml_buffer.value[:end_tag+1]
+
+
+def read_local_file(path, st, digest=None):
+    """Reads the PND at "path", whose os.stat result is "st".  Returns the
+    tuple of column values for its entry in the local table, with "digest" as
+    its MD5 sum, and the digest of its icon, which is stored in the images
+    module's cache, or None if it has no icon.  Raises PNDError if the PND has
+    no PXML.  This doesn't touch the database, so it can be run in any thread or
+    process."""
+    icon = None
     try:
-        # Get title and description in the most preferred language available.
-        titles = {}
-        for t in pkg.find(xml_child('titles')):
-            titles[t.attrib['lang']] = t.text
-        for l in options.get_locale():
-            try:
-                title = titles[l]
-                break
-            except KeyError: pass
-        title # Trigger NameError if it's not yet set.
-    except:
-        title = libpnd.pxml_get_app_name(app, options.get_locale()[0])
-
+        with open_pnd(path) as (pxml, icon_data):
+            info = parse_pxml(pxml)
+            if icon_data is not None:
+                icon = images.store(icon_data, images.LOCAL_DIR)
+    except (SyntaxError, PXMLError):
+        # libpnd is more forgiving of malformed PXML, but can't give as much.
+        # A PND with no PXML at all (PNDError) is left to fail, since libpnd
+        # has already been asked to find one.
+        info = read_pxml_libpnd(path)
+
+    row = ( info['id'],
+        path,
+        info['version'],
+        info['title'],
+        info['description'],
+        None, # Likely no use for "info" on installed packages.
+        st.st_size,
+        digest,
+        int(st.st_mtime),
+        None, # No use for "rating" either.
+        info['author_name'],
+        info['author_website'],
+        info['author_email'],
+        None, # No use for "vendor" either.
+        info['icon'],
+        info['previewpics'],
+        info['licenses'],
+        info['source'],
+        info['categories'],
+        info['applications'],
+        None,
+        version_key(info['version']) )
+    return row, icon
+
+
+def _join(items):
+    "Combines a list into one database field, or None if it's empty."
+    return SEPCHAR.join(items) if items else None
+
+
+def _localized(element, tag, locales):
+    """Gives the stripped text of the child of "element" with the given tag in
+    the most preferred language available, or in the first language if none of
+    "locales" is.  Such children may also be grouped in a plural tag (like
+    titles), as newer PXMLs do."""
+    texts = {}
+    first = None
+    for e in (element.findall(xml_child(tag)) +
+            element.findall('%s/%s' % (xml_child(tag + 's'), xml_child(tag)))):
+        text = (e.text or '').strip()
+        texts.setdefault(e.get('lang'), text)
+        if first is None: first = text
+    for l in locales:
+        if l in texts:
+            return texts[l]
+    return first
+
+
+def _repair_pxml(data):
+    """Fixes the most common ways PXMLs are malformed: unescaped ampersands and
+    text that isn't UTF-8."""
+    data = str(data).decode('utf-8', 'replace').encode('utf-8')
+    return re.sub(r'&(?!#?\w+;)', '&amp;', data)
+
+
+def parse_pxml(pxml, locales=None):
+    """Extracts everything the local table needs from the text of a PXML, in
+    one pass over its elements.  Returns a dictionary keyed by column name.
+    Fields of the package element are used where it has them, otherwise those
+    of the first application.  Lists (like applications and categories) combine
+    those of all applications.  "locales" is the list of preferred languages,
+    defaulting to options.get_locale().  Raises SyntaxError if the PXML can't
+    be parsed even after repairs, or PXMLError if it has no applications."""
+    if locales is None:
+        locales = options.get_locale()
     try:
-        descs = {}
-        for d in pkg.find(xml_child('descriptions')):
-            descs[d.attrib['lang']] = d.text
-        for l in options.get_locale():
-            try:
-                description = descs[l]
-                break
-            except KeyError: pass
-        description # Trigger NameError if it's not yet set.
-    except:
-        description = libpnd.pxml_get_description(app, options.get_locale()[0])
+        parser = etree.XMLParser()
+        parser.feed(pxml)
+        root = parser.close()
+    except SyntaxError:
+        parser = etree.XMLParser()
+        parser.feed(_repair_pxml(pxml))
+        root = parser.close()
+
+    apps = root.findall(xml_child('application'))
+    if not apps:
+        raise PXMLError('PXML has no applications.')
+    # Package-wide fields come from the package element if it has them, or
+    # else from the first application, assuming it's representative.
+    mains = [ e for e in (root.find(xml_child('package')), apps[0])
+        if e is not None ]
+    def find(tag):
+        for e in mains:
+            found = e.find(xml_child(tag))
+            if found is not None: return found
+        return {}
+    def localized(tag):
+        for e in mains:
+            text = _localized(e, tag, locales)
+            if text is not None: return text
+
+    pkgid = next((e.get('id') for e in mains if e.get('id')), None)
+    v = find('version')
+    # TODO: Add support for 'type' attribute.
+    version = '.'.join( v.get(i, '0')
+        for i in ('major', 'minor', 'release', 'build') )
+    author = find('author')
 
-    try:
-        icon = pkg.find(xml_child('icon')).get('src')
-    except:
-        icon = libpnd.pxml_get_icon(app)
+    previewpics = []
+    licenses = []
+    sources = []
+    categories = []
+    for app in apps:
+        previewpics.extend( p.get('src') for p in
+            app.findall('%s/%s' % (xml_child('previewpics'), xml_child('pic'))) )
+        for l in app.findall('%s/%s' % (xml_child('licenses'),
+                xml_child('license'))):
+            licenses.append(l.get('name'))
+            s = l.get('sourcecodeurl')
+            if s and s not in sources:
+                sources.append(s)
+        for c in app.findall('%s/%s' % (xml_child('categories'),
+                xml_child('category'))):
+            categories.append(c.get('name'))
+            categories.extend( s.get('name') for s in
+                c.findall(xml_child('subcategory')) )
+
+    return {
+        'id': pkgid,
+        'version': version,
+        'title': localized('title'),
+        'description': localized('description'),
+        'author_name': author.get('name'),
+        'author_website': author.get('website'),
+        'author_email': author.get('email'),
+        'icon': find('icon').get('src'),
+        'previewpics': _join(filter(None, previewpics)),
+        'licenses': _join(filter(None, licenses)),
+        'source': _join(sources),
+        'categories': _join(filter(None, categories)),
+        'applications': _join([ a.get('id') for a in apps ]),
+    }
+
+
+def read_pxml_libpnd(path):
+    """Like parse_pxml, but has libpnd read the PXML of the PND at "path".
+    libpnd copes with some PXMLs that ElementTree can't, but it knows nothing
+    of package elements, licenses or sources, and gives at most two
+    previewpics and two categories per application."""
+    apps = libpnd.pxml_get_by_path(path)
+    if not apps:
+        raise ValueError("%s doesn't seem to be a real PND file." % path)
 
     # Find out how many apps are in the PXML, so we can iterate over them.
     n_apps = 0
     for i in apps:
         if i is None: break
         n_apps += 1
-
-    # Create the full list of contained applications.
-    applications = SEPCHAR.join([ libpnd.pxml_get_unique_id( apps[i] )
-        for i in xrange(n_apps) ])
-
-    # Get all previewpics.  libpnd only supports two per application.
-    previewpics = []
-    for i in xrange(n_apps):
-        p = libpnd.pxml_get_previewpic1( apps[i] )
-        if p is not None: previewpics.append(p)
-        p = libpnd.pxml_get_previewpic2( apps[i] )
-        if p is not None: previewpics.append(p)
-    if previewpics:
-        previewpics = SEPCHAR.join(previewpics)
-    else: previewpics = None
-
-    # TODO: Get licenses and source urls once libpnd has that functionality.
+    # Assume the first app is representative of the package as a whole.
+    app = apps[0]
 
     # Combine all categories in all apps.  libpnd supports two categories, each
     # with two subcategories in each app.  No effort is made to uniquify the
     # completed list.
+    previewpics = []
     categories = []
     for i in xrange(n_apps):
-        c = libpnd.pxml_get_main_category( apps[i] )
-        if c is not None: categories.append(c)
-        c = libpnd.pxml_get_subcategory1( apps[i] )
-        if c is not None: categories.append(c)
-        c = libpnd.pxml_get_subcategory2( apps[i] )
-        if c is not None: categories.append(c)
-        c = libpnd.pxml_get_altcategory( apps[i] )
-        if c is not None: categories.append(c)
-        c = libpnd.pxml_get_altsubcategory1( apps[i] )
-        if c is not None: categories.append(c)
-        c = libpnd.pxml_get_altsubcategory2( apps[i] )
-        if c is not None: categories.append(c)
-    if categories:
-        categories = SEPCHAR.join(categories)
-    else: categories = None
-
-    # Output from libpnd gives encoded bytestrings, not Unicode strings.
-    db_conn.text_factory = str
-    db_conn.execute("""Insert Or Replace Into "%s" Values
-        (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""" % LOCAL_TABLE,
-        ( pkgid,
-        path,
-        version,
-        title,
-        description,
-        None, # Likely no use for "info" on installed packages.
-        None, # TODO: size field
-        m.hexdigest(), # TODO: Just None?
-        None, # TODO: modified_time field?
-        None, # No use for "rating" either.
-        author_name,
-        author_website,
-        author_email,
-        None, # No use for "vendor" either.
-        icon,
-        previewpics,
-        None, # TODO: Licenses once libpnd can pull them.
-        None, # TODO: Sources once libpnd can pull them.
-        categories,
-        applications,
-        None ) )
+        for get in (libpnd.pxml_get_previewpic1, libpnd.pxml_get_previewpic2):
+            p = get(apps[i])
+            if p is not None: previewpics.append(p)
+        for get in (libpnd.pxml_get_main_category,
+                libpnd.pxml_get_subcategory1, libpnd.pxml_get_subcategory2,
+                libpnd.pxml_get_altcategory, libpnd.pxml_get_altsubcategory1,
+                libpnd.pxml_get_altsubcategory2):
+            c = get(apps[i])
+            if c is not None: categories.append(c)
+
+    info = {
+        'id': libpnd.pxml_get_unique_id(app),
+        'version': '.'.join( (
+            str(libpnd.pxml_get_version_major(app)),
+            str(libpnd.pxml_get_version_minor(app)),
+            str(libpnd.pxml_get_version_release(app)),
+            str(libpnd.pxml_get_version_build(app)), ) ),
+        'title': libpnd.pxml_get_app_name(app, options.get_locale()[0]),
+        'description': libpnd.pxml_get_description(app,
+            options.get_locale()[0]),
+        'author_name': libpnd.pxml_get_author_name(app),
+        'author_website': libpnd.pxml_get_author_website(app),
+        'author_email': None, # NOTE: libpnd has no pxml_get_author_email?
+        'icon': libpnd.pxml_get_icon(app),
+        'previewpics': _join(previewpics),
+        'licenses': None,
+        'source': None,
+        'categories': _join(categories),
+        'applications': _join([ libpnd.pxml_get_unique_id(apps[i])
+            for i in xrange(n_apps) ]),
+    }
 
     # Clean up the pxml handle.
     for i in xrange(n_apps):
         libpnd.pxml_delete(apps[i])
+    return info
 
 
+def _read_local_file_worker(path):
+    """Reads one PND for _read_local_files, in a worker process.  Exceptions
+    can't always be pickled, so they're given as their repr."""
+    try:
+        st = os.stat(path)
+        row, icon = read_local_file(path, st)
+        return path, stat_key(st), row, icon, None
+    except Exception as e:
+        return path, None, None, None, repr(e)
+
+
+def _read_local_files(paths, processes):
+    """Reads each PND in "paths", yielding the results of
+    _read_local_file_worker in the same order.  Uses a pool of "processes"
+    worker processes if that's more than one."""
+    if processes <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield _read_local_file_worker(path)
+        return
+
+    pool = multiprocessing.Pool(min(processes, len(paths)))
+    try:
+        # Hand out several PNDs at a time to cut down on messages between
+        # processes, but not so many that progress becomes jumpy.
+        chunksize = max(1, min(16, len(paths) // (4 * processes)))
+        for result in pool.imap(_read_local_file_worker, paths, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
 
-def update_local():
-    """Adds a table to the database, adding an entry for each application found
-    in the searchpath."""
-    # Open database connection.
-    with sqlite3.connect(options.get_database()) as db:
-        db.row_factory = sqlite3.Row
-        # Create table from scratch to hold list of all installed PNDs.
-        # Drops it first so no old entries get left behind.
-        # TODO: Yes, there are probably more efficient ways than dropping
-        # the whole thing, whatever, I'll get to it.
-        db.execute('Drop Table If Exists "%s"' % LOCAL_TABLE)
-        create_table(db, LOCAL_TABLE)
-
-        # Find PND files on searchpath.
-        searchpath = ':'.join(options.get_searchpath())
-        search = libpnd.disco_search(searchpath, None)
-        if not search:
-            raise ValueError("Your install of libpnd isn't behaving right!  pnd_disco_search has returned null.")
-
-        # If at least one PND is found, add each to the database.
-        # Note that disco_search returns the path to each *application*.  PNDs with
-        # multiple apps will therefore be returned multiple times.  Process any
-        # such PNDs only once.
-        n = libpnd.box_get_size(search)
-        done = set()
-        if n > 0:
-            node = libpnd.box_get_head(search)
-            path = libpnd.box_get_key(node)
-            try: update_local_file(path, db)
-            except Exception as e:
-                warnings.warn("Could not process %s: %s" % (path, repr(e)))
-            done.add(path)
-            for i in xrange(n-1):
-                node = libpnd.box_get_next(node)
-                path = libpnd.box_get_key(node)
-                if path not in done:
-                    try: update_local_file(path, db)
-                    except Exception as e:
-                        warnings.warn("Could not process %s: %s" % (path, repr(e)))
-                    done.add(path)
-        db.commit()
+def _hash_local_file(args):
+    """Gives the stat_key and MD5 sum of one PND for _hash_local_files, reusing
+    the cached sum if the file hasn't changed.  Gives None for the sum if the
+    file can't be read; reading its PXML will fail too, and say why."""
+    path, cached = args
+    try:
+        key = stat_key(os.stat(path))
+        if cached is not None and cached[0] == key and cached[1]:
+            return key, cached[1]
+        return key, hash_file(path)
+    except EnvironmentError:
+        return None, None
+
+
+def _hash_local_files(paths, cached, threads):
+    """Yields the stat_key and MD5 sum of each PND in "paths", in order.
+    "cached" maps paths to the (stat_key, md5) last stored for them, which is
+    reused for unchanged files.  The rest are hashed by "threads" background
+    threads, which work ahead of the caller, so hashing overlaps with whatever
+    the caller does between taking results."""
+    if not paths:
+        return
+    pool = ThreadPool(min(threads, len(paths)))
+    try:
+        for result in pool.imap(_hash_local_file,
+                ((p, cached.get(p)) for p in paths)):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+
+def scan_local_files(paths, cached, processes=1):
+    """Reads and hashes each PND in "paths", yielding (path, stat_key, row,
+    icon, error) tuples in the same order, where row and icon are as given by
+    read_local_file and error is None or the repr of what went wrong.  "cached"
+    maps paths to the (stat_key, md5) last stored for them, which is reused for
+    unchanged files.  Reading is done by up to "processes" worker processes,
+    hashing by options.get_hash_threads() threads.  This doesn't touch the
+    database, so nothing is locked while the PNDs are read."""
+    # izip takes from the reader first, so any worker processes are forked
+    # before the hashing threads start.
+    hashes = _hash_local_files(paths, cached, options.get_hash_threads())
+    for (path, key, row, icon, error), (hash_key, digest) in izip(
+            _read_local_files(paths, processes), hashes):
+        if error is None:
+            # If the file changed between being hashed and read, leave its sum
+            # out so the next update will read it again.
+            if hash_key != key:
+                digest = None
+            # MD5 is the eighth column.
+            row = row[:7] + (digest,) + row[8:]
+        yield path, key, row, icon, error
+
+
+
+def update_local(observer=None, full=False, processes=None):
+    """Brings the local table in line with the PNDs found in the searchpath.
+    Only PNDs that are new or have changed (by size, modification time or
+    inode) since the last update are read; entries of PNDs that have vanished
+    are deleted.  If "full" is True, the table is instead rebuilt from scratch
+    by reading every PND, though MD5 sums of unchanged files are still
+    reused.  If given, "observer" is sent progress.Events as the update goes
+    along.
+    PNDs are read by up to "processes" worker processes at once, defaulting to
+    options.get_scan_processes(), while this process alone writes what they
+    find to the database, "BATCH_SIZE" PNDs at a time.  Each batch is written in
+    its own short transaction, so the database isn't locked while PNDs are
+    read.  The results are the same however many processes are used.
+    Meanwhile, options.get_hash_threads() background threads compute the MD5
+    sums of the PNDs being read."""
+    if processes is None:
+        processes = options.get_scan_processes()
+    reporter = progress.Reporter(observer)
+    with reporter.phase(progress.LOCAL_PHASE):
+        _update_local(reporter, full, processes)
+
+
+def forget_local_files(db_conn, paths):
+    """Deletes the entries and stat information of the PND files at "paths".
+    Returns the ids of the packages whose entries were deleted."""
+    icons = _get_local_icons(db_conn, paths)
+    ids = set()
+    for path in paths:
+        ids.update(i[0] for i in db_conn.execute(
+            'Select id From "%s" Where uri=?' % LOCAL_TABLE, (path,)))
+    db_conn.executemany('Delete From "%s" Where uri=?' % LOCAL_TABLE,
+        ((p,) for p in paths))
+    update_package_index(db_conn, LOCAL_TABLE, ids)
+    db_conn.executemany('Delete From "%s" Where path=?' % LOCAL_FILES_TABLE,
+        ((p,) for p in paths))
+    _discard_local_icons(db_conn, icons)
+    return ids
+
+
+def _update_local(reporter, full, processes):
+    with reporter.phase(progress.SEARCH_PHASE):
+        # Find PND files on searchpath.  Their stat results are kept to
+        # compare with the cache, so nothing is read from unchanged files.
+        found = list(find_local_files())
+        paths = [ path for path, st in found ]
+        stats = dict(found)
+
+    def write(entries, gone=()):
+        # The database is only held while writing, never while PNDs are read.
+        # Paths are bytestrings, so keep them that way.
+        with database.transaction(database.BYTES) as db:
+            write_local_files(db, entries)
+            forget_local_files(db, gone)
+
+    with reporter.phase(progress.SCAN_PHASE):
+        with database.transaction(database.BYTES) as db:
+            if full:
+                # Start from scratch so no old entries get left behind.
+                db.execute('Drop Table If Exists "%s"' % LOCAL_TABLE)
+                create_table(db, LOCAL_TABLE)
+                rebuild_package_index(db, LOCAL_TABLE)
+            cached = dict( (i[0], tuple(i)[1:]) for i in db.execute(
+                'Select path, size, mtime, inode, id, md5, icon From "%s"'
+                % LOCAL_FILES_TABLE) )
+            forget_local_files(db, [ p for p in cached if p not in stats ])
+            # Deleting one PND's entry may have uncovered another with the same
+            # id, so only trust the cache for packages still in the table.
+            ids = set( i[0] for i in
+                db.execute('Select id From "%s"' % LOCAL_TABLE) )
+
+        # Find which PNDs are new or changed.  Those without an MD5 sum or
+        # icon (as left by older versions) are read again to get them.
+        todo = []
+        scanned = 0
+        for path in paths:
+            c = cached.get(path)
+            if (full or c is None or c[:3] != stat_key(stats[path]) or
+                    c[3] not in ids or not c[4] or c[5] is None):
+                todo.append(path)
+                continue
+            scanned += 1
+            reporter.emit(progress.PND_SCANNED, path=path, count=scanned,
+                total=len(paths), changed=False)
+
+        # Read and hash them, and add them to the database in the order they
+        # were found, just as if they'd been read one by one.
+        batch = []
+        for path, key, row, icon, error in scan_local_files(todo, dict(
+                (p, (c[:3], c[4])) for p, c in cached.iteritems() ),
+                processes):
+            if error is None:
+                batch.append((path, key, row, icon))
+            else:
+                warnings.warn("Could not process %s: %s" % (path, error))
+                # Don't keep what the file used to hold.
+                write(batch, [path])
+                batch = []
+            if len(batch) >= BATCH_SIZE:
+                write(batch)
+                batch = []
+            scanned += 1
+            reporter.emit(progress.PND_SCANNED, path=path, count=scanned,
+                total=len(paths), changed=True)
+        write(batch)
 
 
 
 # On import, this will execute, ensuring that necessary tables are created and
 # can be depended upon to exist in later code.
-with sqlite3.connect(options.get_database()) as db:
+with database.transaction() as db:
     # Index for all repositories to track important info.
     db.execute("""Create Table If Not Exists "%s" (
         url Text Primary Key, name Text, etag Text, last_modified Text,
-        updates_url Text, last_update Text, last_full_update Text
+        updates_url Text, last_update Text, last_full_update Text,
+        feed_hash Text, failures Int, last_error Text, last_failure Int,
+        retry_after Int
         )""" % REPO_INDEX_TABLE)
+    add_columns(db, REPO_INDEX_TABLE, [('feed_hash', 'Text'),
+        ('failures', 'Int'), ('last_error', 'Text'), ('last_failure', 'Int'),
+        ('retry_after', 'Int')])
     # Table of installed PNDs.
     create_table(db, LOCAL_TABLE)
+    add_columns(db, LOCAL_TABLE, [('version_key', 'Text')])
+    create_packages_table(db)
+    index_created = create_index_tables(db)
+    migrate_repo_tables(db)
+    fill_version_keys(db, LOCAL_TABLE)
+    fill_version_keys(db, PACKAGES_TABLE)
+    # Index the packages written before the index existed.
+    if index_created:
+        rebuild_package_index(db)
+    db.execute("""Create Table If Not Exists "%s" (
+        path Text Primary Key, size Int, mtime Real, inode Int, id Text,
+        md5 Text, icon Text
+        )""" % LOCAL_FILES_TABLE)
+    add_columns(db, LOCAL_FILES_TABLE, [('md5', 'Text'), ('icon', 'Text')])
+    # Index of the images module's downloads.
+    db.execute("""Create Table If Not Exists "%s" (
+        url Text Primary Key, hash Text, size Int, last_used Real
+        )""" % images.REMOTE_IMAGES_TABLE)
 
     db.commit()
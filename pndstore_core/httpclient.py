@@ -0,0 +1,373 @@
+"""
+This module provides the HTTP plumbing shared by database_update and packages.
+Its openers ask servers for gzip or deflate compressed responses and decompress
+them as they are read, so callers can treat every response as plain data.
+Repository feeds are highly compressible text, so this saves a lot of transfer
+on slow connections.
+
+Openers also keep HTTP connections alive between requests.  Once a response
+has been read to the end, its connection goes back into a pool shared by every
+opener in the process, ready for the next request to the same host.  Mass
+upgrades from one repo therefore only pay for TCP setup and DNS lookups once.
+get_stats shows how often connections have been reused.
+
+Requests may be given a separate timeout for connecting, so that a dead server
+is given up on quickly while a slow one still has time to send its response.
+
+Concurrency note: the pool is locked, and a connection is only ever used by
+whichever thread took it out of the pool, so openers are safe to use from
+multiple threads at once.
+"""
+
+import urllib2, httplib, socket, threading, zlib
+
+# Bytes to read from the network at a time when decompressing.
+CHUNK_SIZE = 16 * 1024
+
+ACCEPT_ENCODING = 'gzip, deflate'
+# Most idle connections to keep open to any one host.
+MAX_IDLE_PER_HOST = 4
+
+
+class DecompressedFile(object):
+    """Wraps the file-like object "fp", whose contents are compressed with the
+    given Content-Encoding (gzip or deflate), decompressing them as they're
+    read.  Only as much is decompressed as is needed to satisfy each read, so
+    memory use stays bounded regardless of the compression ratio."""
+
+    def __init__(self, fp, encoding, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self._gzip = encoding in ('gzip', 'x-gzip')
+        # Adding 16 to wbits makes zlib expect a gzip header and trailer.
+        self._z = zlib.decompressobj(
+            16 + zlib.MAX_WBITS if self._gzip else zlib.MAX_WBITS)
+        self._started = False
+        self._buf = ''
+        self._eof = False
+
+
+    def _decompress(self, data):
+        try:
+            out = self._z.decompress(data, self.chunk_size)
+        except zlib.error:
+            # Many servers send deflate as a raw stream without the zlib header
+            # the spec calls for.  That can only be detected at the start.
+            if self._gzip or self._started:
+                raise
+            self._z = zlib.decompressobj(-zlib.MAX_WBITS)
+            out = self._z.decompress(data, self.chunk_size)
+        self._started = True
+        return out
+
+
+    def _fill(self):
+        """Decompresses another piece of the data into the buffer."""
+        data = self._z.unconsumed_tail
+        if not data:
+            data = self.fp.read(self.chunk_size)
+        if not data:
+            self._buf += self._z.flush()
+            self._eof = True
+        else:
+            self._buf += self._decompress(data)
+
+
+    def _take(self, size):
+        if size < 0:
+            size = len(self._buf)
+        out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            self._fill()
+        return self._take(size)
+
+
+    def readline(self, size=-1):
+        while (not self._eof and '\n' not in self._buf and
+                (size < 0 or len(self._buf) < size)):
+            self._fill()
+        n = self._buf.find('\n') + 1
+        if n and (size < 0 or n < size):
+            size = n
+        return self._take(size)
+
+
+    def close(self):
+        self.fp.close()
+
+
+
+class DecompressionHandler(urllib2.BaseHandler):
+    """Adds an Accept-Encoding header to outgoing requests and transparently
+    decompresses responses that use it.  Response headers are left as sent, so
+    ETag and Last-Modified still work for conditional requests."""
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-encoding', ACCEPT_ENCODING)
+        return req
+
+
+    def http_response(self, req, response):
+        encoding = response.info().getheader('Content-Encoding', '')
+        encoding = encoding.strip().lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            old = response
+            response = urllib2.addinfourl(DecompressedFile(old, encoding),
+                old.info(), old.geturl(), old.code)
+            response.msg = old.msg
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+
+
+class ConnectionPool(object):
+    """Holds idle HTTP connections, keyed by scheme and host, so that they can
+    be reused by later requests.  The stats dictionary counts the requests
+    made, connections opened, and connections reused."""
+
+    def __init__(self, max_idle=MAX_IDLE_PER_HOST):
+        self.max_idle = max_idle
+        self.stats = {'requests':0, 'opened':0, 'reused':0}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, key, connect):
+        """Takes an idle connection for "key" out of the pool, or makes a new
+        one by calling "connect" if there are none.  Returns the connection and
+        whether or not it was reused."""
+        with self._lock:
+            self.stats['requests'] += 1
+            conns = self._idle.get(key)
+            if conns:
+                self.stats['reused'] += 1
+                return conns.pop(), True
+            self.stats['opened'] += 1
+        return connect(), False
+
+
+    def put(self, key, conn):
+        """Returns a connection whose last response has been fully read."""
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+
+# The pool shared by all openers from this module.
+pool = ConnectionPool()
+
+
+def get_stats():
+    """Returns a copy of the shared pool's request, connection and reuse counts."""
+    with pool._lock:
+        return dict(pool.stats)
+
+
+
+def _settimeout(sock, timeout):
+    sock.settimeout(socket.getdefaulttimeout()
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+
+
+class _ConnectTimeoutMixin(object):
+    """Lets an httplib connection use "connect_timeout" (if not None) while
+    connecting, and its usual timeout for everything afterwards."""
+
+    def connect(self):
+        timeout = self.timeout
+        if self.connect_timeout is not None:
+            self.timeout = self.connect_timeout
+        try: self._connect()
+        finally: self.timeout = timeout
+        _settimeout(self.sock, timeout)
+
+
+class HTTPConnection(_ConnectTimeoutMixin, httplib.HTTPConnection):
+    def __init__(self, host, connect_timeout=None, **kwargs):
+        httplib.HTTPConnection.__init__(self, host, **kwargs)
+        self.connect_timeout = connect_timeout
+    _connect = httplib.HTTPConnection.connect
+
+
+class HTTPSConnection(_ConnectTimeoutMixin, httplib.HTTPSConnection):
+    def __init__(self, host, connect_timeout=None, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self.connect_timeout = connect_timeout
+    _connect = httplib.HTTPSConnection.connect
+
+
+
+class PooledResponseFile(object):
+    """File-like wrapper around an httplib response.  Once the body has been
+    read to the end, the connection it came from is returned to the pool (or
+    closed, if the server won't keep it open).  Closing it early closes the
+    connection, since unread data would confuse the next response."""
+
+    def __init__(self, response, conn, key, pool):
+        self._r = response
+        self._conn = conn
+        self._key = key
+        self._pool = pool
+        self._buf = ''
+
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._r.isclosed() and not self._r.will_close:
+            self._pool.put(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+
+    def _read(self, size):
+        if self._conn is None:
+            return ''
+        data = self._r.read() if size < 0 else self._r.read(size)
+        if self._r.isclosed():
+            self._release()
+        return data
+
+
+    def read(self, size=-1):
+        if size < 0:
+            data, self._buf = self._buf + self._read(-1), ''
+            return data
+        if len(self._buf) < size:
+            self._buf += self._read(size - len(self._buf))
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+    def readline(self, size=-1):
+        while '\n' not in self._buf and (size < 0 or len(self._buf) < size):
+            data = self._read(CHUNK_SIZE)
+            if not data: break
+            self._buf += data
+        n = self._buf.find('\n') + 1
+        if n and (size < 0 or n < size):
+            size = n
+        return self.read(size if size >= 0 else len(self._buf))
+
+
+    def close(self):
+        self._release()
+        self._r.close()
+
+
+
+class _PoolingMixin(object):
+    """Implements request sending for the keep-alive handlers below."""
+
+    def _pooled_open(self, scheme, connect, req):
+        """Sends "req" on a pooled connection, made if needed by calling
+        "connect" with the host, timeout and connect timeout.  The connect
+        timeout is taken from the request's connect_timeout attribute, if it
+        has one."""
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        key = (scheme, host)
+        while True:
+            conn, reused = self.pool.get(key, lambda: connect(host, req.timeout,
+                getattr(req, 'connect_timeout', None)))
+            # A reused connection keeps the timeout it was made with.
+            if conn.sock is not None:
+                _settimeout(conn.sock, req.timeout)
+            try:
+                conn.request(req.get_method(), req.get_selector(),
+                    req.get_data(), headers)
+                r = conn.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                # The server may have dropped an idle connection; that's not
+                # an error, so retry with a fresh one.
+                if reused: continue
+                raise urllib2.URLError(e)
+            break
+
+        resp = urllib2.addinfourl(PooledResponseFile(r, conn, key, self.pool),
+            r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class KeepAliveHandler(_PoolingMixin, urllib2.HTTPHandler):
+    """Replaces urllib2.HTTPHandler, sending requests on pooled connections."""
+
+    def __init__(self, pool=pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        # Tunnelling through proxies isn't supported by the pool.
+        if req._tunnel_host:
+            return urllib2.HTTPHandler.http_open(self, req)
+        return self._pooled_open('http', lambda host, timeout, connect_timeout:
+            HTTPConnection(host, connect_timeout, timeout=timeout), req)
+
+
+class KeepAliveHTTPSHandler(_PoolingMixin, urllib2.HTTPSHandler):
+    """Replaces urllib2.HTTPSHandler, sending requests on pooled connections."""
+
+    def __init__(self, pool=pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, req):
+        if req._tunnel_host:
+            return urllib2.HTTPSHandler.https_open(self, req)
+        # SSL contexts only came with Python 2.7.9.
+        context = getattr(self, '_context', None)
+        kwargs = {} if context is None else {'context':context}
+        return self._pooled_open('https', lambda host, timeout, connect_timeout:
+            HTTPSConnection(host, connect_timeout, timeout=timeout, **kwargs),
+            req)
+
+
+
+def build_opener(*handlers):
+    """Like urllib2.build_opener, but the resulting opener also handles
+    compressed responses and reuses connections from the shared pool."""
+    return urllib2.build_opener(DecompressionHandler(), KeepAliveHandler(),
+        KeepAliveHTTPSHandler(), *handlers)
+
+
+def urlopen(url, timeout=None, connect_timeout=None):
+    """Like urllib2.urlopen, but handles compressed responses.  With no timeout,
+    the socket module's default is used.  connect_timeout, if given, replaces
+    timeout while connecting to the server."""
+    opener = build_opener()
+    if not isinstance(url, urllib2.Request):
+        url = urllib2.Request(url)
+    url.connect_timeout = connect_timeout
+    if timeout is None:
+        return opener.open(url)
+    return opener.open(url, timeout=timeout)
@@ -0,0 +1,176 @@
+"""
+This module caches the images that go with packages: icons and preview pictures.
+Each image is stored in options.get_image_dir() under the SHA-1 of its contents,
+so an image shared by several packages, versions or URLs is only kept once, and
+a stored file never changes.
+
+Icons appended to installed PNDs are stored as update_local reads them, and are
+kept for as long as a PND in the local_files table has them.  Images from
+repositories are only downloaded when first asked for, and are kept in a
+least-recently-used cache whose total size is bounded by
+options.get_image_cache_size().  The two are kept in separate directories, so
+that neither can remove the other's files.  To look up a package's images, use
+the get_icon and get_previewpics methods of packages.Package.
+
+Concurrency note: images are written under a temporary name and then renamed
+into place, so any number of threads and processes (such as update_local's
+workers) can store them at once.  Functions that take a database connection
+leave committing to the caller; get_remote_image manages its own, so that no
+transaction is held open while downloading.
+"""
+
+import options, httpclient, database
+import urllib2, httplib, socket, os, tempfile, errno, time
+from hashlib import sha1
+
+# Subdirectories of the image directory.
+LOCAL_DIR = 'local'   # Icons of installed PNDs.
+REMOTE_DIR = 'remote' # Images downloaded from repositories.
+
+# Which URL gave which image, and when it was last used.  database_update
+# creates it along with its other tables.
+REMOTE_IMAGES_TABLE = 'remote_images'
+
+# Largest image that will be downloaded, in bytes.  Anything bigger can't be a
+# sensible icon or preview picture.
+MAX_IMAGE_SIZE = 4 * 1024 * 1024
+# How stale an image's last use may get, in seconds, before using it again is
+# written down.  This only has to order images roughly for eviction.
+LAST_USED_RESOLUTION = 60 * 60
+
+
+class ImageError(Exception): pass
+
+
+
+def _get_dir(kind):
+    path = os.path.join(options.get_image_dir(), kind)
+    if not os.path.isdir(path):
+        try: os.makedirs(path)
+        except OSError as e:
+            # Another process may have just made it.
+            if e.errno != errno.EEXIST:
+                raise
+    return path
+
+
+def get_path(digest, kind):
+    """Gives the path of the image stored with the given digest in "kind" (one
+    of LOCAL_DIR or REMOTE_DIR), or None if it isn't stored there."""
+    if not digest:
+        return None
+    path = os.path.join(_get_dir(kind), digest)
+    return path if os.path.isfile(path) else None
+
+
+def store(data, kind):
+    """Stores the image "data" (a string or buffer) in "kind", unless it's
+    there already, and returns its digest."""
+    digest = sha1(data).hexdigest()
+    d = _get_dir(kind)
+    path = os.path.join(d, digest)
+    if not os.path.isfile(path):
+        fd, temp = tempfile.mkstemp(dir=d, prefix='.' + digest)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp, path)
+        except:
+            os.remove(temp)
+            raise
+    return digest
+
+
+def discard(digests, kind):
+    """Removes the images with the given digests from "kind", if they're
+    there."""
+    for digest in digests:
+        try: os.remove(os.path.join(_get_dir(kind), digest))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def download(url):
+    """Gives the contents of the image at "url".  Raises ImageError if it
+    can't be downloaded or is larger than MAX_IMAGE_SIZE."""
+    try:
+        p = httpclient.urlopen(url, timeout=options.get_repo_timeout(),
+            connect_timeout=options.get_repo_connect_timeout())
+        try: data = p.read(MAX_IMAGE_SIZE + 1)
+        finally: p.close()
+    except (urllib2.URLError, httplib.HTTPException, socket.error,
+            ValueError) as e:
+        raise ImageError('Could not download %s: %s' % (url, repr(e)))
+    if len(data) > MAX_IMAGE_SIZE:
+        raise ImageError('%s is too large to be an image.' % url)
+    return data
+
+
+def find_remote_image(db_conn, url):
+    """Gives the path of the cached copy of the image at "url", or None if it
+    isn't cached.  A found image is marked as just used, though only if that
+    hasn't been done in the last LAST_USED_RESOLUTION seconds, so looking up
+    many images rarely writes to the database."""
+    row = db_conn.execute('Select hash, last_used From "%s" Where url=?'
+        % REMOTE_IMAGES_TABLE, (url,)).fetchone()
+    path = get_path(row[0], REMOTE_DIR) if row is not None else None
+    if path is not None:
+        t = time.time()
+        if not row[1] or t - row[1] >= LAST_USED_RESOLUTION:
+            db_conn.execute('Update "%s" Set last_used=? Where url=?'
+                % REMOTE_IMAGES_TABLE, (t, url))
+    return path
+
+
+def add_remote_image(db_conn, url, data):
+    """Caches "data" as the image at "url", and gives the path of the cached
+    copy.  This may evict the least recently used images to keep within
+    options.get_image_cache_size()."""
+    # Make room first, so the new image can't be the one evicted.
+    evict(db_conn, options.get_image_cache_size() - len(data), url)
+    digest = store(data, REMOTE_DIR)
+    db_conn.execute('Insert Or Replace Into "%s" Values (?,?,?,?)'
+        % REMOTE_IMAGES_TABLE, (url, digest, len(data), time.time()))
+    return get_path(digest, REMOTE_DIR)
+
+
+def get_remote_image(url):
+    """Gives the path of a cached copy of the image at "url", downloading it if
+    it isn't cached yet.  Unlike the functions above, this commits its own
+    short transactions: the cache is looked up in one and the image added in
+    another, with the download in between, so the database is never locked
+    while waiting on the network.  Don't call it inside a transaction.
+    Raises ImageError if the image can't be downloaded."""
+    with database.transaction() as db:
+        path = find_remote_image(db, url)
+    if path is not None:
+        return path
+    data = download(url)
+    with database.transaction() as db:
+        return add_remote_image(db, url, data)
+
+
+def evict(db_conn, limit=None, forget=None):
+    """Forgets the least recently used downloaded images until the rest add up
+    to no more than "limit" bytes, defaulting to
+    options.get_image_cache_size(), and removes the files no longer used by any
+    URL.  The URL "forget", if given, is forgotten regardless.  Returns the
+    number of URLs forgotten."""
+    if limit is None:
+        limit = options.get_image_cache_size()
+    rows = db_conn.execute('Select url, hash, size From "%s" Order By last_used'
+        % REMOTE_IMAGES_TABLE).fetchall()
+    total = sum(r[2] for r in rows)
+    gone = []
+    for url, digest, size in rows:
+        if total <= limit and url != forget:
+            continue
+        gone.append((url, digest))
+        total -= size
+    db_conn.executemany('Delete From "%s" Where url=?' % REMOTE_IMAGES_TABLE,
+        ((url,) for url, digest in gone))
+    discard(set( digest for url, digest in gone if db_conn.execute(
+        'Select 1 From "%s" Where hash=?' % REMOTE_IMAGES_TABLE,
+        (digest,)).fetchone() is None ), REMOTE_DIR)
+    return len(gone)
@@ -0,0 +1,125 @@
+"""
+This module parses PND repository feeds incrementally, so packages can be
+processed as they arrive instead of after the whole feed has been read into
+memory.  Only the "packages" array is streamed; every other top-level member of
+the feed is small and gets decoded whole.
+
+The standard json module can't parse partial documents, but its raw_decode
+method can decode one complete value from a larger string.  RepoStream keeps a
+buffer holding just enough of the feed to decode the next value, reading more
+from the file-like object whenever a value is cut off at the end of the buffer.
+"""
+
+import json, codecs
+
+# Bytes to read from the feed at a time.
+CHUNK_SIZE = 16 * 1024
+
+WHITESPACE = u' \t\n\r'
+
+
+class RepoStream(object):
+    """Parses a repository feed from the file-like object "fp" as it is read.
+    Iterate over packages() to get each package dictionary in turn.  All other
+    top-level members of the feed (such as "repository") are stored in the
+    header dictionary, which is only complete once packages() is exhausted.
+    Malformed feeds raise ValueError, possibly after some packages have already
+    been yielded."""
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.header = {}
+
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+
+    def _fill(self):
+        """Reads another chunk of the feed into the buffer, discarding whatever
+        has already been parsed.  Returns False if there's nothing more to read."""
+        if self._eof:
+            return False
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self._eof = True
+            text = self._text.decode('', True)
+        else:
+            text = self._text.decode(data)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return bool(data)
+
+
+    def _peek(self):
+        """Skips whitespace and returns the next character, or an empty string
+        at the end of the feed."""
+        while True:
+            while (self._pos < len(self._buf) and
+                    self._buf[self._pos] in WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return u''
+
+
+    def _expect(self, chars):
+        """Consumes the next character, which must be one of "chars"."""
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of "%s" in feed, found "%s".'
+                % (chars, c))
+        self._pos += 1
+        return c
+
+
+    def _value(self):
+        """Decodes the next complete JSON value, reading as much of the feed as
+        is needed to do so."""
+        self._peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # Might just be cut off; only give up if there's no more feed.
+                if not self._fill():
+                    raise
+                continue
+            # A number at the very end of the buffer may be missing digits.
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return obj
+
+
+    def packages(self):
+        """Yields each package in the feed as soon as it has been fully read."""
+        self._expect(u'{')
+        if self._peek() == u'}':
+            self._pos += 1
+        else:
+            while True:
+                key = self._value()
+                if not isinstance(key, basestring):
+                    raise ValueError('Feed has a non-string key: %r' % key)
+                self._expect(u':')
+
+                if key == u'packages' and self._peek() == u'[':
+                    self._pos += 1
+                    if self._peek() == u']':
+                        self._pos += 1
+                    else:
+                        while True:
+                            yield self._value()
+                            if self._expect(u',]') == u']': break
+                else:
+                    self.header[key] = self._value()
+
+                if self._expect(u',}') == u'}': break
+
+        if self._peek():
+            raise ValueError('Extra data found after the end of the feed.')
@@ -16,6 +16,8 @@ FILE = c.c_void_p
 
 libc.fopen.argtypes = [c.c_char_p, c.c_char_p]
 libc.fopen.restype = FILE
+libc.fclose.argtypes = [FILE]
+libc.fclose.restype = c.c_int
 
 
 #Data structures defined in libpnd.
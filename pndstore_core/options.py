@@ -3,7 +3,7 @@
 Concurrency note: as long as working_dir and the config file already exist, all functions here should have no side effects, and should therefore be thread safe.  To ensure that both exist, call get_cfg() at least once before starting other threads."""
 
 from json import load as jload
-import shutil, os, locale
+import shutil, os, locale, multiprocessing
 import libpnd
 
 #If a different working directory is to be used, the script importing this
@@ -14,6 +14,27 @@ working_dir = os.path.expanduser('~/.pndstore')
 
 DEFAULT_KEY = 'default'
 
+# Fallbacks for options that may be missing from config files created by older
+# versions of PNDstore.
+DEFAULT_UPDATE_THREADS = 4
+DEFAULT_REPO_TIMEOUT = 30 # In seconds.
+DEFAULT_REPO_CONNECT_TIMEOUT = 10 # In seconds.
+DEFAULT_REPO_RETRIES = 2
+DEFAULT_REPO_RETRY_DELAY = 0.5 # In seconds, doubled after each retry.
+DEFAULT_REPO_COOLDOWN = 3600 # In seconds.
+DEFAULT_SCAN_PROCESSES = 1
+DEFAULT_HASH_THREADS = 2
+DEFAULT_IMAGE_CACHE_SIZE = 16 * 1024 * 1024 # In bytes.
+DEFAULT_DB_JOURNAL_MODE = 'wal'
+DEFAULT_DB_SYNCHRONOUS = 'normal'
+DEFAULT_DB_BUSY_TIMEOUT = 60 # In seconds.
+DEFAULT_DB_CACHE_SIZE = 4 * 1024 * 1024 # In bytes.
+DEFAULT_DB_MMAP_SIZE = 32 * 1024 * 1024 # In bytes.
+
+# Values sqlite accepts for the journal_mode and synchronous pragmas.
+DB_JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+DB_SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+
 
 def get_working_dir():
     """Gives full path to working directory, creating it if needed."""
@@ -38,6 +59,31 @@ def get_database():
     return os.path.abspath(os.path.join(get_working_dir(), 'database_1.0.sqlite'))
 
 
+def get_feed_dir():
+    """Gives full path to the directory holding downloaded repository feeds,
+    creating it if needed."""
+    feed_dir = os.path.join(get_working_dir(), 'feeds')
+    if not os.path.isdir(feed_dir):
+        os.makedirs(feed_dir)
+    return feed_dir
+
+
+def get_image_dir():
+    """Gives full path to the directory holding cached icons and preview
+    pictures, creating it if needed."""
+    image_dir = os.path.join(get_working_dir(), 'images')
+    if not os.path.isdir(image_dir):
+        os.makedirs(image_dir)
+    return image_dir
+
+
+def get_cfg_value(key, default=None):
+    """Gives the value of a single config option, or default if the config file
+    doesn't specify it."""
+    with open(get_cfg()) as cfg:
+        return jload(cfg).get(key, default)
+
+
 def get_repos():
     """Returns list of repository urls in the given order."""
     #TODO: Perhaps validate URLs first?
@@ -47,6 +93,123 @@ def get_repos():
         return jload(cfg)['repositories']
 
 
+def get_update_threads():
+    """Returns the maximum number of repositories to update concurrently."""
+    return max(1, int(get_cfg_value('update_threads', DEFAULT_UPDATE_THREADS)))
+
+
+def get_repo_value(url, key, default=None):
+    """Gives the value of a repository setting.  The "repo_settings" config
+    option may map a repository's url to a dictionary of settings that apply to
+    it alone; otherwise, the top-level config option is used."""
+    with open(get_cfg()) as cfg:
+        cfg = jload(cfg)
+    try: return cfg['repo_settings'][url][key]
+    except (KeyError, TypeError):
+        return cfg.get(key, default)
+
+
+def get_repo_timeout(url=None):
+    """Returns the number of seconds to wait on a repository's server for a
+    response (or more of one) before giving up on it."""
+    return float(get_repo_value(url, 'repo_timeout', DEFAULT_REPO_TIMEOUT))
+
+
+def get_repo_connect_timeout(url=None):
+    """Returns the number of seconds to wait while connecting to a repository's
+    server before giving up on it."""
+    return float(get_repo_value(url, 'repo_connect_timeout',
+        DEFAULT_REPO_CONNECT_TIMEOUT))
+
+
+def get_repo_retries(url=None):
+    """Returns the number of times to retry a repository that can't be reached
+    before giving up on it for this update."""
+    return max(0, int(get_repo_value(url, 'repo_retries', DEFAULT_REPO_RETRIES)))
+
+
+def get_repo_retry_delay(url=None):
+    """Returns the number of seconds to wait before the first retry of a
+    repository.  The wait doubles for each retry after that."""
+    return float(get_repo_value(url, 'repo_retry_delay',
+        DEFAULT_REPO_RETRY_DELAY))
+
+
+def get_repo_cooldown(url=None):
+    """Returns the number of seconds a repository is skipped for once it has
+    failed too many updates in a row.  The time doubles with each further
+    failure."""
+    return float(get_repo_value(url, 'repo_cooldown', DEFAULT_REPO_COOLDOWN))
+
+
+
+def get_scan_processes():
+    """Returns the number of processes to read local PNDs with at once.  A
+    value of 0 in the config file means one per CPU."""
+    n = int(get_cfg_value('scan_processes', DEFAULT_SCAN_PROCESSES))
+    if n == 0:
+        try: n = multiprocessing.cpu_count()
+        except NotImplementedError: n = 1
+    return max(1, n)
+
+
+def get_hash_threads():
+    """Returns the number of background threads to compute MD5 sums of local
+    PNDs with.  Hashing is mostly waiting on the disk, so threads suffice."""
+    return max(1, int(get_cfg_value('hash_threads', DEFAULT_HASH_THREADS)))
+
+
+def get_image_cache_size():
+    """Returns the most bytes of images downloaded from repositories to keep
+    cached.  Icons of installed PNDs don't count towards this."""
+    return max(0, int(get_cfg_value('image_cache_size',
+        DEFAULT_IMAGE_CACHE_SIZE)))
+
+
+def get_db_journal_mode():
+    """Returns sqlite's journal mode for the database.  The default, WAL, lets
+    the GUI read while an update writes, and needs fewer syncs.  Unknown modes
+    give the default."""
+    mode = str(get_cfg_value('db_journal_mode',
+        DEFAULT_DB_JOURNAL_MODE)).lower()
+    return mode if mode in DB_JOURNAL_MODES else DEFAULT_DB_JOURNAL_MODE
+
+
+def get_db_synchronous():
+    """Returns how often sqlite waits for database writes to reach the disk.
+    With WAL, "normal" only syncs at checkpoints, which spares slow SD cards
+    while still keeping the database consistent (though the last commits may be
+    lost on power failure).  Unknown levels give the default."""
+    level = str(get_cfg_value('db_synchronous', DEFAULT_DB_SYNCHRONOUS)).lower()
+    return level if level in DB_SYNCHRONOUS_LEVELS else DEFAULT_DB_SYNCHRONOUS
+
+
+def get_db_busy_timeout():
+    """Returns the seconds to wait for another connection's write to finish
+    before giving up on the database.  Generous, since concurrent repo updates
+    take turns writing."""
+    return max(0.0, float(get_cfg_value('db_busy_timeout',
+        DEFAULT_DB_BUSY_TIMEOUT)))
+
+
+def get_db_cache_size():
+    """Returns the most bytes of the database each connection keeps cached in
+    memory."""
+    return max(0, int(get_cfg_value('db_cache_size', DEFAULT_DB_CACHE_SIZE)))
+
+
+def get_db_mmap_size():
+    """Returns the most bytes of the database that each connection reads
+    through a memory map rather than by copying it.  0 turns that off."""
+    return max(0, int(get_cfg_value('db_mmap_size', DEFAULT_DB_MMAP_SIZE)))
+
+
+def get_keep_feeds():
+    """Returns whether downloaded repository feeds should be kept on disk, so
+    they can be re-read later without using the network."""
+    return bool(get_cfg_value('keep_feeds', False))
+
+
 
 def get_locale_default():
     return locale.getdefaultlocale()[0]
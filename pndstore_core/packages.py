@@ -2,23 +2,38 @@
 This module implements a means of interacting with and acting on package
 data.  Notable is the Package class that encapsulates all available versions of
 a package, also allowing for installation and removal.  Also, the get_updates
-function is useful.
+function is useful, giving an Update for each installed package that can be
+upgraded.
 """
 
-import options, database_update, sqlite3, os, shutil, urllib2, glob
+import options, database, database_update, httpclient, images, sqlite3, os
+import shutil, glob, array
+import warnings
 from hashlib import md5
 from distutils.version import LooseVersion
 from weakref import WeakValueDictionary
-from database_update import LOCAL_TABLE, REPO_INDEX_TABLE, SEPCHAR
+from database_update import LOCAL_TABLE, REPO_INDEX_TABLE, LOCAL_FILES_TABLE
+from database_update import PACKAGES_TABLE, SEARCH_TABLE, SEARCH_IDS_TABLE
+from database_update import SEARCH_COLUMNS, SEPCHAR
 
 
 class PackageError(Exception): pass
 
+# How much a match in each column of the search index counts for when ranking
+# search results.
+SEARCH_WEIGHTS = {'title':10., 'description':1., 'author':3.,
+    'categories':5.}
+
+# Tells PackageInstance to look its entry up itself.
+_LOOKUP = object()
+
 
 
 class PNDVersion(LooseVersion):
     """Gives the flexibility of distutils.version.LooseVersion, but ensures that
-    any text is always considered less than anything else (including nothing)."""
+    any text is always considered less than anything else (including nothing).
+    Versions in the database also have a version_key, as given by
+    database_update.version_key, that sorts the same way without parsing."""
     def __cmp__(self, other):
         if isinstance(other, str):
             other = self.__class__(other)
@@ -38,7 +53,7 @@ class PNDVersion(LooseVersion):
 def get_remote_tables():
     """Checks the remote index table to find the names of all tables containing
     data from remote databases.  Returns a list of strings."""
-    with sqlite3.connect(options.get_database()) as db:
+    with database.transaction() as db:
         c = db.execute('Select url From "%s"' % REPO_INDEX_TABLE)
         return [ i[0] for i in c ]
 
@@ -56,24 +71,42 @@ class PackageInstance(object):
     This should not generally used by external applications.  The Package class
     should cover all needs."""
 
-    def __init__(self, sourceid, pkgid):
-        "sourceid should be the name of the table in which to look for this package."
+    def __init__(self, sourceid, pkgid, db_entry=_LOOKUP):
+        """sourceid should be LOCAL_TABLE or the URL of a repo, as in the repo
+        index.  db_entry may be given if it's already been looked up, or as
+        None if the package isn't there."""
         self.sourceid = sourceid
         self.pkgid = pkgid
 
-        with sqlite3.connect(options.get_database()) as db:
-            db.row_factory = sqlite3.Row
-            db.text_factory = lambda x: unicode(x, 'utf-8', 'replace')
-            # Will set db_entry to None if entry or table doesn't exist.
-            try:
-                self.db_entry = db.execute('Select * From "%s" Where id=?'
-                    % database_update.sanitize_sql(sourceid), (pkgid,)).fetchone()
-            except sqlite3.OperationalError:
-                self.db_entry = None
+        if db_entry is _LOOKUP:
+            with database.transaction() as db:
+                # Will set db_entry to None if entry or table doesn't exist.
+                try:
+                    if sourceid == LOCAL_TABLE:
+                        db_entry = db.execute('Select * From "%s" Where id=?'
+                            % LOCAL_TABLE, (pkgid,)).fetchone()
+                    else:
+                        db_entry = db.execute('''Select * From "%s"
+                            Where repo=? And id=?''' % PACKAGES_TABLE,
+                            (database_update.sanitize_sql(sourceid), pkgid)
+                            ).fetchone()
+                except sqlite3.OperationalError:
+                    db_entry = None
+        self.db_entry = db_entry
 
         self.exists = self.db_entry is not None
-        self.version = PNDVersion(self.db_entry['version'] if self.exists
-            else 'A') # This should be the lowest possible version.
+        # Missing packages have no key, which is lower than any version's.
+        self.version_key = self.db_entry['version_key'] if self.exists else None
+        self._version = None
+
+
+    @property
+    def version(self):
+        "The PNDVersion of this instance, parsed when it's first wanted."
+        if self._version is None:
+            self._version = PNDVersion(self.db_entry['version'] if self.exists
+                else 'A') # This should be the lowest possible version.
+        return self._version
 
 
     def install(self, installdir):
@@ -83,7 +116,7 @@ class PackageInstance(object):
             # Or maybe skip the rest of the function without erroring.
 
         # Make connection and determine filename.
-        p = urllib2.urlopen(self.db_entry['uri'])
+        p = httpclient.urlopen(self.db_entry['uri'])
         header = p.info().getheader('content-disposition')
         fkey = 'filename="'
         if header and (fkey in header):
@@ -107,9 +140,8 @@ class PackageInstance(object):
             raise PackageError("File corrupted.  MD5 sums do not match.")
 
         # Update local database with new info.
-        with sqlite3.connect(options.get_database()) as db:
+        with database.transaction(database.BYTES) as db:
             database_update.update_local_file(path, db)
-            db.commit()
 
 
 
@@ -136,18 +168,70 @@ class Package(object):
         self.id = pkgid
 
         self.local = PackageInstance(LOCAL_TABLE, pkgid)
-        self.remote = [PackageInstance(i, pkgid) for i in get_remote_tables()]
+        # Find the package in every repo at once, in the order of the index.
+        with database.transaction() as db:
+            self.remote = [ PackageInstance(i['index_url'], pkgid,
+                i if i['id'] is not None else None) for i in db.execute(
+                '''Select i.url As index_url, p.* From "%s" i
+                Left Join "%s" p On p.repo=i.url And p.id=? Order By i.rowid'''
+                % (REPO_INDEX_TABLE, PACKAGES_TABLE), (pkgid,)) ]
 
 
     def get_latest_remote(self):
-        return max(self.remote, key=lambda x: x.version)
+        return max(self.remote, key=lambda x: x.version_key)
 
 
     def get_latest(self):
         """Returns PackageInstance of the most recent available version.
         Gives preference to locally installed version."""
         m = self.get_latest_remote()
-        return self.local.version >= m.version and self.local or m
+        return self.local.version_key >= m.version_key and self.local or m
+
+
+    def _get_latest_remote_with(self, col):
+        """Gives the db_entry of the most recent remote version with a value in
+        column "col", or None if none has one."""
+        for m in sorted(self.remote, key=lambda x: x.version_key,
+                reverse=True):
+            if m.exists and m.db_entry[col]:
+                return m.db_entry
+
+
+    def get_icon(self):
+        """Gives the path of a cached copy of this package's icon, or None if
+        there isn't one.  The icon appended to the installed PND is preferred.
+        Otherwise, the icon of the latest remote version is downloaded, unless
+        it already has been."""
+        if self.local.exists:
+            with database.transaction() as db:
+                c = db.execute('Select icon From "%s" Where path=?'
+                    % LOCAL_FILES_TABLE,
+                    (self.local.db_entry['uri'],)).fetchone()
+            path = images.get_path(c and c[0], images.LOCAL_DIR)
+            if path is not None:
+                return path
+        entry = self._get_latest_remote_with('icon')
+        if entry is not None:
+            try:
+                return images.get_remote_image(entry['icon'])
+            except images.ImageError as e:
+                warnings.warn(str(e))
+
+
+    def get_previewpics(self):
+        """Gives a list of paths of cached copies of the preview pictures of the
+        latest remote version that has any, downloading those not yet cached.
+        Any that can't be downloaded are left out.  Installed PNDs keep theirs
+        inside their filesystem images, so those aren't available."""
+        paths = []
+        entry = self._get_latest_remote_with('previewpics')
+        if entry is not None:
+            for url in entry['previewpics'].split(SEPCHAR):
+                try:
+                    paths.append(images.get_remote_image(url))
+                except images.ImageError as e:
+                    warnings.warn(str(e))
+        return paths
 
 
     def install(self, installdir):
@@ -213,9 +297,10 @@ class Package(object):
         # If so, remove it.
         os.remove(self.local.db_entry['uri'])
         # Remove it from the local database.
-        with sqlite3.connect(options.get_database()) as db:
+        with database.transaction() as db:
+            database_update.forget_local_files(db, [self.local.db_entry['uri']])
             db.execute('Delete From "%s" Where id=?' % LOCAL_TABLE, (self.id,))
-            db.commit()
+            database_update.update_package_index(db, LOCAL_TABLE, [self.id])
         # Local table has changed, so update the local PackageInstance.
         self.local = PackageInstance(LOCAL_TABLE, self.id)
 
@@ -232,37 +317,136 @@ def search_local_packages(col, val):
     """Find all packages containing the given value in the given column.
     Also handles columns containing lists of data, ensuring that the given
     value is an entry of that list, not just a substring of an entry."""
-    with sqlite3.connect(options.get_database()) as db:
-        c = db.execute( '''Select id From "%(tab)s" Where %(col)s Like ?
-            Or %(col)s Like ? Or %(col)s Like ? Or %(col)s Like ?'''
-            % {'tab':LOCAL_TABLE, 'col':col},
-            (val, val+SEPCHAR+'%', '%'+SEPCHAR+val,
-            '%'+SEPCHAR+val+SEPCHAR+'%') )
+    lists = dict( (column, (table, entry)) for table, column, entry
+        in database_update.PACKAGE_LISTS )
+    with database.transaction() as db:
+        if col in lists:
+            # Applications and categories have tables of their own.
+            c = db.execute('''Select l.id From "%s" j Join "%s" l On l.id=j.id
+                Where j.%s=? Collate NoCase And j.repo=? Order By l.rowid'''
+                % (lists[col][0], LOCAL_TABLE, lists[col][1]),
+                (val, LOCAL_TABLE))
+        else:
+            c = db.execute( '''Select id From "%(tab)s" Where %(col)s Like ?
+                Or %(col)s Like ? Or %(col)s Like ? Or %(col)s Like ?'''
+                % {'tab':LOCAL_TABLE, 'col':col},
+                (val, val+SEPCHAR+'%', '%'+SEPCHAR+val,
+                '%'+SEPCHAR+val+SEPCHAR+'%') )
 
     return [ Package(i[0]) for i in c ]
 
 
+def search(query, limit=None):
+    """Finds packages whose title, description, author or categories match
+    "query", local or remote.  The query is made of words, all of which must
+    match (so "chess engine" finds packages mentioning both), and may use the
+    sqlite full-text query syntax, such as "quoted phrases", OR, and prefixes
+    like emu*.  Returns Package objects, best matches first, up to "limit" of
+    them if given.  Raises PackageError if the query isn't valid."""
+    weights = [ SEARCH_WEIGHTS[c] for c, p in SEARCH_COLUMNS ]
+    scores = {}
+    with database.transaction() as db:
+        if database_update.search_available:
+            try:
+                c = db.execute('''Select i.id, matchinfo("%(s)s", 'pcx')
+                    From "%(s)s" Join "%(i)s" i On i.rowid="%(s)s".docid
+                    Where "%(s)s" Match ?''' % {'s':SEARCH_TABLE,
+                    'i':SEARCH_IDS_TABLE}, (query,)).fetchall()
+            except sqlite3.OperationalError as e:
+                raise PackageError('Invalid search "%s": %s' % (query, e))
+            for pkgid, info in c:
+                score = _rank(array.array('I', str(info)), weights)
+                scores[pkgid] = max(score, scores.get(pkgid, 0))
+        else:
+            # Without the index, look for each word in every package.
+            words = [ w.lower() for w in query.split() ]
+            columns = ', '.join( p for c, p in SEARCH_COLUMNS )
+            for row in db.execute('''Select id, %s From "%s"
+                    Union All Select id, %s From "%s"''' % (columns,
+                    PACKAGES_TABLE, columns, LOCAL_TABLE)):
+                text = [ (i or '').lower() for i in tuple(row)[1:] ]
+                if all( any( w in t for t in text ) for w in words ):
+                    score = sum( weight for t, weight in zip(text, weights)
+                        for w in words if w in t )
+                    scores[row[0]] = max(score, scores.get(row[0], 0))
+
+    ids = sorted(scores, key=lambda i: (-scores[i], i))
+    return [ Package(i) for i in ids[:limit] ]
+
+
+def _rank(info, weights):
+    """Scores a search result from its matchinfo in "pcx" form: for each phrase
+    of the query, the share of all its hits in each column that fall in this
+    package, weighted by column."""
+    phrases, columns = info[0], info[1]
+    score = 0.
+    for p in xrange(phrases):
+        for c in xrange(columns):
+            hits, total = info[2 + 3 * (p * columns + c):][:2]
+            if hits:
+                score += weights[c] * hits / total
+    return score
+
+
 def get_all():
     "Returns Package object for every available package, local or remote."
-    tables = get_remote_tables()
-    tables.append(LOCAL_TABLE)
-    with sqlite3.connect(options.get_database()) as db:
-        c = db.execute(
-            ' Union '.join([ 'Select id From "%s"'%t for t in tables ]) )
+    with database.transaction() as db:
+        c = db.execute('Select id From "%s" Union Select id From "%s"'
+            % (PACKAGES_TABLE, LOCAL_TABLE))
         return [ Package(i[0]) for i in c ]
 
 
 def get_all_local():
     """Returns Package object for every installed package."""
-    with sqlite3.connect(options.get_database()) as db:
+    with database.transaction() as db:
         c = db.execute('Select id From "%s"' % LOCAL_TABLE)
         return [ Package(i[0]) for i in c ]
 
 
+class Update(object):
+    """An installed package with a newer version available, as given by
+    get_updates.  Has the package's id, and its title and applications as
+    installed, along with its local_version and the remote_version that would
+    replace it, from the repo at the URL "repo".  The full Package is only
+    looked up when first wanted, as the "package" attribute."""
+
+    def __init__(self, pkgid, title, applications, local_version,
+            remote_version, repo):
+        self.id = pkgid
+        self.title = title
+        self.applications = applications
+        self.local_version = local_version
+        self.remote_version = remote_version
+        self.repo = repo
+        self._package = None
+
+
+    @property
+    def package(self):
+        if self._package is None:
+            self._package = Package(self.id)
+        return self._package
+
+
+    def upgrade(self):
+        "Upgrades the installed package to the latest version."
+        self.package.upgrade()
+
+
+
 def get_updates():
     """Checks for updates for all installed packages.
-    Returns a list of Package objects for which a remote version is newer than
-    the installed version.  Does not include packages that are not locally installed."""
-    # TODO: Possibly optimize by using SQL Joins to only check packages that
-    # are both locally and remotely available.
-    return [ i for i in get_all_local() if i.local is not i.get_latest() ]
+    Returns a list of Update objects for the installed packages of which a
+    remote version is newer than the installed version, in the order of the
+    local table."""
+    # For each installed package, pick its latest remote version from the index
+    # on its key, choosing the first repo in the index if several have it, as
+    # Package.get_latest_remote does.
+    with database.transaction() as db:
+        return [ Update(*i) for i in db.execute('''Select l.id, l.title,
+                l.applications, l.version, p.version, p.repo
+            From "%(l)s" l Join "%(p)s" p On p.id=l.id And p.repo=(
+                Select r.repo From "%(p)s" r Join "%(i)s" i On i.url=r.repo
+                Where r.id=l.id Order By r.version_key Desc, i.rowid Limit 1)
+            Where p.version_key > l.version_key Order By l.rowid'''
+            % {'l':LOCAL_TABLE, 'p':PACKAGES_TABLE, 'i':REPO_INDEX_TABLE}) ]
@@ -0,0 +1,163 @@
+"""
+This module lets callers follow the progress of database updates.  Pass an
+observer to database_update.update_remote or update_local and it will be called
+with an Event every time something happens, so interfaces can show how far along
+an update is and where its time is going.
+
+An observer is any callable taking a single Event.  Timings is a ready-made
+observer that totals everything up for reporting afterwards.
+
+Concurrency note: update_remote works on several repositories at once, so events
+may come from several threads.  Reporter makes sure observers are only called
+by one thread at a time, but they are called from whichever thread did the work,
+not necessarily the one that started the update.
+"""
+
+import time, threading, warnings
+from contextlib import contextmanager
+
+# Kinds of event, and the attributes each carries besides "kind" and "time".
+PHASE_STARTED = 'phase started'     # phase
+PHASE_FINISHED = 'phase finished'   # phase, elapsed (seconds)
+REPO_STARTED = 'repo started'       # repo
+REPO_FINISHED = 'repo finished'     # repo, packages, elapsed
+REPO_SKIPPED = 'repo skipped'       # repo, retry_after
+REPO_RETRYING = 'repo retrying'     # repo, attempt, delay, error
+BYTES_RECEIVED = 'bytes received'   # repo, bytes
+PACKAGES_PARSED = 'packages parsed' # repo, packages
+ROWS_WRITTEN = 'rows written'       # repo, rows
+PND_SCANNED = 'pnd scanned'         # path, count, total, changed
+
+# Phases reported by database_update.  Phases within a repo's update also have
+# the "repo" attribute.
+REMOTE_PHASE = 'remote'     # All of update_remote.
+FETCH_PHASE = 'fetch'       # Downloading and loading one repo's feed.
+APPLY_PHASE = 'apply'       # Applying a feed's packages to one repo's table.
+LOCAL_PHASE = 'local'       # All of update_local.
+SEARCH_PHASE = 'search'     # Finding PNDs on the searchpath.
+SCAN_PHASE = 'scan'         # Reading the PNDs found.
+
+
+class Event(object):
+    """Something that happened during an update.  "kind" is one of the constants
+    above and "time" is when it happened.  The other attributes depend on kind:
+
+        repo        URL of the repository concerned
+        bytes       bytes of feed received from repo so far (uncompressed)
+        packages    packages parsed from repo so far; on REPO_FINISHED, the
+                    number written, or None if the repo could not be updated
+        rows        rows written to repo's table so far
+        path        path of the PND just scanned
+        count       PNDs scanned so far, out of "total" found
+        changed     whether the PND was new or changed, and so was read
+        retry_after time until which a failing repo is being skipped
+        attempt     number of the retry about to be made, from 1
+        delay       seconds to wait before retrying
+        error       the exception that made a retry necessary"""
+
+    def __init__(self, kind, **info):
+        self.kind = kind
+        self.time = time.time()
+        self.__dict__.update(info)
+
+    def __repr__(self):
+        info = ', '.join('%s=%r' % i for i in sorted(self.__dict__.iteritems())
+            if i[0] != 'kind')
+        return 'Event(%r, %s)' % (self.kind, info)
+
+
+
+class Reporter(object):
+    """Sends events to "observer", or nowhere if it's None.  Keyword arguments
+    are added to every event sent; bind gives a Reporter sharing the same
+    observer with more of them, so lower-level code needn't know which repo it
+    is working for.  If the observer raises an exception, it's turned into a
+    warning so that a broken display can't break an update."""
+
+    def __init__(self, observer=None, **context):
+        self.observer = observer
+        self.context = context
+        self._lock = threading.Lock()
+
+
+    def bind(self, **context):
+        r = Reporter(self.observer, **dict(self.context, **context))
+        r._lock = self._lock
+        return r
+
+
+    def emit(self, kind, **info):
+        if self.observer is None:
+            return
+        event = Event(kind, **dict(self.context, **info))
+        with self._lock:
+            try: self.observer(event)
+            except Exception as e:
+                warnings.warn("Progress observer failed: %s" % repr(e))
+
+
+    @contextmanager
+    def phase(self, name):
+        """Reports the start and end of the code in a with block as a phase,
+        including its duration.  The end is reported even if it fails."""
+        self.emit(PHASE_STARTED, phase=name)
+        start = time.time()
+        try: yield
+        finally:
+            self.emit(PHASE_FINISHED, phase=name, elapsed=time.time() - start)
+
+
+# Reporter for when nobody's listening.
+null = Reporter()
+
+
+
+class Timings(object):
+    """Observer that adds up events for a summary of an update.  "phases" maps
+    each phase name to its total time, "repos" maps each repo URL to its
+    (packages, elapsed) once finished, and "bytes", "rows" and "pnds" are
+    totals over the whole update.  Repos are updated concurrently, so the time
+    of per-repo phases like FETCH_PHASE can add up to more than REMOTE_PHASE."""
+
+    def __init__(self):
+        self.phases = {}
+        self.repos = {}
+        self.bytes = 0
+        self.rows = 0
+        self.pnds = 0
+        # Latest running totals of each repo, since events count from its start.
+        self._bytes = {}
+        self._rows = {}
+
+
+    def __call__(self, event):
+        if event.kind == PHASE_FINISHED:
+            self.phases[event.phase] = (self.phases.get(event.phase, 0) +
+                event.elapsed)
+        elif event.kind == REPO_FINISHED:
+            self.repos[event.repo] = (event.packages, event.elapsed)
+        elif event.kind == BYTES_RECEIVED:
+            self.bytes += event.bytes - self._bytes.get(event.repo, 0)
+            self._bytes[event.repo] = event.bytes
+        elif event.kind == ROWS_WRITTEN:
+            self.rows += event.rows - self._rows.get(event.repo, 0)
+            self._rows[event.repo] = event.rows
+        elif event.kind == PND_SCANNED:
+            self.pnds += 1
+        # A repo's totals start over if it's updated again.
+        if event.kind == REPO_STARTED:
+            self._bytes.pop(event.repo, None)
+            self._rows.pop(event.repo, None)
+
+
+    def report(self):
+        """Gives a list of lines summarizing the update."""
+        lines = []
+        for repo, (n, elapsed) in sorted(self.repos.iteritems()):
+            lines.append('%s: %s in %.2f s' % (repo,
+                'failed' if n is None else '%d packages' % n, elapsed))
+        for phase, elapsed in sorted(self.phases.iteritems()):
+            lines.append('%s phase: %.2f s' % (phase, elapsed))
+        lines.append('%d bytes received, %d rows written, %d PNDs scanned'
+            % (self.bytes, self.rows, self.pnds))
+        return lines
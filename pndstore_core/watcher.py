@@ -0,0 +1,336 @@
+"""
+This module keeps the local table up to date while PNDs are copied onto, changed
+on or removed from the searchpath, without waiting for a full update_local.  It
+uses Linux's inotify (through ctypes, so nothing extra needs installing) to be
+told about changes in the searchpath's directories, and passes each changed PND
+to database_update.update_local_file or forget_local_files.
+
+Copying a PND produces a flurry of events, and copying a whole directory of them
+even more.  Events are therefore coalesced: nothing is done until the
+filesystem has been quiet for a moment, and then each affected path is looked at
+once.  Files whose size, modification time and inode match the local_files
+table are left alone.
+
+Changes made while nobody was watching aren't seen, so run update_local before
+starting to watch.  If the kernel drops events because too many arrived at
+once, an update_local is done instead.
+
+Concurrency note: a LocalWatcher should only be used by one thread.  It reads
+each batch of changed PNDs without holding the database, and then writes them
+in one short transaction, so other threads and processes may use the database
+meanwhile.
+"""
+
+import packages, database, database_update, progress
+import ctypes, struct, select, errno, os, sys, stat, time, warnings
+
+# Seconds without events to wait before acting on the ones received.
+COALESCE_DELAY = 1.0
+# Longest to put off acting on events while more keep coming, in seconds.
+MAX_DELAY = 10.0
+# Seconds between checks for new searchpath directories, such as those on an SD
+# card that has just been inserted.
+REFRESH_INTERVAL = 10.0
+
+# From <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# Events wanted from every watched directory.
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# Events after which a watched directory is no longer where it was.
+GONE_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT
+
+# Fixed part of struct inotify_event: wd, mask, cookie, len.  It's followed by
+# "len" bytes of NUL-padded name.
+_event = struct.Struct('iIII')
+# Enough for many events at once; any read must fit at least one whole event.
+_READ_SIZE = 64 * 1024
+
+try:
+    _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    _libc.inotify_init1.argtypes = [ctypes.c_int]
+    _libc.inotify_init1.restype = ctypes.c_int
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+        ctypes.c_uint32]
+    _libc.inotify_add_watch.restype = ctypes.c_int
+    _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    _libc.inotify_rm_watch.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _libc = None
+
+
+class WatcherError(Exception): pass
+
+
+def is_available():
+    """Tells whether this system supports watching the searchpath."""
+    return _libc is not None
+
+
+def _check(result, path=None):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path) if path else OSError(e,
+            os.strerror(e))
+    return result
+
+
+
+class Inotify(object):
+    """Thin wrapper around an inotify instance.  Raises WatcherError if inotify
+    isn't available."""
+
+    def __init__(self):
+        if _libc is None:
+            raise WatcherError("inotify isn't available on this system.")
+        self.fd = _check(_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+
+    def add_watch(self, path, mask):
+        """Starts watching "path" for the events in "mask".  Returns the watch
+        descriptor that events will come with."""
+        return _check(_libc.inotify_add_watch(self.fd, path, mask), path)
+
+
+    def rm_watch(self, wd):
+        # The watch may already be gone along with its directory.
+        _libc.inotify_rm_watch(self.fd, wd)
+
+
+    def read(self, timeout=None):
+        """Waits up to "timeout" seconds (or forever, if None) for events and
+        returns a list of (wd, mask, cookie, name) tuples, which is empty if
+        there were none in time."""
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return []
+            data = os.read(self.fd, _READ_SIZE)
+        except (select.error, OSError) as e:
+            if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                return []
+            raise
+        events = []
+        i = 0
+        while i < len(data):
+            wd, mask, cookie, n = _event.unpack_from(data, i)
+            i += _event.size
+            events.append((wd, mask, cookie, data[i:i+n].rstrip('\0')))
+            i += n
+        return events
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+class LocalWatcher(object):
+    """Watches every directory of packages.get_searchpath_full(), and those
+    below them, applying changes to PNDs in them to the local table.  Call poll
+    repeatedly, or run, to act on them; call close when done.  "delay" is the
+    number of quiet seconds to wait for before acting on events (see
+    COALESCE_DELAY).  Raises WatcherError if inotify isn't available."""
+
+    def __init__(self, delay=COALESCE_DELAY):
+        self.delay = delay
+        self._inotify = Inotify()
+        self._dirs = {} # Watch descriptor to directory path.
+        self._wds = {}  # Directory path to watch descriptor.
+        # Paths to look at when events stop: files that may have changed or
+        # gone, and directories whose contents may have.
+        self._pending = set()
+        self._overflow = False
+        self._last_refresh = None
+        self.refresh(initial=True)
+
+
+    def close(self):
+        self._inotify.close()
+
+
+    def refresh(self, initial=False):
+        """Starts watching any searchpath directories not yet watched, such as
+        those whose SD card has just been inserted.  PNDs in them are added to
+        the local table by the next poll, unless "initial" is True, in which
+        case update_local is assumed to have been run already."""
+        self._last_refresh = time.time()
+        for path in packages.get_searchpath_full():
+            # Work with bytestrings, as libpnd and the local table do.
+            if isinstance(path, unicode):
+                path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+            if os.path.isdir(path) and path not in self._wds:
+                self._watch_tree(path, not initial)
+
+
+    def _watch_tree(self, top, new=True):
+        """Watches "top" and every directory below it.  If "new", the tree's
+        contents are also marked to be looked at."""
+        if new:
+            self._pending.add(top)
+        for dirpath, dirnames, filenames in os.walk(top):
+            if dirpath not in self._wds:
+                try:
+                    wd = self._inotify.add_watch(dirpath, WATCH_MASK)
+                except OSError as e:
+                    warnings.warn("Could not watch %s: %s" % (dirpath, repr(e)))
+                    continue
+                self._dirs[wd] = dirpath
+                self._wds[dirpath] = wd
+            if new:
+                self._pending.update(os.path.join(dirpath, f) for f in filenames
+                    if f.lower().endswith(database_update.PND_EXT))
+
+
+    def _unwatch_tree(self, top):
+        """Stops watching "top" and every directory below it."""
+        for path in [ p for p in self._wds
+                if p == top or p.startswith(top + os.sep) ]:
+            wd = self._wds.pop(path)
+            del self._dirs[wd]
+            self._inotify.rm_watch(wd)
+
+
+    def _handle(self, events):
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self._overflow = True
+                continue
+            d = self._dirs.get(wd)
+            if d is None:
+                continue
+            if mask & (GONE_MASK | IN_IGNORED):
+                # Anything from here has gone with it.
+                self._pending.add(d)
+                self._unwatch_tree(d)
+                continue
+            path = os.path.join(d, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+                else:
+                    self._pending.add(path)
+                    self._unwatch_tree(path)
+            elif name.lower().endswith(database_update.PND_EXT):
+                self._pending.add(path)
+
+
+    def poll(self, timeout=None):
+        """Waits up to "timeout" seconds (or forever, if None) for changes to
+        PNDs.  Once some have been seen, waits until events stop coming for
+        "delay" seconds (or for MAX_DELAY in total) and applies them to the
+        local table.  Returns lists of the paths of PNDs added or updated and of
+        those removed, which are both empty if nothing changed in time."""
+        start = time.time()
+        first = None # When the events being coalesced started.
+        while True:
+            now = time.time()
+            if first is None and (self._pending or self._overflow):
+                first = now
+            if first is not None:
+                wait = min(self.delay, first + MAX_DELAY - now)
+            else:
+                wait = self._last_refresh + REFRESH_INTERVAL - now
+                if timeout is not None:
+                    wait = min(wait, start + timeout - now)
+            events = self._inotify.read(max(0, wait))
+            self._handle(events)
+
+            now = time.time()
+            if first is not None and (not events or now >= first + MAX_DELAY):
+                return self._apply()
+            if self._pending or self._overflow:
+                continue
+            if now >= self._last_refresh + REFRESH_INTERVAL:
+                self.refresh()
+            elif timeout is not None and now >= start + timeout:
+                return [], []
+
+
+    def run(self, callback=None):
+        """Applies changes as they happen, forever.  "callback", if given, is
+        called with the lists given by poll after each change."""
+        while True:
+            updated, removed = self.poll()
+            if callback is not None and (updated or removed):
+                callback(updated, removed)
+
+
+    def _apply(self):
+        pending, self._pending = self._pending, set()
+        if self._overflow:
+            self._overflow = False
+            return self._rescan()
+
+        # Paths are bytestrings, so keep them that way.
+        with database.transaction(database.BYTES) as db:
+            cached = dict( (i[0], tuple(i)[1:]) for i in db.execute(
+                'Select path, size, mtime, inode, md5, icon From "%s"'
+                % database_update.LOCAL_FILES_TABLE) )
+
+        # Sort out what's changed, and read and hash the changed PNDs, before
+        # taking the database again just to write the results.
+        todo, removed = [], []
+        for path in sorted(pending):
+            try: st = os.stat(path)
+            except OSError: st = None
+
+            if st is not None and stat.S_ISREG(st.st_mode):
+                c = cached.get(path)
+                if (c is None or c[:3] != database_update.stat_key(st)
+                        or not c[3] or c[4] is None):
+                    todo.append(path)
+            else:
+                # A directory's contents, or whatever used to be here.
+                gone = [ p for p in cached if (p == path or
+                    p.startswith(path + os.sep)) and not os.path.isfile(p) ]
+                removed.extend(gone)
+                for p in gone:
+                    del cached[p]
+
+        updated, entries = [], []
+        hashes = dict( (p, (c[:3], c[3])) for p, c in cached.iteritems() )
+        for path, key, row, icon, error in database_update.scan_local_files(
+                todo, hashes):
+            if error is None:
+                entries.append((path, key, row, icon))
+                updated.append(path)
+            else:
+                warnings.warn("Could not process %s: %s" % (path, error))
+                # Don't keep what the file used to hold.
+                if path in cached:
+                    removed.append(path)
+
+        if removed or entries:
+            with database.transaction(database.BYTES) as db:
+                database_update.forget_local_files(db, removed)
+                database_update.write_local_files(db, entries)
+        return updated, removed
+
+
+    def _rescan(self):
+        """Falls back on update_local when events have been lost."""
+        def paths():
+            with database.transaction(database.BYTES) as db:
+                return set( i[0] for i in db.execute('Select path From "%s"'
+                    % database_update.LOCAL_FILES_TABLE) )
+        before = paths()
+        updated = []
+        def observer(event):
+            if event.kind == progress.PND_SCANNED and event.changed:
+                updated.append(event.path)
+        database_update.update_local(observer=observer)
+        return updated, sorted(before - paths())
@@ -1,7 +1,7 @@
 """This package provides the graphical user interface to PNDstore."""
 
 import gtk, os.path, warnings, threading, time
-from pndstore_core import database_update, packages
+from pndstore_core import options, database_update, packages, progress
 
 class PNDstore(object):
     "The main GUI object that does all the work."
@@ -189,8 +189,8 @@ class PNDstore(object):
 
         checks = {}
         for p in pkgs:
-            b = gtk.CheckButton(u'%s %s \u2192 %s' % (p.local.db_entry['title'],
-                p.local.version, p.get_latest().version))
+            b = gtk.CheckButton(u'%s %s \u2192 %s' % (p.title, p.local_version,
+                p.remote_version))
             b.set_active(True)
             checks[p] = b
             d.vbox.pack_start(b)
@@ -205,12 +205,12 @@ class PNDstore(object):
                     for p in pkgs:
                         if checks[p].get_active():
                             self.statusbar.push(self.cid, 'Upgrading %s...' %
-                                p.local.db_entry['title'])
+                                p.title)
                             try:
                                 p.upgrade()
                             except Exception as e:
                                 self.show_error( 'Failed to upgrade %s: %s' %
-                                    (p.local.db_entry['title'], repr(e)) )
+                                    (p.title, repr(e)) )
                             finally:
                                 self.statusbar.pop(self.cid)
 
@@ -226,6 +226,22 @@ class PNDstore(object):
         # Make sure this isn't running already.
         if self.op_thread.is_alive(): return
 
+        n_repos = len(options.get_repos())
+        repos_done = [0]
+
+        def show_progress(event):
+            # Replace the status message with one showing how far along it is.
+            if event.kind in (progress.REPO_FINISHED, progress.REPO_SKIPPED):
+                repos_done[0] += 1
+                msg = 'Updating remote package list... (%d of %d repositories)' % (
+                    repos_done[0], n_repos)
+            elif event.kind == progress.PND_SCANNED:
+                msg = 'Updating local package list... (%d of %d PNDs)' % (
+                    event.count, event.total)
+            else: return
+            self.statusbar.pop(self.cid)
+            self.statusbar.push(self.cid, msg)
+
         class ThreadUpdates(threading.Thread):
             def run(thread):
 
@@ -234,12 +250,12 @@ class PNDstore(object):
 
                     self.statusbar.push(self.cid,
                         'Updating remote package list...')
-                    database_update.update_remote()
+                    database_update.update_remote(observer=show_progress)
                     self.statusbar.pop(self.cid)
 
                     self.statusbar.push(self.cid,
                         'Updating local package list...')
-                    database_update.update_local()
+                    database_update.update_local(observer=show_progress)
                     self.statusbar.pop(self.cid)
 
                 self.update_treeview()
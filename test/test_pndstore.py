@@ -6,7 +6,10 @@ import unittest, shutil, os.path, locale, sqlite3, ctypes, shutil, warnings
 
 import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
-from pndstore_core import options, database_update, packages, libpnd
+from pndstore_core import options, database_update, packages, libpnd, jsonstream
+from pndstore_core import httpclient, progress, watcher, images, database
+import json, zlib, gzip, urllib2, threading, BaseHTTPServer, SocketServer
+from StringIO import StringIO
 
 # Latest repo version; only latest gets tested (for now).
 repo_version = 3.0
@@ -15,6 +18,22 @@ repo_version = 3.0
 testfiles = os.path.join(os.path.dirname(__file__), 'testdata')
 
 
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # Clients dropping connections is expected; don't spam the test output.
+    def handle_error(self, request, client_address): pass
+
+def start_server(handler):
+    """Serves HTTP on localhost with the given request handler class in a
+    background thread.  Returns the server and its base URL; call shutdown and
+    server_close on the server when done."""
+    server = ThreadedHTTPServer(('127.0.0.1', 0), handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, 'http://127.0.0.1:%d/' % server.server_port
+
+
 
 class TestOptions(unittest.TestCase):
     def setUp(self):
@@ -60,6 +79,46 @@ class TestOptions(unittest.TestCase):
             'http://secondurl','ftp://thirdurl','http://fourthurl'])
 
 
+    def testUpdateSettings(self):
+        # The default config and the fallbacks for older configs should agree.
+        self.assertEqual(options.get_update_threads(),
+            options.DEFAULT_UPDATE_THREADS)
+        self.assertEqual(options.get_repo_timeout(), options.DEFAULT_REPO_TIMEOUT)
+        self.assertEqual(options.get_scan_processes(),
+            options.DEFAULT_SCAN_PROCESSES)
+        self.assertEqual(options.get_hash_threads(),
+            options.DEFAULT_HASH_THREADS)
+        self.assertEqual(options.get_image_cache_size(),
+            options.DEFAULT_IMAGE_CACHE_SIZE)
+        self.assertEqual(options.get_db_journal_mode(), 'wal')
+        self.assertEqual(options.get_db_synchronous(), 'normal')
+        self.assertEqual(options.get_db_busy_timeout(),
+            options.DEFAULT_DB_BUSY_TIMEOUT)
+        with open(options.get_cfg(), 'w') as cfg:
+            cfg.write(
+"""{
+    "repositories": [],
+    "locales": ["default"],
+    "searchpath": ["default"],
+    "update_threads": 0,
+    "repo_timeout": 2.5,
+    "scan_processes": 0,
+    "hash_threads": 0,
+    "image_cache_size": -1,
+    "db_journal_mode": "DELETE",
+    "db_synchronous": "full; Drop Table local"
+}""")
+        self.assertEqual(options.get_update_threads(), 1)
+        self.assertEqual(options.get_repo_timeout(), 2.5)
+        # Zero means one per CPU.
+        self.assertGreaterEqual(options.get_scan_processes(), 1)
+        self.assertEqual(options.get_hash_threads(), 1)
+        self.assertEqual(options.get_image_cache_size(), 0)
+        self.assertEqual(options.get_db_journal_mode(), 'delete')
+        # Anything unknown, which could do harm in a pragma, is ignored.
+        self.assertEqual(options.get_db_synchronous(), 'normal')
+
+
     def testLocale(self):
         # Should return list in desired order, always ending with en_US.
         # If no list is specified, should return (system lang, en_US).
@@ -274,6 +333,306 @@ class TestDatabaseUpdate(unittest.TestCase):
         # TODO: Test database updating (namely, removal of apps).
 
 
+    def testUpdateRemoteThreads(self):
+        # Serial and concurrent updates must give the same results.
+        database_update.update_remote(threads=1)
+        for r in options.get_repos():
+            self._check_entries(r)
+        database_update.update_remote(threads=4)
+        for r in options.get_repos():
+            self._check_entries(r)
+        self.assertEqual(packages.get_remote_tables(), options.get_repos())
+
+
+    def testDifferentialUpdate(self):
+        database_update.update_remote()
+        url = options.get_repos()[0]
+        # Change one package, drop the other, and add a new one.
+        path = url[len('file://'):]
+        repo = json.load(open(path))
+        repo['packages'][0]['version']['major'] = '5'
+        new = dict(repo['packages'][1], id='new.package')
+        repo['packages'][1] = new
+        with open(path, 'w') as f:
+            json.dump(repo, f)
+
+        with sqlite3.connect(options.get_database()) as db:
+            database_update.create_table(db, 'before')
+            db.execute('Insert Into "before" Select * From "%s"' % url)
+            db.commit()
+            database_update.update_remote_url(url, db.cursor(), True)
+            # Shadow table must be gone and the catalog complete.
+            self.assertIsNone(db.execute('''Select * From sqlite_master
+                Where name=?''', (url + database_update.SHADOW_SUFFIX,)
+                ).fetchone())
+            self.assertEqual(db.execute('Select id, version From "%s"' % url
+                ).fetchall(), [('viceVIC.pickle', '5.2.1.3'),
+                ('new.package', '9.3b.3.6.beta')])
+
+            # Going back to the old catalog undoes each change.
+            self.assertEqual(database_update.apply_shadow_table(db.cursor(),
+                url, 'before'), (1, 1, 1))
+            self.assertEqual(database_update.apply_shadow_table(db.cursor(),
+                url, 'before'), (0, 0, 0))
+            # Other repos' packages are untouched.
+            self.assertEqual(db.execute('''Select Count(*) From packages
+                Where repo=?''', (options.get_repos()[1],)).fetchone()[0], 2)
+        self._check_entries(url)
+        self._check_entries(options.get_repos()[1])
+
+
+    def testMigrateRepoTables(self):
+        database_update.update_remote()
+        url = options.get_repos()[0]
+        # Put the repo back in a table of its own, as older versions kept it.
+        with sqlite3.connect(options.get_database()) as db:
+            rows = db.execute('Select * From "%s"' % url).fetchall()
+            db.execute('Drop View "%s"' % url)
+            database_update.create_table(db, url)
+            db.executemany(database_update.insert_sql(url), rows)
+            db.execute('Delete From packages Where repo=?', (url,))
+        reload(database_update)
+
+        with sqlite3.connect(options.get_database()) as db:
+            self.assertEqual(db.execute('''Select type From sqlite_master
+                Where name=?''', (url,)).fetchone()[0], 'view')
+            self.assertEqual(db.execute('Select * From "%s"' % url).fetchall(),
+                rows)
+        self._check_entries(url)
+
+
+    def testFeedHash(self):
+        # A server that gives no ETag or Last-Modified header.
+        body = self.repotxt % ('hashed', repo_version)
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args): pass
+        server, url = start_server(Handler)
+        try:
+            with sqlite3.connect(options.get_database()) as db:
+                self.assertEqual(
+                    database_update.update_remote_url(url, db.cursor()), 2)
+                self._check_entries(url)
+                db.execute('Update "%s" Set last_update=0' %
+                    database_update.REPO_INDEX_TABLE)
+                db.execute('Update packages Set title="Changed" Where repo=?',
+                    (url,))
+                db.commit()
+
+                # Same feed, so nothing gets parsed, but it still counts as
+                # an update.
+                self.assertEqual(
+                    database_update.update_remote_url(url, db.cursor()), 0)
+                self.assertEqual(db.execute('Select title From "%s"' % url
+                    ).fetchone()[0], 'Changed')
+                self.assertNotEqual(db.execute('''Select last_update From "%s"
+                    Where url=?''' % database_update.REPO_INDEX_TABLE, (url,)
+                    ).fetchone()[0], 0)
+                # No feed is kept by default.
+                self.assertEqual(os.listdir(options.get_feed_dir()), [])
+
+                # Unless the update is forced.
+                self.assertEqual(database_update.update_remote_url(url,
+                    db.cursor(), True), 2)
+                self._check_entries(url)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    def testReingest(self):
+        url = options.get_repos()[0]
+        with sqlite3.connect(options.get_database()) as db:
+            self.assertRaises(database_update.RepoError,
+                database_update.reingest_remote_url, url, db.cursor())
+
+        with open(options.get_cfg()) as f:
+            cfg = json.load(f)
+        cfg['keep_feeds'] = True
+        with open(options.get_cfg(), 'w') as f:
+            json.dump(cfg, f)
+        database_update.update_remote()
+
+        # Once kept, the feed can be reread even if its source is gone.
+        os.remove(url[len('file://'):])
+        with sqlite3.connect(options.get_database()) as db:
+            db.execute('Delete From packages Where repo=?', (url,))
+            db.commit()
+            self.assertEqual(
+                database_update.reingest_remote_url(url, db.cursor()), 2)
+        self._check_entries(url)
+
+
+    def testProgress(self):
+        events = []
+        timings = progress.Timings()
+        def observer(event):
+            events.append(event)
+            timings(event)
+        database_update.update_remote(threads=1, observer=observer)
+        repos = options.get_repos()
+        sizes = dict((r, os.path.getsize(r[len('file://'):])) for r in repos)
+
+        self.assertEqual(events[0].kind, progress.PHASE_STARTED)
+        self.assertEqual(events[0].phase, progress.REMOTE_PHASE)
+        self.assertEqual(events[-1].kind, progress.PHASE_FINISHED)
+        self.assertEqual(events[-1].phase, progress.REMOTE_PHASE)
+        self.assertEqual([ (e.kind, e.repo) for e in events if e.kind in
+                (progress.REPO_STARTED, progress.REPO_FINISHED) ],
+            [(progress.REPO_STARTED, repos[0]), (progress.REPO_FINISHED, repos[0]),
+            (progress.REPO_STARTED, repos[1]), (progress.REPO_FINISHED, repos[1])])
+        for e in events:
+            if e.kind == progress.BYTES_RECEIVED:
+                self.assertLessEqual(e.bytes, sizes[e.repo])
+            if e.kind == progress.REPO_FINISHED:
+                self.assertEqual(e.packages, 2)
+
+        self.assertEqual(timings.bytes, sum(sizes.values()))
+        self.assertEqual(timings.rows, 4)
+        self.assertEqual(sorted(timings.repos), sorted(repos))
+        self.assertEqual(set(timings.phases), set((progress.REMOTE_PHASE,
+            progress.FETCH_PHASE, progress.APPLY_PHASE)))
+
+        # A broken observer only gives warnings.
+        def broken(event): raise RuntimeError
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            database_update.update_remote(observer=broken)
+            self.assertTrue(w)
+            self.assertIn('Progress observer failed', str(w[0].message))
+        for r in repos:
+            self._check_entries(r)
+
+
+    def _update_cfg(self, **values):
+        with open(options.get_cfg()) as f:
+            cfg = json.load(f)
+        cfg.update(values)
+        with open(options.get_cfg(), 'w') as f:
+            json.dump(cfg, f)
+
+
+    def testRetries(self):
+        # A server that's unavailable for its first two requests.
+        body = self.repotxt % ('flaky', repo_version)
+        requests = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                if len(requests) <= 2:
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args): pass
+        server, url = start_server(Handler)
+        self._update_cfg(repositories=[url], repo_retry_delay=0.01)
+        try:
+            events = []
+            database_update.update_remote(observer=events.append)
+            self.assertEqual(len(requests), 3)
+            self.assertEqual([ (e.attempt, e.delay) for e in events
+                if e.kind == progress.REPO_RETRYING ], [(1, 0.01), (2, 0.02)])
+            self._check_entries(url)
+
+            # Retries can be turned off per repo.
+            del requests[:]
+            self._update_cfg(repo_settings={url: {'repo_retries': 0}})
+            with sqlite3.connect(options.get_database()) as db:
+                with warnings.catch_warnings(record=True) as w:
+                    warnings.simplefilter('always')
+                    self.assertIsNone(database_update.update_remote_url(url,
+                        db.cursor(), True))
+                    self.assertIn('Could not reach repo', str(w[0].message))
+            self.assertEqual(len(requests), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Error responses are finished off, whether retried or raised.
+        bodies = []
+        def fail():
+            bodies.append(StringIO('Try again later'))
+            raise urllib2.HTTPError(url, 503, 'Unavailable', {}, bodies[-1])
+        self.assertRaises(urllib2.HTTPError, database_update.open_with_retries,
+            fail, url, 1)
+        self.assertEqual(len(bodies), 2)
+        self.assertTrue(all( b.closed for b in bodies ))
+
+
+    def testTimeout(self):
+        # A server that never answers.
+        done = threading.Event()
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                done.wait(10)
+            def log_message(self, *args): pass
+        server, url = start_server(Handler)
+        self._update_cfg(repositories=[url], repo_timeout=0.2, repo_retries=0)
+        try:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                database_update.update_remote()
+                self.assertEqual(len(w), 1)
+                self.assertIn('timed out', str(w[0].message))
+        finally:
+            done.set()
+            server.shutdown()
+            server.server_close()
+
+
+    def testCooldown(self):
+        url = options.get_repos()[0]
+        path = url[len('file://'):]
+        good = open(path).read()
+        with open(path, 'w') as f:
+            f.write('Not a feed.')
+        self._update_cfg(repo_cooldown=100)
+
+        def index():
+            with sqlite3.connect(options.get_database()) as db:
+                db.row_factory = sqlite3.Row
+                return db.execute('Select * From "%s" Where url=?'
+                    % database_update.REPO_INDEX_TABLE, (url,)).fetchone()
+
+        for i in xrange(database_update.FAILURES_BEFORE_COOLDOWN):
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                database_update.update_remote()
+                self.assertEqual(len(w), 1)
+                self.assertIn('Could not process', str(w[0].message))
+            self.assertEqual(index()['failures'], i + 1)
+            self.assertIn('ValueError', index()['last_error'])
+        i = index()
+        self.assertAlmostEqual(i['retry_after'], i['last_failure'] + 100)
+
+        # Now the repo is skipped, even once it works again.
+        with open(path, 'w') as f:
+            f.write(good)
+        events = []
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            database_update.update_remote(observer=events.append)
+            self.assertEqual(len(w), 1)
+            self.assertIn('Skipping repo', str(w[0].message))
+        self.assertIn(url, [ e.repo for e in events
+            if e.kind == progress.REPO_SKIPPED ])
+        self.assertNotIn(url, [ e.repo for e in events
+            if e.kind == progress.REPO_STARTED ])
+        self.assertRaises(TypeError, self._check_entries, url)
+
+        # Unless told otherwise; success clears the record.
+        database_update.update_remote(ignore_cooldown=True)
+        self._check_entries(url)
+        self.assertEqual(index()['failures'], 0)
+        self.assertIsNone(index()['retry_after'])
+        self.assertIsNone(index()['last_error'])
+
+
     def testBadRemote(self):
         with sqlite3.connect(options.get_database()) as db:
             c = db.cursor()
@@ -314,6 +673,51 @@ class TestDatabaseUpdate(unittest.TestCase):
         #TODO: Test for malformed fields: uri, icon, md5.
 
 
+    def testTruncatedRemote(self):
+        database_update.update_remote()
+        # A feed that breaks partway through must leave the old table alone.
+        repo0 = os.path.join(options.get_working_dir(),
+            os.path.basename(options.get_repos()[0]))
+        with open(repo0) as r: txt = r.read()
+        with open(repo0, 'w') as r: r.write(txt[:len(txt)//2])
+        with sqlite3.connect(options.get_database()) as db:
+            self.assertRaises(ValueError, database_update.update_remote_url,
+                options.get_repos()[0], db.cursor(), True)
+        self._check_entries(options.get_repos()[0])
+
+
+    def testUpdatesOnly(self):
+        database_update.update_remote()
+        url = options.get_repos()[0]
+        delta = os.path.join(options.get_working_dir(), 'delta%time%.json')
+        with sqlite3.connect(options.get_database()) as db:
+            db.execute('Update "%s" Set updates_url=? Where url=?'
+                % database_update.REPO_INDEX_TABLE, ('file://' + delta, url))
+            t = db.execute('Select last_update From "%s" Where url=?'
+                % database_update.REPO_INDEX_TABLE, (url,)).fetchone()[0]
+        repo = json.loads(self.repotxt % ('delta', repo_version))
+        repo['packages'] = repo['packages'][1:]
+        repo['packages'][0]['version']['major'] = '10'
+        txt = json.dumps(repo)
+
+        # A broken delta is read in full before any of it is written.
+        with open(delta.replace('%time%', str(t)), 'w') as f:
+            f.write(txt[:-10])
+        with sqlite3.connect(options.get_database()) as db:
+            self.assertRaises(ValueError, database_update.update_remote_url,
+                url, db.cursor(), False)
+        self._check_entries(url)
+
+        with open(delta.replace('%time%', str(t)), 'w') as f:
+            f.write(txt)
+        with sqlite3.connect(options.get_database()) as db:
+            self.assertEqual(database_update.update_remote_url(url,
+                db.cursor(), False), 1)
+            self.assertEqual(db.execute('Select id, version From "%s"' % url
+                ).fetchall(), [('viceVIC.pickle', '4.2.1.3'),
+                ('Different VICE', '10.3b.3.6.beta')])
+
+
     def testMissingRemote(self):
         # Add extra non-existent URL to middle of config.
         with open(options.get_cfg()) as f:
@@ -355,7 +759,7 @@ class TestDatabaseUpdate(unittest.TestCase):
         self.assertEqual(i['description'], "A solo entry by pymike for PyWeek #8")
         self.assertEqual(i['icon'], 'data/logo.png')
         self.assertEqual(i['uri'], os.path.join(testfiles, 'BubbMan2.pnd'))
-        #self.assertEqual(i['md5'], '84c81afa183561f0bb7b2db692646833')
+        self.assertEqual(i['md5'], '84c81afa183561f0bb7b2db692646833')
         self.assertEqual(i['vendor'], None)
         self.assertEqual(i['rating'], None)
         self.assertEqual(i['applications'], 'bubbman2')
@@ -375,7 +779,7 @@ class TestDatabaseUpdate(unittest.TestCase):
         self.assertEqual(i['description'], "A vectorial shooter")
         self.assertEqual(i['icon'], 'icon.png')
         self.assertEqual(i['uri'], os.path.join(testfiles, 'Sparks-0.4.2.pnd'))
-        #self.assertEqual(i['md5'], 'fb10014578bb3f0c0ae8e88a0fd81121')
+        self.assertEqual(i['md5'], 'fb10014578bb3f0c0ae8e88a0fd81121')
         self.assertEqual(i['vendor'], None)
         self.assertEqual(i['rating'], None)
         self.assertEqual(i['applications'], 'sparks')
@@ -391,13 +795,13 @@ class TestDatabaseUpdate(unittest.TestCase):
         self.assertEqual(i['author_name'], "Randy Heydon")
         self.assertEqual(i['author_website'],
             "http://randy.heydon.selfip.net/Programs/The Lonely Tower/")
-        self.assertEqual(i['author_email'], None)
+        self.assertEqual(i['author_email'], "randy.heydon@clockworklab.net")
         self.assertEqual(i['title'], "The Lonely Tower")
         self.assertEqual(i['description'], "A dumb arty game made for a competition.")
         self.assertEqual(i['icon'],
             'lonelytower/assets/male-brunette-angry-listening-notrans.png')
         self.assertEqual(i['uri'], os.path.join(testfiles, 'The Lonely Tower-2.2.pnd'))
-        #self.assertEqual(i['md5'], '0314d0f7055052cd91ec608d63acad2a')
+        self.assertEqual(i['md5'], '0314d0f7055052cd91ec608d63acad2a')
         self.assertEqual(i['vendor'], None)
         self.assertEqual(i['rating'], None)
         self.assertEqual(i['applications'], 'the-lonely-tower')
@@ -418,18 +822,17 @@ class TestDatabaseUpdate(unittest.TestCase):
             "This is a really verbose package with a whole lot of stuff from 2 different sources, mixing different things, having stuff in ways sometimes making use of stuff, often not.")
         self.assertEqual(i['icon'], "my-icon.png")
         self.assertEqual(i['uri'], os.path.join(testfiles, 'fulltest.pnd'))
-        #self.assertEqual(i['md5'], '201f7b98cc4933cd728087b548035b71')
+        self.assertEqual(i['md5'], '201f7b98cc4933cd728087b548035b71')
         self.assertEqual(i['vendor'], None)
         self.assertEqual(i['rating'], None)
         self.assertEqual(i['applications'],
             'sample-app1;sample-app2;sample-app3')
         self.assertEqual(i['previewpics'],
             'preview-image.png;application_1.png;different-preview-image.png')
-        # TODO: Add support for license reading, then enable these tests.
-        #self.assertEqual(i['licenses'],
-        #    'I do as I please;other;Qt-commercial;public domain;GPLv2+;GPLv2+')
-        #self.assertEqual(i['source'],
-        #    'git://git.openpandora.org;http://pandora.org/sources/package.tar.bz2')
+        self.assertEqual(i['licenses'],
+            'I do as I please;other;Qt-commercial;public domain;GPLv2+;GPLv2+')
+        self.assertEqual(i['source'], 'git://git.openpandora.org/special_project;'
+            'http://pandora.org/sources/package.tar.bz2')
         self.assertEqual(i['categories'],
             "Game;Emulator;System;Emulator;Game;StrategyGame;System")
         c = db.execute('Select * From "%s" Where id="chromium-dev"'
@@ -445,7 +848,7 @@ class TestDatabaseUpdate(unittest.TestCase):
             u"Chromium is an open-source browser project that aims to build a safer, faster, and more stable way for all users to experience the web. This site contains design documents, architecture overviews, testing information, and more to help you learn to build and work with the Chromium source code.\u201d.")
         self.assertEqual(i['icon'], "product_logo_48.png")
         self.assertEqual(i['uri'], os.path.join(testfiles, 'Chromium-dev.pxml.pnd'))
-        #self.assertEqual(i['md5'], 'ec93f8e51b50be4ee51d87d342a6028a')
+        self.assertEqual(i['md5'], 'ec93f8e51b50be4ee51d87d342a6028a')
         self.assertEqual(i['vendor'], None)
         self.assertEqual(i['rating'], None)
         self.assertEqual(i['applications'], 'chromium-dev')
@@ -457,6 +860,677 @@ class TestDatabaseUpdate(unittest.TestCase):
         # TODO: Test for bad conditions that could cause segfaults.
 
 
+    def testFindLocalFiles(self):
+        top = os.path.join(options.get_working_dir(), 'pnds')
+        sub = os.path.join(top, 'sub')
+        os.makedirs(os.path.join(sub, 'deeper'))
+        for path in ('a.pnd', 'readme.txt', 'sub/B.PND', 'sub/deeper/c.pnd'):
+            with open(os.path.join(top, path), 'w') as f:
+                f.write('Not really a PND.')
+        # Links to directories aren't followed, so this can't loop, but links
+        # to PNDs are.
+        os.symlink(top, os.path.join(sub, 'loop'))
+        os.symlink(os.path.join(options.get_working_dir(), 'first.json'),
+            os.path.join(top, 'link.pnd'))
+        os.symlink(os.path.join(top, 'a.pnd'), os.path.join(sub, 'a-again.pnd'))
+        os.symlink('missing', os.path.join(top, 'broken.pnd'))
+
+        expected = [ os.path.join(top, p) for p in
+            ('a.pnd', 'link.pnd', 'sub/B.PND', 'sub/deeper/c.pnd') ]
+        found = list(database_update.find_local_files([top]))
+        self.assertEqual([ p for p, st in found ], expected)
+        self.assertEqual(found[1][1].st_size,
+            os.path.getsize(os.path.join(options.get_working_dir(), 'first.json')))
+
+        # Each is found once however the searchpath overlaps, though maybe by
+        # a different link.
+        found = database_update.find_local_files([sub, top + '/*', top,
+            os.path.join(top, 'nonexistent')])
+        self.assertItemsEqual([ os.path.realpath(p) for p, st in found ],
+            map(os.path.realpath, expected))
+
+
+    def testUpdateLocalIncremental(self):
+        # Work on copies, so they can be changed.
+        pnd_dir = os.path.join(options.get_working_dir(), 'pnds')
+        os.mkdir(pnd_dir)
+        for f in ('BubbMan2.pnd', 'Sparks-0.4.2.pnd'):
+            shutil.copy(os.path.join(testfiles, f), pnd_dir)
+        bubbman = os.path.join(pnd_dir, 'BubbMan2.pnd')
+        sparks = os.path.join(pnd_dir, 'Sparks-0.4.2.pnd')
+        self._update_cfg(searchpath=[pnd_dir])
+
+        events = []
+        def read():
+            return sorted(os.path.basename(e.path) for e in events
+                if e.kind == progress.PND_SCANNED and e.changed)
+        def local():
+            with sqlite3.connect(options.get_database()) as db:
+                return db.execute('''Select id, size, modified_time From "%s"
+                    Order By id''' % database_update.LOCAL_TABLE).fetchall()
+
+        database_update.update_local(observer=events.append)
+        self.assertEqual(read(), ['BubbMan2.pnd', 'Sparks-0.4.2.pnd'])
+        st = os.stat(bubbman)
+        self.assertEqual(local()[0], ('bubbman2', st.st_size, int(st.st_mtime)))
+
+        # Nothing has changed, so nothing is read.
+        del events[:]
+        database_update.update_local(observer=events.append)
+        self.assertEqual(read(), [])
+        self.assertEqual(len(local()), 2)
+
+        # Changed files are reread and removed ones are forgotten.
+        os.utime(bubbman, (1000, 1000))
+        os.remove(sparks)
+        del events[:]
+        database_update.update_local(observer=events.append)
+        self.assertEqual(read(), ['BubbMan2.pnd'])
+        self.assertEqual(local(), [('bubbman2', st.st_size, 1000)])
+
+        # A full update reads everything.
+        del events[:]
+        database_update.update_local(observer=events.append, full=True)
+        self.assertEqual(read(), ['BubbMan2.pnd'])
+        self.assertEqual(local(), [('bubbman2', st.st_size, 1000)])
+
+
+    def testUpdateLocalMD5(self):
+        pnd_dir = os.path.join(options.get_working_dir(), 'pnds')
+        os.mkdir(pnd_dir)
+        shutil.copy(os.path.join(testfiles, 'BubbMan2.pnd'), pnd_dir)
+        bubbman = os.path.join(pnd_dir, 'BubbMan2.pnd')
+        self._update_cfg(searchpath=[pnd_dir])
+
+        hashed = []
+        hash_file = database_update.hash_file
+        def counting_hash_file(path):
+            hashed.append(path)
+            return hash_file(path)
+        database_update.hash_file = counting_hash_file
+        def md5s():
+            with sqlite3.connect(options.get_database()) as db:
+                return (db.execute('Select md5 From "%s"'
+                    % database_update.LOCAL_TABLE).fetchall(),
+                    db.execute('Select md5 From "%s"'
+                    % database_update.LOCAL_FILES_TABLE).fetchall())
+        try:
+            database_update.update_local()
+            self.assertEqual(hashed, [bubbman])
+            self.assertEqual(md5s(), ([('84c81afa183561f0bb7b2db692646833',)],
+                [('84c81afa183561f0bb7b2db692646833',)]))
+
+            # Unchanged files keep their sums, even when read again.
+            database_update.update_local(full=True)
+            with database.transaction(database.BYTES) as db:
+                database_update.update_local_file(bubbman, db)
+            self.assertEqual(hashed, [bubbman])
+
+            # Changed ones are hashed again.
+            with open(bubbman, 'ab') as p:
+                p.write('\0')
+            database_update.update_local()
+            self.assertEqual(hashed, [bubbman, bubbman])
+            self.assertEqual(md5s()[0], [(database_update.hash_file(bubbman),)])
+            self.assertNotEqual(md5s()[0],
+                [('84c81afa183561f0bb7b2db692646833',)])
+        finally:
+            database_update.hash_file = hash_file
+
+
+    def testUpdateLocalIcons(self):
+        pnd_dir = os.path.join(options.get_working_dir(), 'pnds')
+        os.mkdir(pnd_dir)
+        for f in ('BubbMan2.pnd', 'The Lonely Tower-2.2.pnd', 'fulltest.pnd'):
+            shutil.copy(os.path.join(testfiles, f), pnd_dir)
+        self._update_cfg(searchpath=[pnd_dir])
+        def icons():
+            with sqlite3.connect(options.get_database()) as db:
+                return dict( (i[0], images.get_path(i[1], images.LOCAL_DIR))
+                    for i in db.execute('Select id, icon From "%s"'
+                    % database_update.LOCAL_FILES_TABLE) )
+
+        database_update.update_local()
+        found = icons()
+        # Icons are what follows the PXML, less any line break.
+        with open(found['bubbman2'], 'rb') as f:
+            self.assertEqual(f.read(), open(os.path.join(testfiles,
+                'BubbMan2.pnd'), 'rb').read().split('</PXML>')[-1])
+        with open(found['the-lonely-tower'], 'rb') as f:
+            self.assertTrue(f.read().startswith('\x89PNG'))
+        self.assertIsNone(found['sample-package'])
+
+        # Icons go when nothing has them any more.
+        os.remove(os.path.join(pnd_dir, 'BubbMan2.pnd'))
+        database_update.update_local()
+        self.assertNotIn('bubbman2', icons())
+        self.assertFalse(os.path.exists(found['bubbman2']))
+        self.assertTrue(os.path.exists(found['the-lonely-tower']))
+
+
+    def testUpdateLocalParallel(self):
+        # Reading PNDs in several processes must give the same results.
+        def local():
+            with sqlite3.connect(options.get_database()) as db:
+                return (db.execute('Select * From "%s" Order By id'
+                    % database_update.LOCAL_TABLE).fetchall(),
+                    db.execute('Select * From "%s" Order By path'
+                    % database_update.LOCAL_FILES_TABLE).fetchall())
+        database_update.update_local(full=True, processes=1)
+        serial = local()
+        database_update.update_local(full=True, processes=3)
+        self.assertEqual(local(), serial)
+        self.assertGreater(len(serial[0]), 1)
+
+
+    def testUpdateLocalUnlocked(self):
+        # Nothing may hold the database while PNDs are read.
+        database_update.update_local()
+        locked = []
+        read_local_file = database_update.read_local_file
+        def checking_read_local_file(path, st, digest=None):
+            writer = sqlite3.connect(options.get_database(), timeout=0)
+            try: writer.execute('Begin Immediate')
+            except sqlite3.OperationalError: locked.append(path)
+            writer.close()
+            return read_local_file(path, st, digest)
+        database_update.read_local_file = checking_read_local_file
+        try:
+            database_update.update_local(full=True, processes=1)
+        finally:
+            database_update.read_local_file = read_local_file
+        self.assertEqual(locked, [])
+
+
+    def testOpenPXML(self):
+        for f in os.listdir(testfiles):
+            if not f.endswith('.pnd'): continue
+            path = os.path.join(testfiles, f)
+            with open(path, 'rb') as p:
+                data = p.read()
+            with database_update.open_pxml(path) as pxml:
+                pxml = str(pxml)
+            # Exactly the PXML, as appended to the end of the file.
+            self.assertTrue(pxml.startswith('<PXML'))
+            self.assertTrue(pxml.endswith('</PXML>'))
+            self.assertEqual(data.rfind(pxml), data.rfind('<PXML'))
+
+        # Files without a PXML fall back on libpnd, which can't find one either.
+        path = os.path.join(options.get_working_dir(), 'empty.pnd')
+        for data in ('', 'Not a PND.'):
+            with open(path, 'wb') as p:
+                p.write(data)
+            with self.assertRaises(database_update.PNDError):
+                with database_update.open_pxml(path): pass
+            # And reading them gives up there, rather than trying libpnd again.
+            with self.assertRaises(database_update.PNDError):
+                database_update.read_local_file(path, os.stat(path))
+
+
+    def testParsePXML(self):
+        with database_update.open_pxml(
+                os.path.join(testfiles, 'fulltest.pnd')) as pxml:
+            pxml = str(pxml)
+        info = database_update.parse_pxml(pxml, ['de_DE', 'en_US'])
+        self.assertEqual(info['title'], 'Beispiel Sammlung')
+        self.assertEqual(info['description'],
+            'Die gleiche Beschreibung wie oben, nur auf deutsch.')
+
+        # Package fields missing from the package element come from the first
+        # application.
+        pxml = pxml.replace('<icon src="my-icon.png"/>\n  </package>',
+            '</package>')
+        self.assertEqual(database_update.parse_pxml(pxml, ['en_US'])['icon'],
+            'my-icon.png')
+        self.assertEqual(database_update.parse_pxml(
+            pxml.replace('my-icon.png', 'other.png', 1), ['en_US'])['icon'],
+            'other.png')
+
+        # Common mistakes are repaired.
+        with database_update.open_pxml(
+                os.path.join(testfiles, 'scummvm-op.pxml.pnd')) as pxml:
+            info = database_update.parse_pxml(pxml, ['en_US'])
+        self.assertEqual(info['description'], 'Point & click game interpreter.')
+
+        with self.assertRaises(database_update.PXMLError):
+            database_update.parse_pxml('<PXML xmlns="%s"><package id="x"/></PXML>'
+                % database_update.PXML_NAMESPACE)
+        with self.assertRaises(SyntaxError):
+            database_update.parse_pxml('<PXML><application></PXML>')
+
+
+
+@unittest.skipUnless(watcher.is_available(), 'inotify not available')
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        options.working_dir = 'temp'
+        reload(database_update)
+        self.pnd_dir = os.path.join(options.get_working_dir(), 'pnds')
+        os.mkdir(self.pnd_dir)
+        with open(options.get_cfg(), 'w') as cfg:
+            json.dump({'repositories': [], 'locales': ['en_US'],
+                'searchpath': [self.pnd_dir]}, cfg)
+        self.watcher = watcher.LocalWatcher(delay=0.1)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(options.working_dir)
+
+    def _local(self):
+        with sqlite3.connect(options.get_database()) as db:
+            return sorted(db.execute('Select id, uri From "%s"'
+                % database_update.LOCAL_TABLE))
+
+
+    def testWatch(self):
+        self.assertEqual(self.watcher.poll(0.2), ([], []))
+
+        bubbman = os.path.join(self.pnd_dir, 'BubbMan2.pnd')
+        shutil.copy(os.path.join(testfiles, 'BubbMan2.pnd'), bubbman)
+        # Other files are ignored.
+        with open(os.path.join(self.pnd_dir, 'readme.txt'), 'w') as f:
+            f.write('Not a PND.')
+        self.assertEqual(self.watcher.poll(5), ([bubbman], []))
+        self.assertEqual(self._local(), [('bubbman2', bubbman)])
+
+        moved = os.path.join(self.pnd_dir, 'moved.pnd')
+        os.rename(bubbman, moved)
+        self.assertEqual(self.watcher.poll(5), ([moved], [bubbman]))
+        self.assertEqual(self._local(), [('bubbman2', moved)])
+
+        # PNDs in new subdirectories are found, and forgotten with them.
+        subdir = os.path.join(self.pnd_dir, 'sub')
+        os.mkdir(subdir)
+        sparks = os.path.join(subdir, 'Sparks-0.4.2.pnd')
+        shutil.copy(os.path.join(testfiles, 'Sparks-0.4.2.pnd'), sparks)
+        self.assertEqual(self.watcher.poll(5), ([sparks], []))
+        shutil.rmtree(subdir)
+        self.assertEqual(self.watcher.poll(5), ([], [sparks]))
+        self.assertEqual(self._local(), [('bubbman2', moved)])
+
+
+    def testCoalesce(self):
+        # A file written bit by bit is only read once it's done.
+        path = os.path.join(self.pnd_dir, 'BubbMan2.pnd')
+        with open(os.path.join(testfiles, 'BubbMan2.pnd'), 'rb') as src:
+            data = src.read()
+        with open(path, 'wb') as dest:
+            for i in xrange(0, len(data), len(data) // 10 + 1):
+                dest.write(data[i:i + len(data) // 10 + 1])
+                dest.flush()
+        os.utime(path, None)
+        self.assertEqual(self.watcher.poll(5), ([path], []))
+        # Events that don't change the file don't cause it to be read again.
+        with open(path, 'ab'): pass
+        self.assertEqual(self.watcher.poll(0.5), ([], []))
+
+
+    def testUnlocked(self):
+        # Nothing may hold the database while PNDs are read.
+        locked = []
+        read_local_file = database_update.read_local_file
+        def checking_read_local_file(path, st, digest=None):
+            writer = sqlite3.connect(options.get_database(), timeout=0)
+            try: writer.execute('Begin Immediate')
+            except sqlite3.OperationalError: locked.append(path)
+            writer.close()
+            return read_local_file(path, st, digest)
+        database_update.read_local_file = checking_read_local_file
+        try:
+            paths = []
+            for f in ('BubbMan2.pnd', 'Sparks-0.4.2.pnd'):
+                paths.append(os.path.join(self.pnd_dir, f))
+                shutil.copy(os.path.join(testfiles, f), paths[-1])
+            self.assertEqual(self.watcher.poll(5), (paths, []))
+        finally:
+            database_update.read_local_file = read_local_file
+        self.assertEqual(locked, [])
+
+
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        options.working_dir = 'temp'
+        reload(database_update)
+
+    def tearDown(self):
+        database.close()
+        shutil.rmtree(options.working_dir)
+
+
+    def testReuse(self):
+        before = database.get_stats()
+        for i in xrange(10):
+            with database.transaction() as db:
+                db.execute('Select 1')
+        after = database.get_stats()
+        self.assertEqual(after['requests'] - before['requests'], 10)
+        self.assertEqual(after['opened'] - before['opened'], 0)
+        # Each thread has its own.
+        dbs = []
+        t = threading.Thread(target=lambda: dbs.append(
+            database.get_connection()))
+        t.start()
+        t.join()
+        self.assertIsNot(dbs[0], database.get_connection())
+        # A new database file gets a new connection.
+        db = database.get_connection()
+        database.close()
+        os.remove(options.get_database())
+        self.assertIsNot(database.get_connection(), db)
+
+
+    def testTransaction(self):
+        def count():
+            with database.transaction() as db:
+                return db.execute('Select Count(*) From "%s"'
+                    % database_update.REPO_INDEX_TABLE).fetchone()[0]
+        def add(db, url):
+            db.execute('Insert Into "%s" (url) Values (?)'
+                % database_update.REPO_INDEX_TABLE, (url,))
+        try:
+            with database.transaction() as db:
+                add(db, 'a')
+                # Nested transactions leave it to the outer one.
+                with database.transaction() as inner:
+                    self.assertIs(inner, db)
+                    add(inner, 'b')
+                raise ValueError
+        except ValueError: pass
+        self.assertEqual(count(), 0)
+        with database.transaction() as db:
+            add(db, 'a')
+        # Committed, so other connections see it.
+        self.assertEqual(sqlite3.connect(options.get_database()).execute(
+            'Select url From "%s"' % database_update.REPO_INDEX_TABLE
+            ).fetchall(), [('a',)])
+
+        with database.transaction() as db:
+            row = db.execute('Select url From "%s"'
+                % database_update.REPO_INDEX_TABLE).fetchone()
+            self.assertIsInstance(row['url'], unicode)
+            with database.transaction(database.BYTES) as db:
+                self.assertIsInstance(db.execute('Select url From "%s"'
+                    % database_update.REPO_INDEX_TABLE).fetchone()[0], str)
+            # The text factory is restored after the inner block.
+            self.assertIsInstance(db.execute('Select url From "%s"'
+                % database_update.REPO_INDEX_TABLE).fetchone()[0], unicode)
+
+
+    def testPragmas(self):
+        with database.transaction() as db:
+            self.assertEqual(db.execute('Pragma journal_mode').fetchone()[0],
+                'wal')
+            # 1 is normal.
+            self.assertEqual(db.execute('Pragma synchronous').fetchone()[0], 1)
+            self.assertEqual(db.execute('Pragma cache_size').fetchone()[0],
+                -options.DEFAULT_DB_CACHE_SIZE // 1024)
+
+
+    def testConcurrentReadWrite(self):
+        # A reader part-way through a query mustn't hold up a writer.
+        with database.transaction() as db:
+            db.executemany('Insert Into "%s" (url) Values (?)'
+                % database_update.REPO_INDEX_TABLE,
+                [ (str(i),) for i in xrange(10) ])
+        with database.transaction() as db:
+            c = db.execute('Select url From "%s"'
+                % database_update.REPO_INDEX_TABLE)
+            c.fetchone()
+            writer = sqlite3.connect(options.get_database(), timeout=0)
+            writer.execute('Insert Into "%s" (url) Values (?)'
+                % database_update.REPO_INDEX_TABLE, ('new',))
+            writer.commit()
+            writer.close()
+            # The reader carries on with what it started with.
+            self.assertEqual(len(c.fetchall()), 9)
+
+
+
+class TestImages(unittest.TestCase):
+    def setUp(self):
+        options.working_dir = 'temp'
+        reload(database_update)
+        self.requests = []
+        self.locked = []
+        requests, locked = self.requests, self.locked
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                # Nothing may hold the database while an image downloads.
+                writer = sqlite3.connect(options.get_database(), timeout=0)
+                try: writer.execute('Begin Immediate')
+                except sqlite3.OperationalError: locked.append(self.path)
+                writer.close()
+                if self.path == '/missing.png':
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.end_headers()
+                # Each image is its path, repeated to a kilobyte.
+                self.wfile.write((self.path * 1024)[:1024])
+            def log_message(self, *args): pass
+        self.server, self.url = start_server(Handler)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(options.working_dir)
+
+
+    def testStore(self):
+        digest = images.store('icon', images.LOCAL_DIR)
+        self.assertEqual(images.store(buffer('icon'), images.LOCAL_DIR), digest)
+        with open(images.get_path(digest, images.LOCAL_DIR)) as f:
+            self.assertEqual(f.read(), 'icon')
+        self.assertIsNone(images.get_path(digest, images.REMOTE_DIR))
+        images.discard([digest], images.LOCAL_DIR)
+        self.assertIsNone(images.get_path(digest, images.LOCAL_DIR))
+
+
+    def testRemoteImage(self):
+        path = images.get_remote_image(self.url + 'a.png')
+        with open(path) as f:
+            self.assertEqual(f.read(), ('/a.png' * 1024)[:1024])
+        # Only downloaded once.
+        self.assertEqual(images.get_remote_image(self.url + 'a.png'), path)
+        self.assertEqual(self.requests, ['/a.png'])
+        self.assertRaises(images.ImageError, images.get_remote_image,
+            self.url + 'missing.png')
+        self.assertEqual(self.locked, [])
+
+
+    def testEviction(self):
+        with open(options.get_cfg(), 'w') as cfg:
+            json.dump({'image_cache_size': 2048}, cfg)
+        last_used = lambda url: database.get_connection().execute(
+            'Select last_used From "%s" Where url=?'
+            % images.REMOTE_IMAGES_TABLE, (self.url + url,)).fetchone()[0]
+        a = images.get_remote_image(self.url + 'a.png')
+        b = images.get_remote_image(self.url + 'b.png')
+        # A use so soon after the last isn't written down.
+        t = last_used('a.png')
+        images.get_remote_image(self.url + 'a.png')
+        self.assertEqual(last_used('a.png'), t)
+        # Once it's been a while, using a makes b the least recently used.
+        with database.transaction() as db:
+            db.execute('Update "%s" Set last_used=? Where url=?'
+                % images.REMOTE_IMAGES_TABLE,
+                (t - images.LAST_USED_RESOLUTION - 1, self.url + 'a.png'))
+        images.get_remote_image(self.url + 'a.png')
+        self.assertGreater(last_used('a.png'), last_used('b.png'))
+        c = images.get_remote_image(self.url + 'c.png')
+        self.assertTrue(os.path.exists(a))
+        self.assertFalse(os.path.exists(b))
+        self.assertTrue(os.path.exists(c))
+        # Evicted images are downloaded again when wanted.
+        images.get_remote_image(self.url + 'b.png')
+        self.assertEqual(self.requests,
+            ['/a.png', '/b.png', '/c.png', '/b.png'])
+        self.assertEqual(self.locked, [])
+
+
+
+class TestJSONStream(unittest.TestCase):
+
+    def testMatchesJSON(self):
+        # Tiny chunks ensure values get split across reads, including in the
+        # middle of multibyte characters.
+        txt = open(os.path.join(testfiles, 'repo.json')).read()
+        for size in (1, 7, 4096):
+            s = jsonstream.RepoStream(StringIO(txt), size)
+            pkgs = list(s.packages())
+            full = json.loads(txt)
+            self.assertEqual(pkgs, full['packages'])
+            del full['packages']
+            self.assertEqual(s.header, full)
+        s = jsonstream.RepoStream(StringIO(
+            '{"packages":[{"title":"\xc3\xa9t\xc3\xa9"}]}'), 1)
+        self.assertEqual(list(s.packages()), [{'title':u'\xe9t\xe9'}])
+
+
+    def testHeaderAfterPackages(self):
+        s = jsonstream.RepoStream(StringIO(
+            '{"packages": [1, 2.5], "repository": {"version": 3.0}, "n": 12}'), 3)
+        self.assertEqual(list(s.packages()), [1, 2.5])
+        self.assertEqual(s.header, {'repository':{'version':3.0}, 'n':12})
+
+
+    def testEmpty(self):
+        for txt in ('{}', '{"packages": []}', '{"packages": null}'):
+            s = jsonstream.RepoStream(StringIO(txt))
+            self.assertEqual(list(s.packages()), [])
+
+
+    def testMalformed(self):
+        for txt in ('', '[]', '{"packages": [1,]}', '{"packages": [1]},',
+                '{"packages": [1] "a": 2}', '{"packages": [{"a": 1}'):
+            s = jsonstream.RepoStream(StringIO(txt), 2)
+            self.assertRaises(ValueError, list, s.packages())
+
+
+
+class TestHTTPClient(unittest.TestCase):
+    data = open(os.path.join(testfiles, 'repo.json')).read()
+
+    def _read_all(self, f, size):
+        out = []
+        for chunk in iter(lambda: f.read(size), ''):
+            out.append(chunk)
+        return ''.join(out)
+
+
+    def testGzip(self):
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as g:
+            g.write(self.data)
+        for size in (1, 100, -1):
+            f = httpclient.DecompressedFile(StringIO(buf.getvalue()), 'gzip', 64)
+            self.assertEqual(self._read_all(f, size), self.data)
+
+
+    def testDeflate(self):
+        z = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = z.compress(self.data) + z.flush()
+        # Both zlib-wrapped and raw deflate streams are seen in the wild.
+        for enc in (zlib.compress(self.data), raw):
+            f = httpclient.DecompressedFile(StringIO(enc), 'deflate', 64)
+            self.assertEqual(self._read_all(f, 1000), self.data)
+
+
+    def testStreamParsing(self):
+        # Decompression must cooperate with incremental feed parsing.
+        f = httpclient.DecompressedFile(StringIO(zlib.compress(self.data)),
+            'deflate', 16)
+        self.assertEqual(list(jsonstream.RepoStream(f, 7).packages()),
+            json.loads(self.data)['packages'])
+
+
+    def testAcceptEncoding(self):
+        req = urllib2.Request('http://example.org')
+        httpclient.DecompressionHandler().http_request(req)
+        self.assertEqual(req.get_header('Accept-encoding'), 'gzip, deflate')
+        # Don't override a caller's explicit choice.
+        req = urllib2.Request('http://example.org',
+            headers={'Accept-encoding':'identity'})
+        httpclient.DecompressionHandler().http_request(req)
+        self.assertEqual(req.get_header('Accept-encoding'), 'identity')
+
+
+    def testConnectionPool(self):
+        class Conn(object):
+            closed = False
+            def close(self): self.closed = True
+        p = httpclient.ConnectionPool(max_idle=1)
+        a, reused = p.get('host', Conn)
+        self.assertFalse(reused)
+        b, reused = p.get('host', Conn)
+        p.put('host', a)
+        p.put('host', b) # Over the limit, so gets closed.
+        self.assertTrue(b.closed)
+        self.assertEqual(p.get('host', Conn), (a, True))
+        self.assertFalse(p.get('other', Conn)[1])
+        self.assertEqual(p.stats, {'requests':4, 'opened':3, 'reused':1})
+
+
+    def testKeepAlive(self):
+        data = self.data
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', len(data))
+                self.end_headers()
+                self.wfile.write(data)
+            def log_message(self, *args): pass
+        server, url = start_server(Handler)
+        try:
+            p = httpclient.ConnectionPool()
+            opener = urllib2.build_opener(httpclient.KeepAliveHandler(p))
+            for i in xrange(3):
+                self.assertEqual(opener.open(url, timeout=5).read(), data)
+            # An unfinished response can't give its connection back.
+            opener.open(url, timeout=5).read(10)
+            self.assertEqual(opener.open(url, timeout=5).read(), data)
+            self.assertEqual(p.stats, {'requests':5, 'opened':2, 'reused':3})
+            p.clear()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    def testHTTPSWithoutContext(self):
+        # Pythons before 2.7.9 have no SSL contexts.  Connections are faked
+        # with plain HTTP, as there's no certificate to test with.
+        data = self.data
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(data)
+            def log_message(self, *args): pass
+        made = []
+        def connection(host, connect_timeout=None, **kwargs):
+            made.append(kwargs)
+            return httpclient.HTTPConnection(host, connect_timeout, **kwargs)
+        server, url = start_server(Handler)
+        old = httpclient.HTTPSConnection
+        httpclient.HTTPSConnection = connection
+        try:
+            handler = httpclient.KeepAliveHTTPSHandler(
+                httpclient.ConnectionPool())
+            if hasattr(handler, '_context'):
+                del handler._context
+            opener = urllib2.build_opener(handler)
+            self.assertEqual(opener.open(url.replace('http:', 'https:'),
+                timeout=5).read(), data)
+            self.assertEqual(made, [{'timeout':5}])
+        finally:
+            httpclient.HTTPSConnection = old
+            server.shutdown()
+            server.server_close()
+
+
 
 class TestLibpnd(unittest.TestCase):
 
@@ -595,6 +1669,34 @@ class TestPackages(unittest.TestCase):
         self.assertLess(v('1.0.3.1'), v('1.1.2.0'))
 
 
+    def testVersionKey(self):
+        # Keys sort just as the versions do.
+        versions = ['1.999', '2.0.0.0', '1.0', '1.1', '2.0a', '2.0', u'2.0a',
+            '2.1a', '2.0.1a', '2.0a.1', '2.0b', '1.0.3.1', '1.1.2.0', '10',
+            '9.9', '1.01', 'beta', '3.4.0+svn.1', '0.9.4.2', 'A']
+        key = database_update.version_key
+        for i in versions:
+            for j in versions:
+                self.assertEqual(cmp(key(i), key(j)),
+                    cmp(packages.PNDVersion(i), packages.PNDVersion(j)),
+                    msg='%r, %r' % (i, j))
+        self.assertIsNone(key(None))
+        self.assertLess(key(''), key('0'))
+
+        # Rows from before keys were kept get them when the database is opened.
+        with sqlite3.connect(options.get_database()) as db:
+            db.execute('Update packages Set version_key=Null')
+            db.execute('Update local Set version_key=Null')
+        reload(database_update)
+        with sqlite3.connect(options.get_database()) as db:
+            for version, k in db.execute('''Select version, version_key
+                    From packages Union All
+                    Select version, version_key From local'''):
+                self.assertEqual(k, key(version))
+        self.assertEqual([ p.id for p in packages.get_updates() ],
+            ['bubbman2'])
+
+
     def testGetRemoteTables(self):
         # Okay, this may seem like a gratuitous function, but it gets around
         # DB quoting issues.  This and options.get_repo will not always produce
@@ -650,6 +1752,88 @@ class TestPackages(unittest.TestCase):
             'package.pcsx_rearmed.notaz.r8'})
 
 
+    def testPackageLists(self):
+        url = options.get_repos()[0]
+        def entries(table, pkgid):
+            with sqlite3.connect(options.get_database()) as db:
+                return sorted( tuple(i) for i in db.execute(
+                    'Select repo, %s From "%s" Where id=?' % (
+                    'appid' if table == database_update.APPLICATIONS_TABLE
+                    else 'category', table), (pkgid,)) )
+        # Both installed and remote packages are listed.
+        self.assertEqual(entries(database_update.APPLICATIONS_TABLE,
+            'bubbman2'), [(url, 'bubbman2'), ('local', 'bubbman2')])
+        self.assertEqual(entries(database_update.CATEGORIES_TABLE,
+            'bubbman2'), [('local', 'ActionGame'), ('local', 'Game')])
+
+        # Forgotten PNDs take their entries with them.
+        path = os.path.join(testfiles, 'BubbMan2.pnd')
+        with database.transaction(database.BYTES) as db:
+            database_update.forget_local_files(db, [path])
+        self.assertEqual(entries(database_update.CATEGORIES_TABLE,
+            'bubbman2'), [])
+        self.assertEqual(
+            packages.search_local_packages('applications', 'bubbman2'), [])
+
+        # Ids are looked up in batches; missing ones count as gone.
+        ids = [ 'missing%d' % i for i in range(database_update.BATCH_SIZE*2) ]
+        with database.transaction(database.BYTES) as db:
+            db.execute('Insert Into "%s" Values (?,?,?)'
+                % database_update.CATEGORIES_TABLE, (url, ids[-1], 'Stale'))
+            database_update.update_package_index(db, url,
+                ids + ['bubbman2'])
+        self.assertEqual(entries(database_update.CATEGORIES_TABLE, ids[-1]),
+            [])
+        self.assertEqual(entries(database_update.APPLICATIONS_TABLE,
+            'bubbman2'), [(url, 'bubbman2')])
+
+        # Databases from before the lists had them filled in.
+        database_update.update_local()
+        with sqlite3.connect(options.get_database()) as db:
+            for table, column, entry in database_update.PACKAGE_LISTS:
+                db.execute('Drop Table "%s"' % table)
+        reload(database_update)
+        self.assertEqual(entries(database_update.APPLICATIONS_TABLE,
+            'bubbman2'), [(url, 'bubbman2'), ('local', 'bubbman2')])
+        ps = packages.search_local_packages('categories', 'ActionGame')
+        self.assertItemsEqual([ p.id for p in ps ],
+            ['bubbman2', 'hexen2.pickle'])
+        # Entries match regardless of case.
+        ps = packages.search_local_packages('categories', 'actionGAME')
+        self.assertItemsEqual([ p.id for p in ps ],
+            ['bubbman2', 'hexen2.pickle'])
+        self.assertEqual([ p.id for p in packages.search_local_packages(
+            'applications', 'BubbMan2') ], ['bubbman2'])
+
+
+    def testSearch(self):
+        ids = lambda ps: [ p.id for p in ps ]
+        # Titles count for more than descriptions.
+        ps = packages.search('sparks')
+        self.assertEqual(ids(ps)[0], 'sparks')
+        self.assertIn('bubbman2', ids(packages.search('pyweek')))
+        self.assertEqual(ids(packages.search('pymike pyweek')), ['bubbman2'])
+        self.assertIn('bubbman2', ids(packages.search('bubb*')))
+        self.assertEqual(packages.search('nothing-like-this-anywhere'), [])
+        self.assertEqual(len(packages.search('game', limit=2)), 2)
+        self.assertRaises(packages.PackageError, packages.search, 'game OR')
+
+        # The index follows local changes.
+        path = os.path.join(testfiles, 'Sparks-0.4.2.pnd')
+        self.assertEqual(ids(packages.search('vectorial')), ['sparks'])
+        with database.transaction(database.BYTES) as db:
+            database_update.forget_local_files(db, [path])
+        self.assertEqual(packages.search('vectorial'), [])
+        database_update.update_local()
+        self.assertEqual(ids(packages.search('vectorial')), ['sparks'])
+
+        # Without an index, every package is looked through instead.
+        database_update.search_available = False
+        self.assertEqual(ids(packages.search('ARTY dumb')),
+            ['the-lonely-tower'])
+        self.assertEqual(ids(packages.search('pymike pyweek')), ['bubbman2'])
+
+
     def testGetAll(self):
         ps = packages.get_all()
         for p in ps:
@@ -669,10 +1853,45 @@ class TestPackages(unittest.TestCase):
         self.assertEqual(len(ps), 11)
 
 
+    def testConnectionReuse(self):
+        # Looking up every package opens no new connections.
+        before = database.get_stats()
+        for p in packages.get_all():
+            p.get_latest()
+        self.assertEqual(database.get_stats()['opened'], before['opened'])
+
+
     def testGetUpdates(self):
+        before = database.get_stats()
         ps = packages.get_updates()
         self.assertEqual(len(ps), 1)
         self.assertEqual(ps[0].id, 'bubbman2')
+        self.assertEqual(ps[0].title, 'BubbMan2')
+        self.assertEqual(ps[0].applications, 'bubbman2')
+        self.assertEqual(ps[0].local_version, '1.0.3.1')
+        self.assertEqual(ps[0].remote_version, '1.0.4.0')
+        self.assertEqual(ps[0].repo, options.get_repos()[0])
+        # All from one query, without looking up whole packages.
+        self.assertEqual(database.get_stats()['requests'] - before['requests'],
+            1)
+        # Which is still there to be had.
+        p = ps[0].package
+        self.assertIsInstance(p, packages.Package)
+        self.assertIs(p.get_latest(), p.get_latest_remote())
+        self.assertEqual(p.get_latest().db_entry['version'],
+            ps[0].remote_version)
+
+
+    def testGetIcon(self):
+        # An installed PND's own icon is used without going to its repo.
+        path = packages.Package('bubbman2').get_icon()
+        self.assertTrue(path.startswith(os.path.abspath(os.path.join(
+            options.get_image_dir(), images.LOCAL_DIR))))
+        with open(path, 'rb') as f:
+            self.assertTrue(f.read().startswith('\x89PNG'))
+        self.assertIsNone(packages.Package('not-even-real').get_icon())
+        self.assertEqual(packages.Package('not-even-real').get_previewpics(),
+            [])
 
 
     def testRemove(self):